@@ -0,0 +1,166 @@
+# backtester.py
+"""
+Бэктест сигналов EnhancedFundingTrendAnalyzer на данных из market_store
+(история фандинга и минутные свечи, которые собирает data_collector.py или /export).
+
+Перед каждой выплатой анализатор видит последние --lookback ставок и текущую (ту, что будет
+выплачена) и выдает сигнал. По каждому сигналу открывается позиция за --entry-lead секунд
+до выплаты и закрывается через --exit-delay секунд после --hold-й выплаты. Считаются:
+полученный/уплаченный фандинг, изменение цены (по close минутных свечей), комиссии и спред.
+Для сигналов выхода (long_exit, short_exit) считается сделка против прежней позиции:
+плюс означает, что выйти было правильно.
+
+Одна монета считается векторно (пакетный анализ + NumPy), монеты раздаются пулу процессов.
+Пороги анализатора можно перебирать списками:
+python backtester.py --all --min-rate 0.001,0.003 --min-strength 0.5,0.6 --min-change 0.5,1.0
+"""
+import os
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import numpy as np
+
+from market_store import MarketStore, DEFAULT_ROOT
+from bot import EnhancedFundingTrendAnalyzer, HISTORY_ANALYSIS_POINTS
+
+# Сторона сделки, которую подразумевает сигнал: +1 лонг, -1 шорт
+SIGNAL_SIDES = {
+    'strong_long_entry': 1, 'long_entry': 1, 'hold_long': 1, 'short_exit': 1,
+    'strong_short_entry': -1, 'short_entry': -1, 'hold_short': -1, 'long_exit': -1,
+}
+PRICE_MAX_AGE_MS = 10 * 60 * 1000  # свеча старше - цены на момент сделки нет, сделка пропускается
+
+
+def price_at(timestamps: np.ndarray, closes: np.ndarray, moments: np.ndarray) -> np.ndarray:
+    """Цена закрытия последней свечи, закрывшейся к каждому моменту (NaN, если свечей рядом нет)"""
+    if not len(timestamps):
+        return np.full(len(moments), np.nan)
+    idx = np.searchsorted(timestamps, moments - 60000, side='right') - 1
+    safe = np.maximum(idx, 0)
+    fresh = (idx >= 0) & (moments - 60000 - timestamps[safe] <= PRICE_MAX_AGE_MS)
+    return np.where(fresh, closes[safe], np.nan)
+
+
+def backtest_symbol(job) -> dict:
+    """
+    Все наборы порогов для одной монеты. Возвращает {(пороги, сигнал): [сделок, в плюсе, фандинг,
+    цена, издержки, итог]} - суммы, а не средние, чтобы их можно было сложить по монетам.
+    """
+    root, exchange, symbol, params_grid, options = job
+    store = MarketStore(root)
+    funding = store.read_range('funding', exchange, symbol)
+    klines = store.read_range('klines_1m', exchange, symbol)
+    lookback, hold = options['lookback'], options['hold']
+    n_events = len(funding) - lookback - hold + 1
+    if n_events <= 0:
+        return {}
+
+    settle_times, rates = funding['timestamp'], funding['rate']
+    decimals = {}  # ставки MEXC короткие: repr(float) дает ту же Decimal, что пришла от биржи
+    rate_decimals = [decimals.setdefault(rate, Decimal(repr(rate))) for rate in rates.tolist()]
+    events = np.arange(lookback, lookback + n_events)  # индекс выплаты, перед которой выдается сигнал
+    histories = [rate_decimals[i - lookback:i] for i in events.tolist()]
+    currents = [rate_decimals[i] for i in events.tolist()]
+
+    # --- одинаково для всех порогов: фандинг за удержание и цены входа/выхода ---
+    cumulative = np.concatenate([[0.0], np.cumsum(rates)])
+    held_funding = cumulative[events + hold] - cumulative[events]  # выплаты events .. events+hold-1
+    entry_price = price_at(klines['timestamp'], klines['close'], settle_times[events] - options['entry_lead_ms'])
+    exit_price = price_at(klines['timestamp'], klines['close'], settle_times[events + hold - 1] + options['exit_delay_ms'])
+    price_move = exit_price / entry_price - 1
+    costs = 2 * options['fee'] + options['spread']
+    priced = np.isfinite(price_move)
+
+    totals = {}
+    for params in params_grid:
+        analyzer = EnhancedFundingTrendAnalyzer(dict(params))
+        signals = np.array([a['signal'] for a in analyzer.analyze_history_batch(histories, currents)], dtype=object)
+        for signal, side in SIGNAL_SIDES.items():
+            mask = (signals == signal) & priced
+            if not mask.any():
+                continue
+            funding_pnl = -side * held_funding[mask]  # лонг получает при отрицательной ставке
+            price_pnl = side * price_move[mask]
+            net = funding_pnl + price_pnl - costs
+            totals[(params, signal)] = np.array([mask.sum(), (net > 0).sum(), funding_pnl.sum(),
+                                                 price_pnl.sum(), costs * mask.sum(), net.sum()])
+    return totals
+
+
+def list_symbols(store: MarketStore, exchange: str) -> list:
+    path = os.path.join(store.root, exchange)
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name, 'funding')))
+
+
+def parse_grid(args) -> list:
+    """Декартово произведение списков порогов -> кортежи пар (имя, значение)"""
+    axes = {'min_rate': args.min_rate, 'min_strength': args.min_strength,
+            'hold_strength': args.hold_strength, 'min_change_pct': args.min_change}
+    axes = {name: [float(v) for v in values.split(',')] for name, values in axes.items() if values}
+    return [tuple(zip(axes, combo)) for combo in itertools.product(*axes.values())] or [()]
+
+
+def print_report(totals: dict):
+    """Средние на сделку, лучшие комбинации порогов и сигналов сверху"""
+    labels = {params: ", ".join(f"{name}={value:g}" for name, value in params) or "по умолчанию" for params, _ in totals}
+    width = max(len(label) for label in labels.values())
+    print(f"{'пороги':<{width}} {'сигнал':<19} {'сделок':>6} {'winrate':>8} {'фандинг':>9} {'цена':>9} {'издержки':>9} {'итог':>9}")
+    rows = sorted(totals.items(), key=lambda item: -item[1][5] / item[1][0])
+    for (params, signal), sums in rows:
+        trades = sums[0]
+        print(f"{labels[params]:<{width}} {signal:<19} {trades:>6.0f} {sums[1] / trades:>8.1%} "
+              + " ".join(f"{value / trades * 100:>+8.3f}%" for value in sums[2:]))
+
+
+def parse_args():
+    defaults = EnhancedFundingTrendAnalyzer.SIGNAL_THRESHOLDS
+    parser = argparse.ArgumentParser(description="Бэктест сигналов анализатора фандинга на данных market_store")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--symbols", help="монеты через запятую, например BTC_USDT,ETH_USDT")
+    target.add_argument("--all", action="store_true", help="все монеты биржи, по которым есть фандинг в хранилище")
+    parser.add_argument("--store", default=DEFAULT_ROOT,
+                        help="корень market_store (по умолчанию общий с ботом и data_collector.py: %(default)s)")
+    parser.add_argument("--exchange", default="MEXC")
+    parser.add_argument("--lookback", type=int, default=HISTORY_ANALYSIS_POINTS, help="сколько прошлых выплат видит анализатор")
+    parser.add_argument("--hold", type=int, default=1, help="сколько выплат держать позицию")
+    parser.add_argument("--entry-lead", type=int, default=60, help="вход за столько секунд до выплаты")
+    parser.add_argument("--exit-delay", type=int, default=60, help="выход через столько секунд после последней выплаты")
+    parser.add_argument("--fee", type=float, default=0.0004, help="комиссия тейкера за сторону, доля")
+    parser.add_argument("--spread", type=float, default=0.0005, help="потери на спреде за сделку (вход+выход), доля")
+    parser.add_argument("--min-rate", default=str(defaults['min_rate']), help="порог |ставки|, можно списком через запятую")
+    parser.add_argument("--min-strength", default=str(defaults['min_strength']), help="сила тренда для входа/выхода, списком")
+    parser.add_argument("--hold-strength", default=str(defaults['hold_strength']), help="сила тренда, чтобы держать, списком")
+    parser.add_argument("--min-change", default=str(defaults['min_change_pct']), help="изменение ставки за последние периоды, %%, списком")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="процессов в пуле")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    store = MarketStore(args.store)
+    symbols = args.symbols.split(",") if args.symbols else list_symbols(store, args.exchange)
+    grid = parse_grid(args)
+    options = {'lookback': args.lookback, 'hold': args.hold, 'fee': args.fee, 'spread': args.spread,
+               'entry_lead_ms': args.entry_lead * 1000, 'exit_delay_ms': args.exit_delay * 1000}
+    print(f"--- {len(symbols)} монет, {len(grid)} наборов порогов, {args.workers} процессов ---")
+    started = time.monotonic()
+    totals = {}
+    jobs = [(args.store, args.exchange, symbol, grid, options) for symbol in symbols]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for result in pool.map(backtest_symbol, jobs, chunksize=max(1, len(jobs) // (args.workers * 4))):
+            for key, sums in result.items():
+                totals[key] = totals[key] + sums if key in totals else sums
+    print(f"--- Готово за {time.monotonic() - started:.1f}с ---")
+    if not totals:
+        print("❌ Нет сделок: мало истории фандинга или нет свечей вокруг выплат.")
+        return
+    print_report(totals)
+
+
+if __name__ == "__main__":
+    main()
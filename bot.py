@@ -4,15 +4,25 @@
 # =========================================================================
 
 import os
+import sys
+import abc
 import asyncio
 import aiohttp
+import numpy as np
 import decimal
 import json
 import time
 import hmac
 import hashlib
 import traceback
+import bisect
+import heapq
 import io
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone, timedelta
 from decimal import Decimal
 from typing import Dict, List, Tuple, Optional
@@ -24,6 +34,8 @@ from telegram.ext import (
 )
 from dotenv import load_dotenv
 
+from market_store import MarketStore, DEFAULT_ROOT as MARKET_STORE_PATH
+
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
@@ -48,28 +60,348 @@ def check_access(user_id: int) -> bool:
         return False
     return user_id in ALLOWED_USERS
 
+# ===== ОБЩИЙ HTTP-КЛИЕНТ С ПУЛОМ СОЕДИНЕНИЙ =====
+# Один долгоживущий клиент на всё приложение: keep-alive соединения, лимит на хост
+# и кэш DNS, чтобы каждый цикл сканера не платил за новые TCP+TLS рукопожатия.
+HTTP_POOL_LIMIT = 100               # всего открытых соединений
+HTTP_POOL_LIMIT_PER_HOST = 30       # соединений на одну биржу
+HTTP_DNS_CACHE_SECONDS = 600        # кэш DNS
+HTTP_KEEPALIVE_SECONDS = 120        # держим соединение дольше цикла сканера (60 сек)
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общий HTTP-клиент, создавая его при первом обращении"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+    return _http_session
+
+@asynccontextmanager
+async def shared_http_session():
+    """Отдает общий клиент для `async with`, не закрывая его на выходе из блока"""
+    yield get_http_session()
+
+async def close_http_session():
+    """Закрывает пул соединений при остановке приложения"""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+# ===== ЛИМИТЫ ЗАПРОСОВ К БИРЖАМ =====
+# Token bucket на каждую биржу (а для тяжелых эндпоинтов - отдельный bucket).
+# Запросы не отбрасываются, а ждут своей очереди; ответы 429/418 и заголовки
+# с использованным весом (Binance X-MBX-USED-WEIGHT-1M, Bybit X-Bapi-Limit-Status)
+# притормаживают весь bucket, чтобы не получить бан по IP.
+# За любое окно W bucket пропускает до capacity + refill * W весов (полный запас плюс пополнение),
+# поэтому для лимита L за окно W нужно capacity + refill * W <= L.
+RATE_LIMITS = {
+    # bucket: {'capacity': макс. запас весов, 'refill': весов в секунду, 'window_limit': лимит окна сервера}
+    'Bybit':            {'capacity': 50,   'refill': 20},     # 600 запросов / 5 сек: 50 + 20*5 = 150
+    'MEXC':             {'capacity': 10,   'refill': 5},      # 20 запросов / 2 сек: 10 + 5*2 = 20
+    'Binance':          {'capacity': 1200, 'refill': 20, 'window_limit': 2400},  # 2400 веса / мин: 1200 + 20*60 = 2400
+    'OKX':              {'capacity': 10,   'refill': 5},      # 20 запросов / 2 сек: 10 + 5*2 = 20
+    'OKX funding-rate': {'capacity': 5,    'refill': 2.5},    # 10 запросов / 2 сек: 5 + 2.5*2 = 10
+    'KuCoin':           {'capacity': 20,   'refill': 10},
+    'Bitget':           {'capacity': 10,   'refill': 10},     # 20 запросов / сек: 10 + 10*1 = 20
+    'Gate.io':          {'capacity': 50,   'refill': 15},     # 200 запросов / 10 сек: 50 + 15*10 = 200
+    'Hyperliquid':      {'capacity': 600,  'refill': 10},     # 1200 веса / мин: 600 + 10*60 = 1200
+    'HTX':              {'capacity': 20,   'refill': 10},
+}
+RATE_LIMIT_MAX_RETRIES = 3
+RATE_LIMIT_BACKOFF_BASE_SECONDS = 1.0
+RATE_LIMIT_BACKOFF_MAX_SECONDS = 60.0
+
+class TokenBucket:
+    """Token bucket с FIFO-очередью ожидающих и возможностью заблокировать до момента времени"""
+
+    def __init__(self, capacity: float, refill: float, window_limit: Optional[float] = None):
+        self.capacity = capacity
+        self.refill = refill
+        self.window_limit = window_limit
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()  # asyncio.Lock честный (FIFO), он и есть очередь
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill)
+        self.updated = now
+
+    async def acquire(self, weight: float = 1):
+        weight = min(weight, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0 and self.tokens >= weight:
+                    self.tokens -= weight
+                    return
+                await asyncio.sleep(max(wait, (weight - self.tokens) / self.refill))
+
+    def block_for(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def sync_used_weight(self, used: float):
+        """Подстраивает запас под вес, который сервер уже насчитал в текущем окне"""
+        if self.window_limit:
+            self._refill()
+            self.tokens = min(self.tokens, max(0.0, self.window_limit - used))
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Dict]):
+        self.buckets = {name: TokenBucket(**config) for name, config in limits.items()}
+        self.throttled_count: Dict[str, int] = {}
+
+    def bucket(self, name: str) -> TokenBucket:
+        if name not in self.buckets:
+            self.buckets[name] = TokenBucket(capacity=10, refill=5)
+        return self.buckets[name]
+
+    async def acquire(self, name: str, weight: float = 1):
+        await self.bucket(name).acquire(weight)
+
+    def observe(self, name: str, response: aiohttp.ClientResponse):
+        """Читает заголовки лимитов из ответа биржи"""
+        bucket = self.bucket(name)
+        headers = response.headers
+        used_weight = headers.get('X-MBX-USED-WEIGHT-1M') or headers.get('X-MBX-USED-WEIGHT-1m')
+        if used_weight and used_weight.isdigit():
+            bucket.sync_used_weight(int(used_weight))
+        remaining = headers.get('X-Bapi-Limit-Status')
+        reset_ms = headers.get('X-Bapi-Limit-Reset-Timestamp')
+        if remaining is not None and remaining.isdigit() and int(remaining) <= 0 and reset_ms and reset_ms.isdigit():
+            bucket.block_for(max(0.0, int(reset_ms) / 1000 - time.time()))
+
+    def backoff_delay(self, name: str, response: aiohttp.ClientResponse, attempt: int) -> float:
+        """Пауза после 429/418: Retry-After, если биржа его прислала, иначе экспонента с джиттером"""
+        self.throttled_count[name] = self.throttled_count.get(name, 0) + 1
+        delay = min(RATE_LIMIT_BACKOFF_MAX_SECONDS, RATE_LIMIT_BACKOFF_BASE_SECONDS * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        retry_after = response.headers.get('Retry-After')
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        self.bucket(name).block_for(delay)
+        return delay
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+@asynccontextmanager
+async def exchange_request(session: aiohttp.ClientSession, bucket: str, method: str, url: str, weight: float = 1, **kwargs):
+    """
+    Запрос к бирже через лимитер: ждет свободный вес, учитывает заголовки лимитов
+    и повторяет запрос после 429/418 с паузой. Используется как `session.get(...)`.
+    """
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        await rate_limiter.acquire(bucket, weight)
+        response = await session.request(method, url, **kwargs)
+        rate_limiter.observe(bucket, response)
+        if response.status in (429, 418):
+            delay = rate_limiter.backoff_delay(bucket, response, attempt)
+            print(f"[RATE_LIMIT] {bucket}: Статус {response.status}, пауза {delay:.1f} сек (попытка {attempt + 1})")
+            # Бан на долгий срок (418) не пересиживаем внутри запроса - отдаем ответ вызывающему
+            if attempt < RATE_LIMIT_MAX_RETRIES and delay <= RATE_LIMIT_BACKOFF_MAX_SECONDS:
+                response.release()
+                await asyncio.sleep(delay)
+                continue
+        try:
+            yield response
+        finally:
+            response.release()
+        return
+
 # ===== УЛУЧШЕННЫЙ МОДУЛЬ: АНАЛИЗАТОР ТРЕНДОВ FUNDING RATE =====
 
 # <<< НАЧАЛО ПОЛНОСТЬЮ ИСПРАВЛЕННОГО БЛОКА АНАЛИЗАТОРА >>>
 
+# ===== ЛОКАЛЬНОЕ ХРАНИЛИЩЕ ИСТОРИИ СТАВОК =====
+HISTORY_DB_PATH = os.getenv("FUNDING_HISTORY_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'funding_history.sqlite3'))
+HISTORY_BACKFILL_LIMIT = {'MEXC': 100, 'BYBIT': 200}  # первичная загрузка монеты - максимум страницы API
+HISTORY_INCREMENT_LIMIT = 15                          # после выплаты догружаем только хвост
+HISTORY_ANALYSIS_POINTS = 15                          # сколько последних выплат видит анализатор
+
+class FundingHistoryStore:
+    """
+    SQLite-хранилище выплат: (биржа, монета, время выплаты) -> ставка. Ставка хранится строкой,
+    чтобы Decimal читался без потерь. synced_until - до какого момента история монеты полная
+    (время следующей выплаты на момент синхронизации): раньше него сеть не нужна.
+    Методы блокирующие - из event loop их вызывают через asyncio.to_thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS funding_history (
+                    exchange TEXT NOT NULL, symbol TEXT NOT NULL, funding_time INTEGER NOT NULL, rate TEXT NOT NULL,
+                    PRIMARY KEY (exchange, symbol, funding_time)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS history_sync (
+                    exchange TEXT NOT NULL, symbol TEXT NOT NULL, synced_until INTEGER NOT NULL,
+                    PRIMARY KEY (exchange, symbol)
+                ) WITHOUT ROWID;
+            """)
+            self._conn = conn
+        return self._conn
+
+    def synced_until(self, exchange: str, symbol: str) -> Optional[int]:
+        """None - монета еще ни разу не загружалась (нужна первичная загрузка)"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT synced_until FROM history_sync WHERE exchange = ? AND symbol = ?", (exchange, symbol)).fetchone()
+        return row[0] if row else None
+
+    def append(self, exchange: str, symbol: str, rows: List[Tuple[int, Decimal]], synced_until: int) -> int:
+        """Добавляет новые выплаты (уже известные пропускаются); возвращает число добавленных"""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO funding_history VALUES (?, ?, ?, ?)",
+                                 [(exchange, symbol, funding_time, str(rate)) for funding_time, rate in rows])
+                added = conn.total_changes - before
+                conn.execute("INSERT OR REPLACE INTO history_sync VALUES (?, ?, ?)", (exchange, symbol, synced_until))
+        return added
+
+    def recent(self, exchange: str, symbol: str, limit: int) -> List[Decimal]:
+        """Последние limit ставок, от старых к новым"""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT rate FROM funding_history WHERE exchange = ? AND symbol = ? ORDER BY funding_time DESC LIMIT ?",
+                (exchange, symbol, limit)).fetchall()
+        return [Decimal(rate) for rate, in reversed(rows)]
+
+    def summary(self, exchange: str, symbol: str) -> Tuple[int, Optional[int]]:
+        """Число выплат в хранилище и время самой ранней (по индексу, без чтения ставок)"""
+        with self._lock:
+            count, first = self._connection().execute(
+                "SELECT COUNT(*), MIN(funding_time) FROM funding_history WHERE exchange = ? AND symbol = ?",
+                (exchange, symbol)).fetchone()
+        return count, first
+
+history_store = FundingHistoryStore(HISTORY_DB_PATH)
+
+HISTORY_CACHE_MAX_ENTRIES = 4000          # (биржа, монета); сверх лимита вытесняются давно не читанные
+HISTORY_NEGATIVE_TTL_SECONDS = 300        # сколько помним, что история монеты недоступна
+HISTORY_SETTLEMENT_GRACE_SECONDS = 60     # выплата уже прошла, а снимок еще старый - перепроверим скоро
+HISTORY_EXCHANGES = ('MEXC', 'BYBIT')     # биржи, для которых анализатор умеет получать историю
+HISTORY_PREFETCH_CONCURRENCY = 6          # параллельных запросов истории при прогреве (поверх лимитера бирж)
+BATCH_RATE_DECIMALS = 12                  # пакетный анализ считает ставки целыми в единицах 1e-12
+
+class HistoryCache:
+    """
+    Ограниченный LRU-кэш истории ставок. История меняется только в момент выплаты,
+    поэтому запись живет ровно до next_funding_time монеты. Пустой ответ (ошибка или нет
+    истории) тоже кэшируется, но коротко - чтобы не долбить биржу каждым анализом.
+    """
+
+    def __init__(self, max_entries: int = HISTORY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[Tuple[str, str], Tuple[List[Decimal], float]]' = OrderedDict()
+        self.hits = self.negative_hits = self.misses = self.evictions = 0
+
+    def get(self, key: Tuple[str, str], now: float) -> Optional[List[Decimal]]:
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        if entry[0]:
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return entry[0]
+
+    def is_fresh(self, key: Tuple[str, str], now: float) -> bool:
+        """Есть ли живая запись (без учета в счетчиках и без изменения порядка LRU)"""
+        entry = self.entries.get(key)
+        return entry is not None and entry[1] > now
+
+    def put(self, key: Tuple[str, str], history: List[Decimal], expires_at: float):
+        self.entries[key] = (history, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self.entries), 'hits': self.hits, 'negative_hits': self.negative_hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
 class EnhancedFundingTrendAnalyzer:
     """
     Улучшенный анализатор трендов funding rates с точными торговыми сигналами
     и всеми необходимыми функциями для получения данных.
     """
     
-    def __init__(self):
-        self.historical_cache = {}
-        self.cache_lifetime_minutes = 30
+    _UNSCALABLE = object()  # ставку нельзя точно перевести в целые - монета считается скалярно
+
+    SIGNAL_RECOMMENDATIONS = {
+        'rate_too_low': 'Ставка слишком низкая',
+        'strong_long_entry': '🚀 СИЛЬНЫЙ ЛОНГ: Ставка быстро падает (становится выгоднее).',
+        'long_entry': '📈 Вход в ЛОНГ: Ставка стабильно падает (становится выгоднее).',
+        'long_exit': '📉 Выход из ЛОНГА: Ставка растет к нулю, становится невыгодно.',
+        'hold_long': '⏸️ ДЕРЖАТЬ ЛОНГ: Ставка остается выгодной и стабильной.',
+        'strong_short_entry': '🎯 СИЛЬНЫЙ ШОРТ: Ставка быстро растет (становится выгоднее).',
+        'short_entry': '📉 Вход в ШОРТ: Ставка стабильно растет (становится выгоднее).',
+        'short_exit': '📈 Выход из ШОРТА: Ставка падает к нулю, становится невыгодно.',
+        'hold_short': '⏸️ ДЕРЖАТЬ ШОРТ: Ставка остается выгодной и стабильной.',
+        'wait': '⏱️ ОЖИДАНИЕ: Тренд неясен, нет четкого сигнала.',
+    }
+
+    # Пороги _generate_trading_signal; backtester.py перебирает их, бот работает с этими
+    SIGNAL_THRESHOLDS = {
+        'min_rate': 0.003,       # |ставка| ниже - rate_too_low; выше - можно держать позицию
+        'min_strength': 0.6,     # сила тренда для входа/выхода
+        'hold_strength': 0.4,    # сила тренда, чтобы держать
+        'min_change_pct': 1.0,   # суммарное изменение ставки за последние периоды, %
+    }
+
+    def __init__(self, thresholds: Optional[Dict[str, float]] = None):
+        self.thresholds = {**self.SIGNAL_THRESHOLDS, **(thresholds or {})}
+        self.historical_cache = HistoryCache()
+        self.history_fetches: Dict[Tuple[str, str], asyncio.Task] = {}  # идущие запросы истории (single-flight)
+        self.cache_lifetime_minutes = 30  # если время выплаты неизвестно
+        self._scaled_memo: Dict[Decimal, object] = {}  # ставка -> целое для пакетного анализа
         
-    async def analyze_trading_opportunity(self, symbol: str, exchange: str, current_rate: Decimal) -> Dict:
+    async def analyze_trading_opportunity(self, symbol: str, exchange: str, current_rate: Decimal, next_funding_time: Optional[int] = None) -> Dict:
         """
         Анализирует торговые возможности на основе трендов funding rate.
         """
-        history = await self._get_funding_history_real(symbol, exchange, periods=10)
-        
+        history = await self._get_funding_history_real(symbol, exchange, periods=10, next_funding_time=next_funding_time)
+        return self.analyze_history(history, current_rate)
+
+    @staticmethod
+    def _insufficient_data() -> Dict:
+        return {'signal': 'insufficient_data', 'confidence': 0.0, 'recommendation': 'Недостаточно данных для анализа', 'trend_direction': 'unknown', 'trend_strength': 0.0, 'data_source': 'insufficient'}
+
+    @staticmethod
+    def _change_text(before: Decimal, after: Decimal) -> str:
+        return f"Было: {before * 100:+.3f}%, стало: {after * 100:+.3f}%"
+
+    def analyze_history(self, history: List[Decimal], current_rate: Decimal) -> Dict:
+        """Сигнал по уже полученной истории (без запросов к бирже)"""
         if not history or len(history) < 3:
-            return {'signal': 'insufficient_data', 'confidence': 0.0, 'recommendation': 'Недостаточно данных для анализа', 'trend_direction': 'unknown', 'trend_strength': 0.0, 'data_source': 'insufficient'}
+            return self._insufficient_data()
         
         trend_analysis = self._analyze_detailed_trend(history, current_rate)
         stability_analysis = self._analyze_trend_stability(history, current_rate)
@@ -121,9 +453,7 @@ class EnhancedFundingTrendAnalyzer:
             else: momentum = 'steady'
         else: momentum = 'steady'
 
-        before_val_pct = all_rates[-2] * 100
-        after_val_pct = all_rates[-1] * 100
-        change_text = f"Было: {before_val_pct:+.3f}%, стало: {after_val_pct:+.3f}%"
+        change_text = self._change_text(all_rates[-2], all_rates[-1])
         
         return {
             'direction': direction, 'strength': strength, 'recent_change_pct': recent_change_pct,
@@ -158,93 +488,293 @@ class EnhancedFundingTrendAnalyzer:
         КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Полностью переработана логика для соответствия правильной
         стратегии фандинг-арбитража.
         """
+        t = self.thresholds
+        min_rate, min_strength, min_change = t['min_rate'], t['min_strength'], t['min_change_pct']
         # --- ОБЩИЕ ПРОВЕРКИ ---
-        if abs(rate) < 0.003:
-            return {'signal': 'rate_too_low', 'confidence': 0, 'recommendation': 'Ставка слишком низкая'}
+        if abs(rate) < min_rate:
+            return {'signal': 'rate_too_low', 'confidence': 0, 'recommendation': self.SIGNAL_RECOMMENDATIONS['rate_too_low']}
         
         confidence = min(1.0, (stability['score'] + trend['strength']) / 2 + min(0.2, len(history) * 0.03))
 
         # === ПРАВИЛЬНАЯ ЛОГИКА ДЛЯ ЛОНГ ПОЗИЦИЙ (когда ставка ОТРИЦАТЕЛЬНАЯ) ===
         if rate < 0:
             # СИГНАЛ НА ВХОД В ЛОНГ: Ставка отрицательная и становится еще более отрицательной (это хорошо)
-            if trend['direction'] == 'declining' and trend['strength'] >= 0.6 and trend['recent_change_pct'] < -1.0:
-                if trend['momentum'] == 'accelerating': return {'signal': 'strong_long_entry', 'confidence': min(1.0, confidence*1.2), 'recommendation': '🚀 СИЛЬНЫЙ ЛОНГ: Ставка быстро падает (становится выгоднее).'}
-                return {'signal': 'long_entry', 'confidence': confidence, 'recommendation': '📈 Вход в ЛОНГ: Ставка стабильно падает (становится выгоднее).'}
+            if trend['direction'] == 'declining' and trend['strength'] >= min_strength and trend['recent_change_pct'] < -min_change:
+                if trend['momentum'] == 'accelerating': return {'signal': 'strong_long_entry', 'confidence': min(1.0, confidence*1.2), 'recommendation': self.SIGNAL_RECOMMENDATIONS['strong_long_entry']}
+                return {'signal': 'long_entry', 'confidence': confidence, 'recommendation': self.SIGNAL_RECOMMENDATIONS['long_entry']}
 
             # СИГНАЛ НА ВЫХОД ИЗ ЛОНГА: Ставка все еще отрицательная, но начала расти к нулю (это плохо)
-            if trend['direction'] == 'growing' and trend['strength'] >= 0.6 and trend['recent_change_pct'] > 1.0:
-                 return {'signal': 'long_exit', 'confidence': confidence, 'recommendation': '📉 Выход из ЛОНГА: Ставка растет к нулю, становится невыгодно.'}
+            if trend['direction'] == 'growing' and trend['strength'] >= min_strength and trend['recent_change_pct'] > min_change:
+                 return {'signal': 'long_exit', 'confidence': confidence, 'recommendation': self.SIGNAL_RECOMMENDATIONS['long_exit']}
 
             # СИГНАЛ ДЕРЖАТЬ ЛОНГ: Ставка отрицательная и стабильная
-            if trend['direction'] in ['declining', 'stable'] and rate < -0.003 and trend['strength'] >= 0.4:
-                return {'signal': 'hold_long', 'confidence': confidence*0.8, 'recommendation': '⏸️ ДЕРЖАТЬ ЛОНГ: Ставка остается выгодной и стабильной.'}
+            if trend['direction'] in ['declining', 'stable'] and rate < -min_rate and trend['strength'] >= t['hold_strength']:
+                return {'signal': 'hold_long', 'confidence': confidence*0.8, 'recommendation': self.SIGNAL_RECOMMENDATIONS['hold_long']}
 
         # === ПРАВИЛЬНАЯ ЛОГИКА ДЛЯ ШОРТ ПОЗИЦИЙ (когда ставка ПОЛОЖИТЕЛЬНАЯ) ===
         if rate > 0:
             # СИГНАЛ НА ВХОД В ШОРТ: Ставка положительная и растет еще выше (это хорошо)
-            if trend['direction'] == 'growing' and trend['strength'] >= 0.6 and trend['recent_change_pct'] > 1.0:
-                if trend['momentum'] == 'accelerating': return {'signal': 'strong_short_entry', 'confidence': min(1.0, confidence*1.2), 'recommendation': '🎯 СИЛЬНЫЙ ШОРТ: Ставка быстро растет (становится выгоднее).'}
-                return {'signal': 'short_entry', 'confidence': confidence, 'recommendation': '📉 Вход в ШОРТ: Ставка стабильно растет (становится выгоднее).'}
+            if trend['direction'] == 'growing' and trend['strength'] >= min_strength and trend['recent_change_pct'] > min_change:
+                if trend['momentum'] == 'accelerating': return {'signal': 'strong_short_entry', 'confidence': min(1.0, confidence*1.2), 'recommendation': self.SIGNAL_RECOMMENDATIONS['strong_short_entry']}
+                return {'signal': 'short_entry', 'confidence': confidence, 'recommendation': self.SIGNAL_RECOMMENDATIONS['short_entry']}
             
             # СИГНАЛ НА ВЫХОД ИЗ ШОРТА: Ставка все еще положительная, но начала падать к нулю (это плохо)
-            if trend['direction'] == 'declining' and trend['strength'] >= 0.6 and trend['recent_change_pct'] < -1.0:
-                return {'signal': 'short_exit', 'confidence': confidence, 'recommendation': '📈 Выход из ШОРТА: Ставка падает к нулю, становится невыгодно.'}
+            if trend['direction'] == 'declining' and trend['strength'] >= min_strength and trend['recent_change_pct'] < -min_change:
+                return {'signal': 'short_exit', 'confidence': confidence, 'recommendation': self.SIGNAL_RECOMMENDATIONS['short_exit']}
 
             # СИГНАЛ ДЕРЖАТЬ ШОРТ: Ставка положительная и стабильная
-            if trend['direction'] in ['growing', 'stable'] and rate > 0.003 and trend['strength'] >= 0.4:
-                return {'signal': 'hold_short', 'confidence': confidence*0.8, 'recommendation': '⏸️ ДЕРЖАТЬ ШОРТ: Ставка остается выгодной и стабильной.'}
+            if trend['direction'] in ['growing', 'stable'] and rate > min_rate and trend['strength'] >= t['hold_strength']:
+                return {'signal': 'hold_short', 'confidence': confidence*0.8, 'recommendation': self.SIGNAL_RECOMMENDATIONS['hold_short']}
         
         # Если ни одно из правил не сработало, значит тренд неясен
-        return {'signal': 'wait', 'confidence': confidence*0.5, 'recommendation': '⏱️ ОЖИДАНИЕ: Тренд неясен, нет четкого сигнала.'}
-    
+        return {'signal': 'wait', 'confidence': confidence*0.5, 'recommendation': self.SIGNAL_RECOMMENDATIONS['wait']}
+    
+    # --- ПАКЕТНЫЙ АНАЛИЗ (NumPy) ---
+    # Та же логика, что у _analyze_detailed_trend/_analyze_trend_stability/_generate_trading_signal,
+    # но сразу для всех монет с историей одной длины. Ставки переводятся в целые (единицы 1e-12),
+    # поэтому сравнения ставок точные, а проценты изменения - это correctly rounded float того же
+    # отношения, что считает Decimal. Дальше те же операции float в том же порядке.
+    def analyze_history_batch(self, histories: List[List[Decimal]], current_rates: List[Decimal]) -> List[Dict]:
+        """analyze_history для многих монет сразу; результаты совпадают со скалярным путем"""
+        results: List[Optional[Dict]] = [None] * len(histories)
+        groups: Dict[int, List[Tuple[int, List[int]]]] = {}
+        for i, (history, current_rate) in enumerate(zip(histories, current_rates)):
+            scaled = self._scaled_rates(history + [current_rate]) if history and len(history) >= 3 else None
+            if scaled is None:
+                results[i] = self.analyze_history(history, current_rate)  # мало данных или ставка не помещается в целые
+            else:
+                groups.setdefault(len(history), []).append((i, scaled))
+        for rows in groups.values():
+            indices = [i for i, _ in rows]
+            analyses = self._analyze_group(np.array([scaled for _, scaled in rows], dtype=np.int64),
+                                           [histories[i] for i in indices], [current_rates[i] for i in indices])
+            for i, analysis in zip(indices, analyses):
+                results[i] = analysis
+        return results
+
+    def _scaled_rates(self, rates: List[Decimal]) -> Optional[List[int]]:
+        """Ставки целыми в единицах 1e-12 или None, если какую-то нельзя представить точно"""
+        memo = self._scaled_memo  # значения ставок сильно повторяются, as_tuple() дорогой
+        if len(memo) > 200_000:
+            memo.clear()
+        try:
+            scaled = [memo.get(rate) for rate in rates]
+        except TypeError:  # sNaN не хешируется
+            return None
+        if None in scaled:
+            for i, rate in enumerate(rates):
+                if scaled[i] is None:
+                    exact = rate.is_finite() and rate.as_tuple().exponent >= -BATCH_RATE_DECIMALS and abs(rate) < 1
+                    scaled[i] = memo[rate] = int(rate.scaleb(BATCH_RATE_DECIMALS)) if exact else self._UNSCALABLE
+        return None if self._UNSCALABLE in scaled else scaled
+
+    @staticmethod
+    def _sequential_sum(values: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Сумма по строкам слева направо, как sum() в Python (порядок сложения важен для точного совпадения)"""
+        total = np.zeros(len(values))
+        for j in range(values.shape[1]):
+            total = total + values[:, j] if mask is None else np.where(mask[:, j], total + values[:, j], total)
+        return total
+
+    def _analyze_group(self, rates: np.ndarray, histories: List[List[Decimal]], current_rates: List[Decimal]) -> List[Dict]:
+        """rates: монеты x (история + текущая ставка), целые в единицах 1e-12; истории одной длины"""
+        n_history = rates.shape[1] - 1
+        unit = 10 ** BATCH_RATE_DECIMALS
+        near_zero = unit // 10_000  # Decimal('0.0001')
+        prev, curr = rates[:, :-1], rates[:, 1:]
+        step = ((curr - prev) * 100).astype(np.float64)  # точное целое, меньше 2**53
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step_pct = step / np.abs(prev)
+
+        # --- тренд (_analyze_detailed_trend) ---
+        changes = np.where(np.abs(prev) < near_zero,
+                           np.where(curr > prev, 500.0, np.where(np.abs(curr) > near_zero * 2, -500.0, 0.0)),
+                           step_pct)
+        recent = changes[:, -min(4, n_history):]
+        n_recent = recent.shape[1]
+        positive = (recent > 0.1).sum(axis=1)
+        negative = (recent < -0.1).sum(axis=1)
+        recent_change = self._sequential_sum(recent)
+        growing = (positive > negative) & (recent_change > 0.5)
+        declining = ~growing & (negative > positive) & (recent_change < -0.5)
+        strength = np.where(growing, np.minimum(1.0, positive / n_recent),
+                            np.where(declining, np.minimum(1.0, negative / n_recent), 0.5))
+        half = n_recent // 2
+        early = np.abs(self._sequential_sum(recent[:, :half]) / half)
+        late = np.abs(self._sequential_sum(recent[:, half:]) / (n_recent - half))
+        accelerating = late > early * 1.2
+        decelerating = ~accelerating & (late < early * 0.8)
+
+        # --- стабильность (_analyze_trend_stability) ---
+        valid = prev != 0
+        n_valid = valid.sum(axis=1)
+        last_valid = valid & (np.cumsum(valid[:, ::-1], axis=1)[:, ::-1] <= 4)  # последние 4 изменения
+        avg_change = self._sequential_sum(np.where(valid, np.abs(step_pct), 0.0), last_valid) / np.maximum(np.minimum(n_valid, 4), 1)
+        consistency = np.maximum((curr > prev).sum(axis=1), (curr < prev).sum(axis=1)) / n_history
+        high = (consistency >= 0.7) & (avg_change >= 0.1)
+        medium = ~high & (consistency >= 0.5)
+        score = np.where(n_valid == 0, 0.0, np.where(high, np.minimum(1.0, consistency * 1.2),
+                                                      np.where(medium, consistency, consistency * 0.8)))
+
+        # --- сигнал (_generate_trading_signal): порог min_rate сравнивается с float, как у Decimal ---
+        t = self.thresholds
+        rate = rates[:, -1]
+        scaled_min_rate = Decimal(t['min_rate']).scaleb(BATCH_RATE_DECIMALS)  # точное значение float в единицах 1e-12
+        below = int(scaled_min_rate.to_integral_value(rounding=decimal.ROUND_CEILING))  # |ставка| < min_rate  <=>  |целое| < below
+        above = int(scaled_min_rate.to_integral_value(rounding=decimal.ROUND_FLOOR))    # ставка > min_rate  <=>  целое > above
+        min_change = t['min_change_pct']
+        confidence = np.minimum(1.0, (score + strength) / 2 + min(0.2, n_history * 0.03))
+        strong = strength >= t['min_strength']
+        holding = strength >= t['hold_strength']
+        signals = np.full(len(rates), 'wait', dtype=object)
+        factors = np.full(len(rates), 0.5)
+        rules = [  # первое сработавшее правило, как цепочка if/return
+            (np.abs(rate) < below, 'rate_too_low', 0.0),
+            ((rate < 0) & declining & strong & (recent_change < -min_change) & accelerating, 'strong_long_entry', 1.2),
+            ((rate < 0) & declining & strong & (recent_change < -min_change), 'long_entry', 1.0),
+            ((rate < 0) & growing & strong & (recent_change > min_change), 'long_exit', 1.0),
+            ((rate < 0) & ~growing & (rate < -above) & holding, 'hold_long', 0.8),
+            ((rate > 0) & growing & strong & (recent_change > min_change) & accelerating, 'strong_short_entry', 1.2),
+            ((rate > 0) & growing & strong & (recent_change > min_change), 'short_entry', 1.0),
+            ((rate > 0) & declining & strong & (recent_change < -min_change), 'short_exit', 1.0),
+            ((rate > 0) & ~declining & (rate > above) & holding, 'hold_short', 0.8),
+        ]
+        undecided = np.ones(len(rates), dtype=bool)
+        for mask, signal, factor in rules:
+            hit = undecided & mask
+            signals[hit], factors[hit] = signal, factor
+            undecided &= ~mask
+        signal_confidence = np.where(factors == 1.2, np.minimum(1.0, confidence * 1.2),
+                                     np.where(factors == 1.0, confidence, confidence * factors))
+
+        direction = np.where(growing, 'growing', np.where(declining, 'declining', 'stable'))
+        momentum = np.where(accelerating, 'accelerating', np.where(decelerating, 'decelerating', 'steady'))
+        results = []
+        for history, current_rate, signal, conf, trend_direction, trend_strength, change, trend_momentum, stability, trend_changes in zip(
+                histories, current_rates, signals.tolist(), signal_confidence.tolist(), direction.tolist(), strength.tolist(),
+                recent_change.tolist(), momentum.tolist(), score.tolist(), changes.tolist()):
+            results.append({
+                'signal': signal, 'confidence': 0 if signal == 'rate_too_low' else conf,
+                'recommendation': self.SIGNAL_RECOMMENDATIONS[signal], 'trend_direction': trend_direction,
+                'trend_strength': trend_strength, 'recent_change': change,
+                'momentum': trend_momentum, 'stability_score': stability,
+                'data_points': n_history, 'data_source': 'real_api',
+                'analysis_details': {'history': history[-5:], 'current_rate': float(current_rate), 'trend_changes': trend_changes},
+                'change_text': self._change_text(history[-1], current_rate),
+            })
+        return results
+
     # --- НЕДОСТАЮЩИЕ ФУНКЦИИ, КОТОРЫЕ МЫ ВОЗВРАЩАЕМ ---
-    async def _get_funding_history_real(self, symbol: str, exchange: str, periods: int = 10) -> List[Decimal]:
-        cache_key = f"{exchange}_{symbol}"
-        now = time.time()
-        if cache_key in self.historical_cache:
-            cached_data, cached_time = self.historical_cache[cache_key]
-            if now - cached_time < self.cache_lifetime_minutes * 60:
-                return cached_data
+    async def _get_funding_history_real(self, symbol: str, exchange: str, periods: int = 10, next_funding_time: Optional[int] = None) -> List[Decimal]:
+        cache_key = (exchange.upper(), symbol)
+        if cache_key[0] not in HISTORY_EXCHANGES:
+            return []  # истории у биржи нет - в кэш не кладем, чтобы не вытеснять настоящие истории
+        cached = self.historical_cache.get(cache_key, time.time())
+        if cached is not None:
+            return cached
         
-        if exchange.upper() == 'MEXC': history = await self._fetch_mexc_funding_history(symbol)
-        elif exchange.upper() == 'BYBIT': history = await self._fetch_bybit_funding_history(symbol)
-        else: history = []
+        task = self.history_fetches.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_history(cache_key, next_funding_time))
+            self.history_fetches[cache_key] = task
+            task.add_done_callback(lambda _: self.history_fetches.pop(cache_key, None))
+        return await asyncio.shield(task)
+
+    async def prefetch_history(self, records: List['FundingRecord']) -> int:
+        """Прогревает кэш истории для записей, у которых ее нет; возвращает число запросов"""
+        now = time.time()
+        missing: Dict[Tuple[str, str], FundingRecord] = {}
+        for item in records:
+            key = (item.exchange.upper(), item.symbol)
+            if key[0] in HISTORY_EXCHANGES and key not in missing and not self.historical_cache.is_fresh(key, now):
+                missing[key] = item
+        semaphore = asyncio.Semaphore(HISTORY_PREFETCH_CONCURRENCY)
+
+        async def prefetch(item: FundingRecord):
+            async with semaphore:
+                await self._get_funding_history_real(item.symbol, item.exchange, next_funding_time=item.next_funding_time)
+
+        await asyncio.gather(*(prefetch(item) for item in missing.values()))
+        return len(missing)
+
+    async def _sync_history(self, exchange: str, symbol: str, next_funding_time: Optional[int]) -> bool:
+        """
+        Догружает в хранилище выплаты, которых там еще нет. Возвращает False, если история
+        была нужна, но биржа ее не отдала (тогда отдаем то, что уже лежит в хранилище).
+        """
+        now_ms = int(time.time() * 1000)
+        synced_until = await asyncio.to_thread(history_store.synced_until, exchange, symbol)
+        if synced_until is not None and now_ms < synced_until:
+            return True  # с прошлой синхронизации выплат не было
+        if synced_until is None:
+            limit = HISTORY_BACKFILL_LIMIT[exchange]
+        else:  # бот мог простаивать: берем с запасом по часовым выплатам, но не больше первичной загрузки
+            limit = min(HISTORY_BACKFILL_LIMIT[exchange], max(HISTORY_INCREMENT_LIMIT, (now_ms - synced_until) // 3_600_000 + 2))
+        if exchange == 'MEXC': rows = await self._fetch_mexc_funding_history(symbol, limit)
+        else: rows = await self._fetch_bybit_funding_history(symbol, limit)
+        if not rows:
+            return False
+        if synced_until is not None and rows[-1][0] < synced_until - HISTORY_SETTLEMENT_GRACE_SECONDS * 1000:
+            next_sync = now_ms + HISTORY_SETTLEMENT_GRACE_SECONDS * 1000  # биржа еще не опубликовала прошедшую выплату
+        elif next_funding_time is not None and next_funding_time > now_ms:
+            next_sync = next_funding_time
+        else:
+            next_sync = now_ms + self.cache_lifetime_minutes * 60 * 1000
+        added = await asyncio.to_thread(history_store.append, exchange, symbol, rows, next_sync)
+        if added:
+            print(f"[DEBUG] История {exchange} {symbol}: +{added} выплат в хранилище")
+        return True
+
+    async def _fetch_history(self, cache_key: Tuple[str, str], next_funding_time: Optional[int]) -> List[Decimal]:
+        exchange, symbol = cache_key
+        synced = await self._sync_history(exchange, symbol, next_funding_time)
+        history = await asyncio.to_thread(history_store.recent, exchange, symbol, HISTORY_ANALYSIS_POINTS)
         
-        if history: self.historical_cache[cache_key] = (history, now)
+        now = time.time()
+        # отрицательная запись - только когда биржа не отдала историю или ее еще нет
+        if not history or not synced:
+            expires_at = now + HISTORY_NEGATIVE_TTL_SECONDS
+        elif next_funding_time is None:
+            expires_at = now + self.cache_lifetime_minutes * 60
+        elif next_funding_time / 1000 > now:
+            expires_at = next_funding_time / 1000
+        else:
+            expires_at = now + HISTORY_SETTLEMENT_GRACE_SECONDS
+        self.historical_cache.put(cache_key, history, expires_at)
         return history
 
-    async def _fetch_mexc_funding_history(self, symbol: str) -> List[Decimal]:
-        mexc_symbol = symbol.replace('USDT', '_USDT')
+    async def _fetch_mexc_funding_history(self, symbol: str, limit: int = HISTORY_INCREMENT_LIMIT) -> List[Tuple[int, Decimal]]:
+        """Последние limit выплат (время в мс, ставка), от старых к новым"""
+        mexc_symbol = symbol_index.native(symbol, 'MEXC') or symbol.replace('USDT', '_USDT')
         url = "https://contract.mexc.com/api/v1/contract/funding_rate/history"
-        params = {'symbol': mexc_symbol, 'page_size': 15}
+        params = {'symbol': mexc_symbol, 'page_size': limit}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, timeout=10) as response:
+            async with shared_http_session() as session:
+                async with exchange_request(session, 'MEXC', 'GET', url, params=params, timeout=10) as response:
                     if response.status != 200: return []
                     data = await response.json()
                     if not data.get('success'): return []
                     api_data = data.get('data', {})
                     funding_data = api_data.get('resultList', [])
                     if not funding_data: return []
-                    rates = [Decimal(str(item.get('fundingRate', 0))) for item in funding_data]
-                    rates.reverse()
-                    return rates
+                    return sorted((int(item['settleTime']), Decimal(str(item.get('fundingRate', 0))))
+                                  for item in funding_data if item.get('settleTime'))
         except Exception: return []
 
-    async def _fetch_bybit_funding_history(self, symbol: str) -> List[Decimal]:
+    async def _fetch_bybit_funding_history(self, symbol: str, limit: int = HISTORY_INCREMENT_LIMIT) -> List[Tuple[int, Decimal]]:
+        """Последние limit выплат (время в мс, ставка), от старых к новым"""
         url = "https://api.bybit.com/v5/market/funding/history"
-        params = {'category': 'linear', 'symbol': symbol, 'limit': 15}
+        params = {'category': 'linear', 'symbol': symbol_index.native(symbol, 'Bybit') or symbol, 'limit': limit}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, timeout=10) as response:
+            async with shared_http_session() as session:
+                async with exchange_request(session, 'Bybit', 'GET', url, params=params, timeout=10) as response:
                     if response.status != 200: return []
                     data = await response.json()
                     if data.get('retCode') != 0: return []
                     result_list = data.get('result', {}).get('list', [])
                     if not result_list: return []
-                    rates = [Decimal(str(item.get('fundingRate', 0))) for item in result_list]
-                    rates.reverse()
-                    return rates
+                    return sorted((int(item['fundingRateTimestamp']), Decimal(str(item.get('fundingRate', 0))))
+                                  for item in result_list if item.get('fundingRateTimestamp'))
         except Exception: return []
 
 # Создаем глобальный экземпляр улучшенного анализатора
@@ -311,12 +841,11 @@ def require_access():
 # === ИСПРАВЛЕННАЯ СТРУКТУРА ДАННЫХ ===
 # Теперь храним и user_id для корректной проверки доступа
 user_settings = {}  # Ключ: chat_id, значение: {'user_id': int, 'settings': dict}
-api_data_cache = {"last_update": None, "data": []}
 CACHE_LIFETIME_SECONDS = 100
-ALL_AVAILABLE_EXCHANGES = ['Bybit', 'MEXC', 'Binance', 'OKX', 'KuCoin', 'Gate.io', 'Bitget', 'Hyperliquid']
+SNAPSHOT_MAX_STALE_SECONDS = 600  # дольше этого старый снимок не отдаем, ждем обновления
 
 # Функция форматирования объема
-def format_volume(volume_usdt: Decimal) -> str:
+def format_volume(volume_usdt: float) -> str:
     """Форматирует объем в читаемый вид (K, M, B)"""
     vol = volume_usdt
     if vol >= 1_000_000_000:
@@ -369,7 +898,307 @@ def ensure_user_settings(chat_id: int, user_id: int):
 # ===================== МОДУЛЬ СБОРА ДАННЫХ (API) =====================
 # =================================================================
 
+# ===== ИНДЕКС СИМВОЛОВ =====
+# Биржи называют один и тот же контракт по-разному: BTC_USDT (MEXC, Gate.io), BTC-USDT-SWAP (OKX),
+# XBTUSDTM (KuCoin), BTC (Hyperliquid). Все записи получают общий канонический символ BTCUSDT,
+# по которому монеты группируются между биржами и ищутся в командах.
+SYMBOL_ALIASES = {'XBT': 'BTC'}  # KuCoin называет биткоин XBT
+
+def canonical_symbol(exchange: str, native: str) -> str:
+    """Приводит нативный символ контракта биржи к виду BASEUSDT"""
+    if exchange == 'Hyperliquid':
+        # Монеты Hyperliquid без котировки; kPEPE - контракт на 1000 PEPE, как 1000PEPEUSDT на Binance и Bybit
+        base = ('1000' + native[1:] if native.startswith('k') and native[1:].isupper() else native).upper()
+    else:
+        text = native.upper()
+        if exchange == 'OKX':
+            text = text.removesuffix('-SWAP')
+        elif exchange == 'KuCoin' and text.endswith('USDTM'):
+            text = text[:-1]
+        base = text.replace('-', '').replace('_', '').removesuffix('USDT')
+    return SYMBOL_ALIASES.get(base, base) + 'USDT'
+
+class SymbolIndex:
+    """
+    Постоянный индекс (биржа, нативный символ) -> канонический символ.
+    Пополняется по мере появления новых инструментов; повторные циклы - только поиск в словаре.
+    """
+
+    def __init__(self):
+        self.canonical_by_native: Dict[Tuple[str, str], str] = {}
+        self.natives: Dict[str, Dict[str, str]] = {}  # канонический символ -> {биржа: нативный символ}
+        self._by_native_text: Dict[str, str] = {}     # нативный символ любой биржи (в верхнем регистре) -> канонический
+
+    def canonical(self, exchange: str, native: str) -> str:
+        key = (exchange, native)
+        symbol = self.canonical_by_native.get(key)
+        if symbol is None:
+            symbol = sys.intern(canonical_symbol(exchange, native))
+            self.canonical_by_native[key] = symbol
+            self.natives.setdefault(symbol, {})[exchange] = native
+            self._by_native_text.setdefault(native.upper(), symbol)
+        return symbol
+
+    def native(self, symbol: str, exchange: str) -> Optional[str]:
+        return self.natives.get(symbol, {}).get(exchange)
+
+    def resolve(self, query: str) -> str:
+        """Канонический символ для ввода пользователя: API3, api3usdt, XBTUSDTM, BTC-USDT-SWAP..."""
+        text = query.strip().upper()
+        if text in self._by_native_text:
+            return self._by_native_text[text]
+        base = text.replace('-', '').replace('_', '').replace('/', '').removesuffix('USDT')
+        return SYMBOL_ALIASES.get(base, base) + 'USDT'
+
+symbol_index = SymbolIndex()
+
+# ===== ЗАПИСЬ О СТАВКЕ ФАНДИНГА =====
+# Фетчеры каждую минуту создают тысячи записей. Вместо словаря с Decimal на каждый инструмент
+# храним компактный объект со __slots__: названия бирж и символов интернированы (одна строка
+# на все биржи и циклы), ставка и объем - float. Decimal нужен только анализатору трендов.
+TRADE_URL_TEMPLATES = {
+    'Bybit': 'https://www.bybit.com/trade/usdt/{}',
+    'MEXC': 'https://futures.mexc.com/exchange/{}',
+    'Binance': 'https://www.binance.com/en/futures/{}',
+    'OKX': 'https://www.okx.com/trade-swap/{}',
+    'KuCoin': 'https://www.kucoin.com/futures/trade/{}',
+    'Bitget': 'https://www.bitget.com/futures/usdt/{}',
+    'Gate.io': 'https://www.gate.io/futures_trade/USDT/{}',
+    'HTX': 'https://www.htx.com/en-us/futures/usdt/{}',
+    'Hyperliquid': 'https://app.hyperliquid.xyz/trade/{}',
+}
+
+FUNDING_DEFAULT_INTERVAL_HOURS = 8  # интервал выплат, если биржа его не отдает (стандарт большинства бирж)
+
+class FundingRecord:
+    """Ставка фандинга одного инструмента на одной бирже"""
+    __slots__ = ('exchange', 'symbol', 'market', 'rate', 'next_funding_time', 'volume_24h_usdt', 'open_interest_usdt',
+                 'funding_interval_hours')
+
+    def __init__(self, exchange: str, native_symbol: str, rate, next_funding_time, volume_24h_usdt=0.0, market: Optional[str] = None,
+                 open_interest_usdt=0.0, funding_interval_hours=0.0):
+        self.exchange = sys.intern(exchange)
+        self.symbol = symbol_index.canonical(self.exchange, native_symbol)
+        # Идентификатор инструмента для ссылки на торговлю (по умолчанию - нативный символ биржи)
+        self.market = sys.intern(native_symbol if market is None else market)
+        self.rate = float(rate)
+        self.next_funding_time = int(next_funding_time)
+        self.volume_24h_usdt = float(volume_24h_usdt)
+        self.open_interest_usdt = float(open_interest_usdt)
+        self.funding_interval_hours = float(funding_interval_hours or 0)  # 0 - биржа интервал не отдает
+
+    @property
+    def hourly_rate(self) -> float:
+        """Ставка в пересчете на час: ноги с выплатой раз в 1ч и раз в 8ч сравнимы только так"""
+        return self.rate / (self.funding_interval_hours or FUNDING_DEFAULT_INTERVAL_HOURS)
+
+    @property
+    def trade_url(self) -> str:
+        return TRADE_URL_TEMPLATES[self.exchange].format(self.market)
+
+    def __repr__(self) -> str:
+        return f"FundingRecord({self.exchange} {self.symbol} rate={self.rate} next={self.next_funding_time})"
+
+# ===== КОЛОНОЧНЫЙ СНИМОК =====
+# Для фильтров и ранжирования снимок хранится колонками NumPy: фильтры по биржам, порогам и окну
+# времени - это маски, а лучшая биржа по каждой монете - групповая операция, без циклов Python.
+# Биржи и символы кодируются числами; таблицы кодов общие для всех снимков и только растут.
+exchange_codes: Dict[str, int] = {}
+symbol_codes: Dict[str, int] = {}
+
+def column_code(codes: Dict[str, int], value: str) -> int:
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(codes)
+    return code
+
+class FundingColumns:
+    """Колонки снимка; строка i соответствует записи records[i]"""
+
+    def __init__(self, records: List[FundingRecord], exchange_id: np.ndarray, symbol_id: np.ndarray, rate: np.ndarray,
+                 next_funding_time: np.ndarray, volume: np.ndarray, open_interest: np.ndarray, hourly_rate: np.ndarray):
+        self.records = records
+        self.exchange_id = exchange_id
+        self.symbol_id = symbol_id
+        self.rate = rate
+        self.abs_rate = np.abs(rate)
+        self.hourly_rate = hourly_rate
+        self.next_funding_time = next_funding_time
+        self.volume = volume
+        self.open_interest = open_interest
+        self._symbol_rows: Optional[Dict[int, np.ndarray]] = None
+        self._ranked: Optional[Tuple[List[int], List[float]]] = None
+
+    @classmethod
+    def from_records(cls, records: List[FundingRecord]) -> 'FundingColumns':
+        n = len(records)
+        return cls(
+            records,
+            np.fromiter((column_code(exchange_codes, r.exchange) for r in records), np.int16, n),
+            np.fromiter((column_code(symbol_codes, r.symbol) for r in records), np.int32, n),
+            np.fromiter((r.rate for r in records), np.float64, n),
+            np.fromiter((r.next_funding_time for r in records), np.int64, n),
+            np.fromiter((r.volume_24h_usdt for r in records), np.float64, n),
+            np.fromiter((r.open_interest_usdt for r in records), np.float64, n),
+            np.fromiter((r.hourly_rate for r in records), np.float64, n),
+        )
+
+    @classmethod
+    def concat(cls, blocks: List['FundingColumns']) -> 'FundingColumns':
+        if len(blocks) == 1:
+            return blocks[0]
+        if not blocks:
+            return cls.from_records([])
+        records = []
+        for block in blocks:
+            records.extend(block.records)
+        return cls(records, *(np.concatenate([getattr(block, name) for block in blocks])
+                              for name in ('exchange_id', 'symbol_id', 'rate', 'next_funding_time', 'volume', 'open_interest', 'hourly_rate')))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def rows_for_symbol(self, symbol: str) -> np.ndarray:
+        """Строки монеты по каноническому символу; словарь строится один раз на снимок"""
+        if self._symbol_rows is None:
+            order = np.argsort(self.symbol_id, kind='stable')
+            codes, starts = np.unique(self.symbol_id[order], return_index=True)
+            self._symbol_rows = dict(zip(codes.tolist(), np.split(order, starts[1:])))
+        code = symbol_codes.get(symbol)
+        return self._symbol_rows.get(code, np.empty(0, dtype=np.intp))
+
+    def records_for_symbol(self, symbol: str) -> List[FundingRecord]:
+        return self.take(self.rows_for_symbol(symbol))
+
+    def ranked(self) -> Tuple[List[int], List[float]]:
+        """Строки по убыванию |ставки| и их ключи -|ставка|; сортируется один раз на блок"""
+        if self._ranked is None:
+            order = np.argsort(-self.abs_rate, kind='stable')
+            self._ranked = order.tolist(), (-self.abs_rate[order]).tolist()
+        return self._ranked
+
+    def exchange_mask(self, exchanges: List[str]) -> np.ndarray:
+        selected = np.zeros(len(exchange_codes) + 1, dtype=bool)
+        selected[[exchange_codes[name] for name in exchanges if name in exchange_codes]] = True
+        return selected[self.exchange_id]
+
+    def funding_window_mask(self, now_ms: int, window_ms: int) -> np.ndarray:
+        """Выплата еще не прошла и наступит не позже чем через window_ms"""
+        time_left = self.next_funding_time - now_ms
+        return (time_left > 0) & (time_left <= window_ms)
+
+    def _group_by_symbol(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Строки, упорядоченные по монете (сортировка стабильна, порядок бирж внутри группы сохраняется)"""
+        ordered = rows[np.argsort(self.symbol_id[rows], kind='stable')]
+        symbols = self.symbol_id[ordered]
+        group_start = np.empty(len(ordered), dtype=bool)
+        group_start[0] = True
+        np.not_equal(symbols[1:], symbols[:-1], out=group_start[1:])
+        return ordered, group_start, np.cumsum(group_start) - 1
+
+    @staticmethod
+    def _first_extreme(ordered: np.ndarray, values: np.ndarray, group_start: np.ndarray, group: np.ndarray, reduce: np.ufunc) -> Tuple[np.ndarray, np.ndarray]:
+        """Первая строка каждой группы с экстремумом values (как у max()/min()) и сами экстремумы"""
+        extremes = reduce.reduceat(values, np.flatnonzero(group_start))
+        candidates = np.flatnonzero(values == extremes[group])
+        first = np.empty(len(candidates), dtype=bool)
+        first[0] = True
+        np.not_equal(group[candidates][1:], group[candidates][:-1], out=first[1:])
+        return ordered[candidates[first]], extremes
+
+    def best_per_symbol(self, rows: np.ndarray) -> np.ndarray:
+        """Для каждой монеты строка с максимальной |ставкой|, по убыванию |ставки|"""
+        if not len(rows):
+            return rows
+        ordered, group_start, group = self._group_by_symbol(rows)
+        best, maxima = self._first_extreme(ordered, self.abs_rate[ordered], group_start, group, np.maximum)
+        return best[np.argsort(-maxima, kind='stable')]
+
+    def rate_extremes_per_symbol(self, rows: np.ndarray, rates: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """По каждой монете: код символа, строка с макс. ставкой, строка с мин. ставкой, число строк (ставки - rates или rate)"""
+        if not len(rows):
+            return rows, rows, rows, rows
+        ordered, group_start, group = self._group_by_symbol(rows)
+        rate = (self.rate if rates is None else rates)[ordered]
+        highest, _ = self._first_extreme(ordered, rate, group_start, group, np.maximum)
+        lowest, _ = self._first_extreme(ordered, rate, group_start, group, np.minimum)
+        starts = np.flatnonzero(group_start)
+        return self.symbol_id[ordered[starts]], highest, lowest, np.diff(np.append(starts, len(ordered)))
+
+    def take(self, rows: np.ndarray) -> List[FundingRecord]:
+        return [self.records[i] for i in rows]
+
+# ===== РЕЕСТР АДАПТЕРОВ БИРЖ =====
+# Каждая биржа регистрирует свой сборщик данных декоратором @register_exchange
+# и объявляет частоту обновления, таймаут и бюджет параллельных запросов.
+# Порядок регистрации = порядок бирж в меню.
+EXCHANGE_ADAPTERS: Dict[str, Dict] = {}
+exchange_data_cache: Dict[str, Dict] = {}  # Ключ: биржа, значение: {'last_update': попытка, 'last_good': float, 'data': list}
+exchange_fetch_tasks: Dict[str, asyncio.Task] = {}  # идущие запросы к биржам (общие для всех потребителей)
+exchange_fetch_started: Dict[asyncio.Task, float] = {}  # время запуска запроса (monotonic) - для бюджета ожидания
+
+def register_exchange(name: str, refresh_seconds: int = 55, timeout: int = 20, concurrency: int = 2, credentials: Optional[Dict[str, str]] = None):
+    """
+    Регистрирует сборщик данных биржи.
+    credentials: {имя аргумента сборщика: ключ в bot_data}
+    """
+    def decorator(fetcher):
+        EXCHANGE_ADAPTERS[name] = {
+            'name': name,
+            'fetch': fetcher,
+            'refresh_seconds': refresh_seconds,
+            'timeout': timeout,
+            'concurrency': concurrency,
+            'credentials': credentials or {},
+            'semaphore': None,
+            'stream': None,  # WebSocket-поток биржи, если включен (см. ExchangeStream)
+        }
+        return fetcher
+    return decorator
+
+def exchange_semaphore(name: str) -> asyncio.Semaphore:
+    """Семафор, ограничивающий число одновременных запросов к бирже ее бюджетом"""
+    adapter = EXCHANGE_ADAPTERS[name]
+    if adapter['semaphore'] is None:
+        adapter['semaphore'] = asyncio.Semaphore(adapter['concurrency'])
+    return adapter['semaphore']
+
+def get_active_exchanges() -> List[str]:
+    """Биржи, которые включены хотя бы у одного пользователя (в фильтрах или в уведомлениях)"""
+    active = set()
+    for user_data in user_settings.values():
+        if not check_access(user_data.get('user_id')):
+            continue
+        settings = user_data['settings']
+        active.update(settings.get('exchanges', []))
+        active.update(settings.get('alert_exchanges', []))
+    if not active:
+        active.update(get_default_settings()['exchanges'])
+    return [name for name in EXCHANGE_ADAPTERS if name in active]
+
+async def run_exchange_adapter(name: str, bot_data: Dict) -> List[FundingRecord]:
+    """Запускает сборщик биржи с ее таймаутом и ключами из bot_data"""
+    adapter = EXCHANGE_ADAPTERS[name]
+    kwargs = {arg: bot_data.get(key) for arg, key in adapter['credentials'].items()}
+    return await asyncio.wait_for(adapter['fetch'](**kwargs), timeout=adapter['timeout'])
+
+def parse_bybit_ticker(t: Dict) -> Optional[FundingRecord]:
+    """Приводит тикер Bybit (из REST или WebSocket) к стандартному формату"""
+    try:
+        if not t.get("symbol") or not t.get("fundingRate"):
+            return None
+        return FundingRecord('Bybit', t["symbol"], t["fundingRate"], t.get("nextFundingTime"), t.get("turnover24h", "0"),
+                             funding_interval_hours=t.get("fundingIntervalHour") or 0)
+    except (TypeError, ValueError) as e:
+        print(f"[DEBUG] Bybit: Ошибка обработки инструмента {t.get('symbol', 'unknown')}: {e}")
+        return None
+
+@register_exchange('Bybit', timeout=20, credentials={'api_key': 'bybit_api_key', 'secret_key': 'bybit_secret_key'})
 async def get_bybit_data(api_key: str, secret_key: str):
+    stream = EXCHANGE_ADAPTERS['Bybit']['stream']
+    if stream is not None and stream.is_live():
+        return stream.records()
+
     if not api_key or not secret_key:
         print("[API_WARNING] Bybit: Ключи не настроены.")
         return []
@@ -392,8 +1221,8 @@ async def get_bybit_data(api_key: str, secret_key: str):
     results = []
     try:
         print(f"[DEBUG] Bybit: Отправляем запрос к {base_url + request_path}?{params}")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(base_url + request_path + "?" + params, headers=headers, timeout=15) as response:
+        async with shared_http_session() as session:
+            async with exchange_request(session, 'Bybit', 'GET', base_url + request_path + "?" + params, headers=headers, timeout=15) as response:
                 response_text = await response.text()
                 print(f"[DEBUG] Bybit: Статус {response.status}, размер ответа: {len(response_text)} символов")
                 
@@ -412,21 +1241,9 @@ async def get_bybit_data(api_key: str, secret_key: str):
                 if data.get("retCode") == 0 and data.get("result", {}).get("list"):
                     print(f"[DEBUG] Bybit: Получено {len(data['result']['list'])} инструментов")
                     for t in data["result"]["list"]:
-                        try:
-                            if not t.get("symbol") or not t.get("fundingRate"):
-                                continue
-                            results.append({
-                                'exchange': 'Bybit', 
-                                'symbol': t.get("symbol"), 
-                                'rate': Decimal(t.get("fundingRate")), 
-                                'next_funding_time': int(t.get("nextFundingTime")), 
-                                'volume_24h_usdt': Decimal(t.get("turnover24h", "0")), 
-                                'max_order_value_usdt': Decimal('0'), 
-                                'trade_url': f'https://www.bybit.com/trade/usdt/{t.get("symbol")}'
-                            })
-                        except (TypeError, ValueError, decimal.InvalidOperation) as e:
-                            print(f"[DEBUG] Bybit: Ошибка обработки инструмента {t.get('symbol', 'unknown')}: {e}")
-                            continue
+                        record = parse_bybit_ticker(t)
+                        if record:
+                            results.append(record)
                     print(f"[DEBUG] Bybit: Успешно обработано {len(results)} инструментов")
                 else:
                     print(f"[API_ERROR] Bybit: retCode={data.get('retCode')}, retMsg={data.get('retMsg')}")
@@ -439,6 +1256,7 @@ async def get_bybit_data(api_key: str, secret_key: str):
     
     return results
 
+@register_exchange('MEXC', timeout=20, credentials={'api_key': 'mexc_api_key', 'secret_key': 'mexc_secret_key'})
 async def get_mexc_data(api_key: str, secret_key: str):
     results = []
     ticker_url = "https://contract.mexc.com/api/v1/contract/ticker"
@@ -446,25 +1264,26 @@ async def get_mexc_data(api_key: str, secret_key: str):
 
     try:
         print("[DEBUG] MEXC: Запрашиваем данные по тикерам и ставкам...")
-        async with aiohttp.ClientSession() as session:
-            tasks = [
-                session.get(ticker_url, timeout=15),
-                session.get(funding_rate_url, timeout=15)
-            ]
-            responses = await asyncio.gather(*tasks, return_exceptions=True)
-
+        async with shared_http_session() as session:
+            async def fetch_json(url):
+                async with exchange_request(session, 'MEXC', 'GET', url, timeout=15) as response:
+                    if response.status != 200:
+                        return response.status, None
+                    return response.status, await response.json()
+
+            responses = await asyncio.gather(fetch_json(ticker_url), fetch_json(funding_rate_url), return_exceptions=True)
             ticker_response, funding_response = responses
             
-            if isinstance(ticker_response, Exception) or ticker_response.status != 200:
-                print(f"[API_ERROR] MEXC Ticker: Не удалось получить данные. Статус: {getattr(ticker_response, 'status', 'N/A')}")
+            if isinstance(ticker_response, Exception) or ticker_response[1] is None:
+                print(f"[API_ERROR] MEXC Ticker: Не удалось получить данные. Статус: {ticker_response if isinstance(ticker_response, Exception) else ticker_response[0]}")
                 return []
             
-            if isinstance(funding_response, Exception) or funding_response.status != 200:
-                print(f"[API_ERROR] MEXC Funding: Не удалось получить данные. Статус: {getattr(funding_response, 'status', 'N/A')}")
+            if isinstance(funding_response, Exception) or funding_response[1] is None:
+                print(f"[API_ERROR] MEXC Funding: Не удалось получить данные. Статус: {funding_response if isinstance(funding_response, Exception) else funding_response[0]}")
                 return []
                 
-            ticker_data = await ticker_response.json()
-            funding_data = await funding_response.json()
+            ticker_data = ticker_response[1]
+            funding_data = funding_response[1]
 
             funding_info = {}
             if funding_data.get("success") and funding_data.get("data"):
@@ -472,11 +1291,9 @@ async def get_mexc_data(api_key: str, secret_key: str):
                     symbol = item.get("symbol")
                     if symbol:
                         try:
-                            funding_info[symbol] = {
-                                'rate': Decimal(str(item.get("fundingRate", "0"))),
-                                'next_funding_time': int(item.get("nextSettleTime", 0))
-                            }
-                        except (TypeError, ValueError, decimal.InvalidOperation) as e:
+                            funding_info[symbol] = (float(item.get("fundingRate", "0")), int(item.get("nextSettleTime", 0)),
+                                                    float(item.get("collectCycle") or 0))
+                        except (TypeError, ValueError) as e:
                             print(f"[DEBUG] MEXC: Ошибка парсинга данных фандинга для {symbol}: {e}")
                             continue
             print(f"[DEBUG] MEXC: Обработано {len(funding_info)} ставок фандинга.")
@@ -490,20 +1307,10 @@ async def get_mexc_data(api_key: str, secret_key: str):
 
                     if symbol in funding_info:
                         try:
-                            rate = funding_info[symbol]['rate']
-                            next_funding = funding_info[symbol]['next_funding_time']
-                            volume_usdt = Decimal(str(ticker.get("amount24", "0")))
-
-                            results.append({
-                                'exchange': 'MEXC',
-                                'symbol': symbol.replace("_", ""),
-                                'rate': rate,
-                                'next_funding_time': next_funding,
-                                'volume_24h_usdt': volume_usdt,
-                                'max_order_value_usdt': Decimal('0'),
-                                'trade_url': f'https://futures.mexc.com/exchange/{symbol}'
-                            })
-                        except (TypeError, ValueError, decimal.InvalidOperation, KeyError) as e:
+                            rate, next_funding, interval_hours = funding_info[symbol]
+                            results.append(FundingRecord('MEXC', symbol, rate, next_funding, ticker.get("amount24", "0"),
+                                                         funding_interval_hours=interval_hours))
+                        except (TypeError, ValueError, KeyError) as e:
                             print(f"[DEBUG] MEXC: Ошибка обработки тикера {symbol}: {e}")
                             continue
                 
@@ -519,8 +1326,15 @@ async def get_mexc_data(api_key: str, secret_key: str):
     
     return results
 
+@register_exchange('Binance', timeout=20)
 async def get_binance_data():
     """Получает данные по ставкам финансирования с Binance Futures."""
+    stream = EXCHANGE_ADAPTERS['Binance']['stream']
+    if stream is not None and stream.is_live():
+        await stream.refresh_volumes_if_due()
+        if stream.volumes:
+            return stream.records()
+
     results = []
     # Эндпоинты API Binance
     funding_rate_url = "https://fapi.binance.com/fapi/v1/premiumIndex"
@@ -528,10 +1342,10 @@ async def get_binance_data():
 
     try:
         print("[DEBUG] Binance: Запрашиваем данные по ставкам и тикерам...")
-        async with aiohttp.ClientSession() as session:
+        async with shared_http_session() as session:
             # Асинхронно запрашиваем оба эндпоинта
-            async with session.get(funding_rate_url, timeout=15) as funding_response, \
-                       session.get(ticker_url, timeout=15) as ticker_response:
+            async with exchange_request(session, 'Binance', 'GET', funding_rate_url, weight=10, timeout=15) as funding_response, \
+                       exchange_request(session, 'Binance', 'GET', ticker_url, weight=40, timeout=15) as ticker_response:
                 
                 if funding_response.status != 200:
                     print(f"[API_ERROR] Binance Funding: Статус {funding_response.status}")
@@ -549,11 +1363,8 @@ async def get_binance_data():
                     symbol = item.get("symbol")
                     if symbol and item.get("lastFundingRate"):
                         try:
-                            funding_info[symbol] = {
-                                'rate': Decimal(str(item["lastFundingRate"])),
-                                'next_funding_time': int(item["nextFundingTime"])
-                            }
-                        except (TypeError, ValueError, decimal.InvalidOperation):
+                            funding_info[symbol] = (float(item["lastFundingRate"]), int(item["nextFundingTime"]))
+                        except (TypeError, ValueError):
                             continue # Пропускаем, если данные некорректны
                 
                 print(f"[DEBUG] Binance: Обработано {len(funding_info)} ставок фандинга.")
@@ -566,15 +1377,10 @@ async def get_binance_data():
                     if symbol in funding_info:
                         try:
                             # Собираем все данные в стандартный формат
-                            results.append({
-                                'exchange': 'Binance', 
-                                'symbol': symbol, 
-                                'rate': funding_info[symbol]['rate'], 
-                                'next_funding_time': funding_info[symbol]['next_funding_time'], 
-                                'volume_24h_usdt': Decimal(str(ticker.get("quoteVolume", "0"))), # quoteVolume - это объем в USDT
-                                'trade_url': f'https://www.binance.com/en/futures/{symbol}'
-                            })
-                        except (TypeError, ValueError, decimal.InvalidOperation, KeyError) as e:
+                            rate, next_funding_time = funding_info[symbol]
+                            # quoteVolume - это объем в USDT
+                            results.append(FundingRecord('Binance', symbol, rate, next_funding_time, ticker.get("quoteVolume", "0")))
+                        except (TypeError, ValueError, KeyError) as e:
                             print(f"[DEBUG] Binance: Ошибка обработки тикера {symbol}: {e}")
                             continue
                 
@@ -588,6 +1394,88 @@ async def get_binance_data():
     
     return results
 
+# ===== ПЛАНИРОВЩИК СТАВОК OKX =====
+# У OKX ставка отдается только поштучно (/public/funding-rate?instId=). Вместо топ-100 по объему
+# держим кэш ставок по всем USDT-свопам и каждый цикл обновляем только те инструменты,
+# у которых прошла выплата, нет данных или данные слишком старые.
+# Документированный лимит /public/funding-rate - 10 запросов / 2 сек, т.е. 5 в секунду (не 8, как
+# считал первый вариант планировщика); темп держит bucket 'OKX funding-rate' в RATE_LIMITS,
+# а число запросов за цикл выводится из него, чтобы цикл укладывался в таймаут сборщика OKX.
+OKX_FUNDING_FETCH_SECONDS = 20           # сколько секунд цикла отводим на ставки (таймаут сборщика - 30)
+OKX_FUNDING_REQUESTS_PER_CYCLE = int(RATE_LIMITS['OKX funding-rate']['capacity']
+                                     + RATE_LIMITS['OKX funding-rate']['refill'] * OKX_FUNDING_FETCH_SECONDS)
+OKX_FUNDING_MAX_AGE_SECONDS = 15 * 60    # страховка: ставку текущего периода перепроверяем раз в 15 минут
+
+class OkxFundingScheduler:
+    """Кэш ставок OKX до nextFundingTime; темп запросов задает bucket 'OKX funding-rate' лимитера"""
+
+    def __init__(self):
+        self.cache: Dict[str, Dict] = {}  # instId -> {'rate': float, 'next_funding_time', 'fetched_at'}
+
+    def select_due(self, usdt_swaps: List[str], ticker_info: Dict[str, float]) -> List[str]:
+        """Инструменты, которые нужно обновить в этом цикле, в порядке приоритета"""
+        now = time.time()
+        missing, settled, aged = [], [], []
+        for inst_id in usdt_swaps:
+            cached = self.cache.get(inst_id)
+            if cached is None:
+                missing.append(inst_id)
+            elif cached['next_funding_time'] <= now * 1000:
+                settled.append(inst_id)
+            elif now - cached['fetched_at'] >= OKX_FUNDING_MAX_AGE_SECONDS:
+                aged.append(inst_id)
+        # Сначала инструменты без актуальной ставки - новые и прошедшие выплату вместе, ликвидные вперед:
+        # после общей выплаты (~250 свопов) догонка идет несколько циклов, и BTC/ETH не должны ждать хвост.
+        # Потом самые старые из остальных
+        stale = sorted(missing + settled, key=lambda inst_id: ticker_info.get(inst_id, 0.0), reverse=True)
+        aged.sort(key=lambda inst_id: self.cache[inst_id]['fetched_at'])
+        return (stale + aged)[:OKX_FUNDING_REQUESTS_PER_CYCLE]
+
+    async def _fetch_one(self, session: aiohttp.ClientSession, base_url: str, inst_id: str):
+        async with exchange_semaphore('OKX'):
+            try:
+                async with exchange_request(session, 'OKX funding-rate', 'GET', f"{base_url}/api/v5/public/funding-rate?instId={inst_id}", timeout=8) as resp:
+                    if resp.status == 200:
+                        data = await resp.json()
+                        if data.get('code') == '0' and data.get('data'):
+                            item = data['data'][0]
+                            # интервал - расстояние между двумя ближайшими выплатами (у OKX бывает 1ч, 2ч, 4ч, 8ч)
+                            interval_ms = int(item['nextFundingTime']) - int(item.get('fundingTime') or 0)
+                            self.cache[inst_id] = {
+                                'rate': float(item['fundingRate']),
+                                'next_funding_time': int(item['nextFundingTime']),
+                                'interval_hours': interval_ms / 3_600_000 if 0 < interval_ms <= 24 * 3_600_000 else 0.0,
+                                'fetched_at': time.time(),
+                            }
+                            return True
+            except Exception:
+                pass
+        return False
+
+    async def refresh(self, session: aiohttp.ClientSession, base_url: str, usdt_swaps: List[str], ticker_info: Dict[str, float]) -> Dict[str, Dict]:
+        """
+        Обновляет просроченные ставки и возвращает актуальные ставки по USDT-свопам. Ставки, чья выплата
+        уже прошла, а новая еще не скачана, не отдаются: в топе они выглядели бы текущими.
+        """
+        listed = set(usdt_swaps)
+        for inst_id in [inst_id for inst_id in self.cache if inst_id not in listed]:
+            del self.cache[inst_id]  # делистинг
+
+        due = self.select_due(usdt_swaps, ticker_info)
+        if due:
+            print(f"[DEBUG] OKX: Обновляем {len(due)} ставок из {len(usdt_swaps)} (остальные из кэша)...")
+            updated = await asyncio.gather(*(self._fetch_one(session, base_url, inst_id) for inst_id in due))
+            print(f"[DEBUG] OKX: Получено {sum(updated)} ставок фандинга из {len(due)} запросов")
+        now_ms = time.time() * 1000
+        current = {inst_id: self.cache[inst_id] for inst_id in usdt_swaps
+                   if inst_id in self.cache and self.cache[inst_id]['next_funding_time'] > now_ms}
+        if len(current) < len(usdt_swaps):
+            print(f"[DEBUG] OKX: {len(usdt_swaps) - len(current)} ставок ждут обновления после выплаты и пока не показываются")
+        return current
+
+okx_funding_scheduler = OkxFundingScheduler()
+
+@register_exchange('OKX', refresh_seconds=115, timeout=30, concurrency=25)
 async def get_okx_data():
     """Получает данные по ставкам финансирования и ОИ с OKX."""
     results = []
@@ -595,11 +1483,11 @@ async def get_okx_data():
     
     try:
         print("[DEBUG] OKX: Запрашиваем данные...")
-        async with aiohttp.ClientSession() as session:
+        async with shared_http_session() as session:
             
             # 1. Получаем список всех perpetual-свопов
             instruments_url = f"{base_url}/api/v5/public/instruments?instType=SWAP"
-            async with session.get(instruments_url, timeout=15) as response:
+            async with exchange_request(session, 'OKX', 'GET', instruments_url, timeout=15) as response:
                 if response.status != 200:
                     print(f"[API_ERROR] OKX Instruments: Статус {response.status}")
                     return []
@@ -622,14 +1510,14 @@ async def get_okx_data():
             
             # 2.1: Получаем все тикеры
             try:
-                async with session.get(f"{base_url}/api/v5/public/tickers?instType=SWAP", timeout=20) as resp:
+                async with exchange_request(session, 'OKX', 'GET', f"{base_url}/api/v5/public/tickers?instType=SWAP", timeout=20) as resp:
                     if resp.status == 200:
                         data = await resp.json()
                         if data.get('code') == '0':
                             for item in data.get('data', []):
                                 inst_id = item.get('instId')
                                 if inst_id in usdt_swaps:
-                                    ticker_info[inst_id] = Decimal(str(item.get('volCcy24h', '0')))
+                                    ticker_info[inst_id] = float(item.get('volCcy24h', '0'))
                             print(f"[DEBUG] OKX: Получено {len(ticker_info)} тикеров")
                         else:
                             print(f"[API_ERROR] OKX Тикеры: {data.get('msg')}")
@@ -640,14 +1528,14 @@ async def get_okx_data():
 
             # 2.2: Получаем открытый интерес
             try:
-                async with session.get(f"{base_url}/api/v5/public/open-interest?instType=SWAP", timeout=20) as resp:
+                async with exchange_request(session, 'OKX', 'GET', f"{base_url}/api/v5/public/open-interest?instType=SWAP", timeout=20) as resp:
                     if resp.status == 200:
                         data = await resp.json()
                         if data.get('code') == '0':
                             for item in data.get('data', []):
                                 inst_id = item.get('instId')
                                 if inst_id in usdt_swaps:
-                                    oi_info[inst_id] = Decimal(str(item.get('oiCcy', '0')))
+                                    oi_info[inst_id] = float(item.get('oiCcy', '0'))
                             print(f"[DEBUG] OKX: Получено {len(oi_info)} данных по ОИ")
                         else:
                             print(f"[API_ERROR] OKX ОИ: {data.get('msg')}")
@@ -656,71 +1544,18 @@ async def get_okx_data():
             except Exception as e:
                 print(f"[API_ERROR] OKX ОИ Exception: {e}")
 
-            # 3. БЫСТРЫЙ МЕТОД: Берем только топовые инструменты по объему
-            # Сортируем по объему и берем только топ-100
-            top_instruments = sorted(
-                [(inst_id, ticker_info.get(inst_id, Decimal('0'))) for inst_id in usdt_swaps], 
-                key=lambda x: x[1], 
-                reverse=True
-            )[:100]  # Только топ-100 по объему
-            
-            selected_instruments = [inst_id for inst_id, _ in top_instruments]
-            print(f"[DEBUG] OKX: Выбрано {len(selected_instruments)} топовых инструментов по объему")
+            # 3. Обновляем ставки через планировщик: только те инструменты, чья ставка могла измениться
+            funding_info = await okx_funding_scheduler.refresh(session, base_url, usdt_swaps, ticker_info)
 
-            # 4. ПАРАЛЛЕЛЬНЫЕ ЗАПРОСЫ для фандинга
-            async def get_funding_for_instrument(inst_id):
-                try:
-                    async with session.get(f"{base_url}/api/v5/public/funding-rate?instId={inst_id}", timeout=8) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            if data.get('code') == '0' and data.get('data'):
-                                item = data['data'][0]
-                                return inst_id, {
-                                    'rate': Decimal(str(item['fundingRate'])),
-                                    'next_funding_time': int(item['nextFundingTime'])
-                                }
-                except Exception:
-                    pass
-                return inst_id, None
-
-            # Запускаем параллельно по 20 запросов за раз
-            funding_info = {}
-            semaphore = asyncio.Semaphore(25)  # Ограничиваем до 20 параллельных запросов
-            
-            async def bounded_request(inst_id):
-                async with semaphore:
-                    return await get_funding_for_instrument(inst_id)
-            
-            print(f"[DEBUG] OKX: Запускаем параллельные запросы для {len(selected_instruments)} инструментов...")
-            
-            # Выполняем все запросы параллельно
-            tasks = [bounded_request(inst_id) for inst_id in selected_instruments]
-            results_funding = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Собираем результаты
-            successful = 0
-            for result in results_funding:
-                if isinstance(result, tuple) and result[1] is not None:
-                    inst_id, funding_data = result
-                    funding_info[inst_id] = funding_data
-                    successful += 1
-            
-            print(f"[DEBUG] OKX: Получено {successful} ставок фандинга из {len(selected_instruments)} запросов")
-
-            # 5. Формируем финальный результат
-            for inst_id in funding_info.keys():
-                symbol = inst_id.replace("-SWAP", "").replace("-", "")
+            # 4. Формируем финальный результат
+            for inst_id, funding in funding_info.items():
                 trade_symbol = inst_id.replace("-SWAP", "")
                 
-                results.append({
-                    'exchange': 'OKX', 
-                    'symbol': symbol, 
-                    'rate': funding_info[inst_id]['rate'],
-                    'next_funding_time': funding_info[inst_id]['next_funding_time'],
-                    'volume_24h_usdt': ticker_info.get(inst_id, Decimal('0')),
-                    'open_interest_usdt': oi_info.get(inst_id, Decimal('0')),
-                    'trade_url': f'https://www.okx.com/trade-swap/{trade_symbol}'
-                })
+                results.append(FundingRecord(
+                    'OKX', inst_id, funding['rate'], funding['next_funding_time'],
+                    ticker_info.get(inst_id, 0.0), market=trade_symbol, open_interest_usdt=oi_info.get(inst_id, 0.0),
+                    funding_interval_hours=funding.get('interval_hours', 0.0),
+                ))
 
             print(f"[DEBUG] OKX: Успешно сформировано {len(results)} инструментов.")
 
@@ -732,6 +1567,7 @@ async def get_okx_data():
 
 # Вставьте этот код после функции get_okx_data
 
+@register_exchange('KuCoin', timeout=20)
 async def get_kucoin_data():
     """Получает данные по ставкам финансирования с KuCoin Futures."""
     results = []
@@ -739,8 +1575,8 @@ async def get_kucoin_data():
     
     try:
         print("[DEBUG] KuCoin: Запрашиваем данные по активным контрактам...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{base_url}/api/v1/contracts/active", timeout=15) as response:
+        async with shared_http_session() as session:
+            async with exchange_request(session, 'KuCoin', 'GET', f"{base_url}/api/v1/contracts/active", timeout=15) as response:
                 if response.status != 200:
                     print(f"[API_ERROR] KuCoin: Статус {response.status}")
                     return []
@@ -760,27 +1596,16 @@ async def get_kucoin_data():
                         item.get('status') == 'Open'):
                         try:
                             # Преобразуем funding rate в правильный формат
-                            funding_rate = Decimal(str(item.get('fundingFeeRate', '0')))
-                            next_funding = int(item.get('nextFundingRateTime', 0))
-                            
                             # У KuCoin объем может быть в turnoverOf24h (USDT) или volumeOf24h (базовая валюта)
-                            volume_usdt = Decimal(str(item.get('turnoverOf24h', '0')))
+                            volume_usdt = float(item.get('turnoverOf24h') or 0)
                             if volume_usdt == 0:
                                 # Если turnoverOf24h = 0, пробуем volumeOf24h * markPrice
-                                volume_base = Decimal(str(item.get('volumeOf24h', '0')))
-                                mark_price = Decimal(str(item.get('markPrice', '0')))
-                                volume_usdt = volume_base * mark_price
+                                volume_usdt = float(item.get('volumeOf24h') or 0) * float(item.get('markPrice') or 0)
                             
-                            results.append({
-                                'exchange': 'KuCoin', 
-                                'symbol': item.get('symbol'), 
-                                'rate': funding_rate, 
-                                'next_funding_time': next_funding, 
-                                'volume_24h_usdt': volume_usdt,
-                                'open_interest_usdt': Decimal('0'),  # KuCoin не предоставляет ОИ в USDT напрямую
-                                'trade_url': f'https://www.kucoin.com/futures/trade/{item.get("symbol")}'
-                            })
-                        except (TypeError, ValueError, decimal.InvalidOperation, KeyError) as e:
+                            # KuCoin не предоставляет ОИ в USDT напрямую
+                            results.append(FundingRecord('KuCoin', item['symbol'], item.get('fundingFeeRate', '0'), item.get('nextFundingRateTime', 0), volume_usdt,
+                                                         funding_interval_hours=float(item.get('fundingRateGranularity') or 0) / 3_600_000))
+                        except (TypeError, ValueError, KeyError) as e:
                             print(f"[DEBUG] KuCoin: Ошибка обработки контракта {item.get('symbol', 'unknown')}: {e}")
                             continue
                 
@@ -794,6 +1619,7 @@ async def get_kucoin_data():
     
     return results
 
+@register_exchange('Bitget', timeout=20)
 async def get_bitget_data():
     """Получает данные по ставкам финансирования с Bitget."""
     results = []
@@ -802,8 +1628,8 @@ async def get_bitget_data():
 
     try:
         print("[DEBUG] Bitget: Запрашиваем данные по тикерам...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(tickers_url, timeout=15) as response:
+        async with shared_http_session() as session:
+            async with exchange_request(session, 'Bitget', 'GET', tickers_url, timeout=15) as response:
                 if response.status != 200:
                     print(f"[API_ERROR] Bitget: Статус {response.status}")
                     return []
@@ -818,21 +1644,10 @@ async def get_bitget_data():
                 
                 for item in tickers_data:
                     try:
-                        # Bitget отдает время в секундах, а нам нужны миллисекунды
-                        next_funding_time_ms = int(item.get('nextFundingTime', 0))
-
-                        # Собираем все данные в стандартный формат
-                        results.append({
-                            'exchange': 'Bitget', 
-                            'symbol': item.get('symbol'), # Символ уже в формате BTCUSDT
-                            'rate': Decimal(str(item.get('fundingRate', '0'))), 
-                            'next_funding_time': next_funding_time_ms, 
-                            'volume_24h_usdt': Decimal(str(item.get('volume24h', '0'))), # Объем в USDT
-                            # У Bitget нет простого способа получить ОИ в USDT, оставляем 0
-                            'open_interest_usdt': Decimal('0'),
-                            'trade_url': f'https://www.bitget.com/futures/usdt/{item.get("symbol")}'
-                        })
-                    except (TypeError, ValueError, decimal.InvalidOperation, KeyError) as e:
+                        # Собираем все данные в стандартный формат: символ уже в формате BTCUSDT, объем в USDT.
+                        # У Bitget нет простого способа получить ОИ в USDT, оставляем 0
+                        results.append(FundingRecord('Bitget', item['symbol'], item.get('fundingRate', '0'), item.get('nextFundingTime', 0), item.get('volume24h', '0')))
+                    except (TypeError, ValueError, KeyError) as e:
                         print(f"[DEBUG] Bitget: Ошибка обработки инструмента {item.get('symbol')}: {e}")
                         continue
                 
@@ -846,6 +1661,7 @@ async def get_bitget_data():
     
     return results
 
+@register_exchange('Gate.io', timeout=20)
 async def get_gateio_data():
     """Получает данные по ставкам финансирования с Gate.io."""
     results = []
@@ -854,8 +1670,8 @@ async def get_gateio_data():
 
     try:
         print("[DEBUG] Gate.io: Запрашиваем данные по тикерам...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(tickers_url, timeout=15) as response:
+        async with shared_http_session() as session:
+            async with exchange_request(session, 'Gate.io', 'GET', tickers_url, timeout=15) as response:
                 if response.status != 200:
                     print(f"[API_ERROR] Gate.io: Статус {response.status}")
                     return []
@@ -868,18 +1684,10 @@ async def get_gateio_data():
                         # Gate.io отдает время следующей выплаты в секундах, переводим в миллисекунды
                         next_funding_time_ms = int(item.get('funding_next_apply', 0)) * 1000
 
-                        # Собираем все данные в стандартный формат
-                        results.append({
-                            'exchange': 'Gate.io', 
-                            'symbol': item.get('contract').replace('_', ''), # Символ в формате BTC_USDT
-                            'rate': Decimal(str(item.get('funding_rate', '0'))), 
-                            'next_funding_time': next_funding_time_ms, 
-                            'volume_24h_usdt': Decimal(str(item.get('volume_24h_usdt', '0'))),
-                            # ОИ у Gate.io доступен, но в контрактах, а не в USDT. Для простоты пока ставим 0.
-                            'open_interest_usdt': Decimal('0'),
-                            'trade_url': f'https://www.gate.io/futures_trade/USDT/{item.get("contract")}'
-                        })
-                    except (TypeError, ValueError, decimal.InvalidOperation, KeyError) as e:
+                        # Собираем все данные в стандартный формат (символ в формате BTC_USDT).
+                        # ОИ у Gate.io доступен, но в контрактах, а не в USDT. Для простоты пока ставим 0.
+                        results.append(FundingRecord('Gate.io', item['contract'], item.get('funding_rate', '0'), next_funding_time_ms, item.get('volume_24h_usdt', '0')))
+                    except (TypeError, ValueError, KeyError) as e:
                         print(f"[DEBUG] Gate.io: Ошибка обработки инструмента {item.get('contract')}: {e}")
                         continue
                 
@@ -905,12 +1713,12 @@ async def get_htx_data():
             'Accept': 'application/json'
         }
         
-        async with aiohttp.ClientSession(headers=headers) as session:
+        async with shared_http_session() as session:
             
             # Получаем список всех контрактов
             contracts_url = "https://api.hbdm.com/linear-swap-api/v1/swap_contract_info"
             
-            async with session.get(contracts_url, timeout=15) as response:
+            async with exchange_request(session, 'HTX', 'GET', contracts_url, headers=headers, timeout=15) as response:
                 if response.status != 200:
                     print(f"[API_ERROR] HTX Contracts: Статус {response.status}")
                     return []
@@ -937,7 +1745,7 @@ async def get_htx_data():
                 try:
                     funding_url = f"https://api.hbdm.com/linear-swap-api/v1/swap_funding_rate?contract_code={contract_code}"
                     
-                    async with session.get(funding_url, timeout=10) as fr_response:
+                    async with exchange_request(session, 'HTX', 'GET', funding_url, headers=headers, timeout=10) as fr_response:
                         if fr_response.status == 200:
                             fr_text = await fr_response.text()
                             fr_data = json.loads(fr_text)
@@ -958,17 +1766,7 @@ async def get_htx_data():
                                 else:
                                     next_funding_time = int(next_funding_time)
                                 
-                                symbol = contract_code.replace('-', '')  # BTC-USDT -> BTCUSDT
-                                
-                                results.append({
-                                    'exchange': 'HTX',
-                                    'symbol': symbol,
-                                    'rate': Decimal(str(item.get('funding_rate', '0'))),
-                                    'next_funding_time': next_funding_time,
-                                    'volume_24h_usdt': Decimal('0'),
-                                    'open_interest_usdt': Decimal('0'),
-                                    'trade_url': f'https://www.htx.com/en-us/futures/usdt/{contract_code.lower()}'
-                                })
+                                results.append(FundingRecord('HTX', contract_code, item.get('funding_rate', '0'), next_funding_time, market=contract_code.lower()))
                                 successful_count += 1
                         
                         
@@ -984,6 +1782,7 @@ async def get_htx_data():
     
     return results
 
+@register_exchange('Hyperliquid', timeout=20)
 async def get_hyperliquid_data():
     """Получает данные по ставкам финансирования с Hyperliquid."""
     results = []
@@ -994,8 +1793,8 @@ async def get_hyperliquid_data():
 
     try:
         print("[DEBUG] Hyperliquid: Запрашиваем данные...")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(info_url, json=payload, headers=headers, timeout=15) as response:
+        async with shared_http_session() as session:
+            async with exchange_request(session, 'Hyperliquid', 'POST', info_url, weight=20, json=payload, headers=headers, timeout=15) as response:
                 if response.status != 200:
                     print(f"[API_ERROR] Hyperliquid: Статус {response.status}")
                     return []
@@ -1063,15 +1862,12 @@ async def get_hyperliquid_data():
                         
                         # Преобразуем funding rate (может быть в разных форматах)
                         try:
-                            funding_rate_decimal = Decimal(str(funding_rate_raw))
+                            funding_rate_8h = float(funding_rate_raw)
                             # Если значение очень большое, это может быть годовой процент
-                            if abs(funding_rate_decimal) > 1:
+                            if abs(funding_rate_8h) > 1:
                                 # Преобразуем в 8-часовую ставку
-                                funding_rate_8h = funding_rate_decimal / (Decimal('365.25') * 3)
-                            else:
-                                # Уже в правильном формате
-                                funding_rate_8h = funding_rate_decimal
-                        except (ValueError, decimal.InvalidOperation):
+                                funding_rate_8h /= 365.25 * 3
+                        except (TypeError, ValueError):
                             print(f"[DEBUG] Hyperliquid: Ошибка преобразования funding rate: {funding_rate_raw}")
                             continue
                         
@@ -1081,36 +1877,29 @@ async def get_hyperliquid_data():
                         next_funding_time_ms = int(next_funding_time.timestamp() * 1000)
 
                         # Получаем объем торгов из метаданных (universe)
-                        volume_24h = Decimal('0')
+                        volume_24h = 0.0
                         for key in ['dayNtlVlm', 'volume24h', 'volume_24h', 'turnover24h']:
                             if key in meta:
                                 try:
-                                    volume_24h = Decimal(str(meta[key]))
+                                    volume_24h = float(meta[key])
                                     break
-                                except (ValueError, decimal.InvalidOperation):
+                                except (TypeError, ValueError):
                                     continue
                         
                         # Получаем открытый интерес из контекста (asset_contexts)
-                        open_interest = Decimal('0')
+                        open_interest = 0.0
                         for key in ['openInterest', 'open_interest', 'oi']:
                             if key in ctx:
                                 try:
-                                    open_interest = Decimal(str(ctx[key]))
+                                    open_interest = float(ctx[key])
                                     break
-                                except (ValueError, decimal.InvalidOperation):
+                                except (TypeError, ValueError):
                                     continue
 
                         # Собираем все данные в стандартный формат
-                        results.append({
-                            'exchange': 'Hyperliquid', 
-                            'symbol': f"{symbol}USDT", # Приводим к стандартному виду
-                            'rate': funding_rate_8h, 
-                            'next_funding_time': next_funding_time_ms, 
-                            'volume_24h_usdt': volume_24h,
-                            'open_interest_usdt': open_interest,
-                            'trade_url': f'https://app.hyperliquid.xyz/trade/{symbol}'
-                        })
-                    except (TypeError, ValueError, decimal.InvalidOperation, KeyError) as e:
+                        results.append(FundingRecord('Hyperliquid', symbol, funding_rate_8h, next_funding_time_ms, volume_24h,
+                                                     open_interest_usdt=open_interest, funding_interval_hours=1))
+                    except (TypeError, ValueError, KeyError) as e:
                         print(f"[DEBUG] Hyperliquid: Ошибка обработки инструмента [{i}]: {e}")
                         continue
                 
@@ -1123,81 +1912,856 @@ async def get_hyperliquid_data():
         print(f"[API_ERROR] Hyperliquid: Traceback: {traceback.format_exc()}")
     
     return results
-async def fetch_all_data(context: ContextTypes.DEFAULT_TYPE | Application, force_update=False):
-    now = datetime.now().timestamp()
-    if not force_update and api_data_cache["last_update"] and (now - api_data_cache["last_update"] < CACHE_LIFETIME_SECONDS):
-        return api_data_cache["data"]
+# ===== ПОТОКОВЫЕ ДАННЫЕ (WEBSOCKET) =====
+# Вместо опроса полного списка тикеров каждую минуту держим открытый WebSocket,
+# применяем дельты к книге ставок в памяти и отдаем ее в том же формате, что и REST.
+BYBIT_STREAMING = os.getenv("BYBIT_STREAMING", "0") == "1"
+BYBIT_WS_URL = os.getenv("BYBIT_WS_URL", "wss://stream.bybit.com/v5/public/linear")
+BINANCE_STREAMING = os.getenv("BINANCE_STREAMING", "0") == "1"
+BINANCE_WS_URL = os.getenv("BINANCE_WS_URL", "wss://fstream.binance.com/ws/!markPrice@arr@1s")
+BINANCE_VOLUME_REFRESH_SECONDS = 300  # 24ч объем меняется медленно, обновляем его по REST реже
+
+class ExchangeStream(abc.ABC):
+    """
+    Базовый WebSocket-поток биржи: переподключение с backoff, пинги и учет свежести.
+    Наследники реализуют подписку, применение сообщений и сборку записей.
+    """
+    name = 'Exchange'
+    ping_interval_seconds = 20
+    stale_after_seconds = 30
+
+    def __init__(self, url: str):
+        self.url = url
+        self.book: Dict[str, Dict] = {}
+        self.updates = 0  # растет при каждом реальном изменении книги (по нему снимок понимает, что подменять)
+        self.connected = False
+        self.last_message_time = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def on_connect(self, ws: aiohttp.ClientWebSocketResponse):
+        """Вызывается после подключения (подписки)"""
+
+    def ping_message(self) -> Optional[Dict]:
+        """Сообщение-пинг уровня приложения; None - достаточно пингов протокола"""
+        return None
+
+    @abc.abstractmethod
+    def apply_message(self, message) -> None:
+        """Применяет разобранное JSON-сообщение к книге"""
+
+    @abc.abstractmethod
+    def records(self) -> List[FundingRecord]:
+        """Текущая книга в формате REST-сборщика"""
+
+    def is_live(self) -> bool:
+        """Поток подключен и получал данные недавно"""
+        return self.connected and bool(self.book) and time.time() - self.last_message_time < self.stale_after_seconds
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        backoff = 1
+        while True:
+            try:
+                session = get_http_session()
+                async with session.ws_connect(self.url, heartbeat=self.ping_interval_seconds if self.ping_message() is None else None) as ws:
+                    await self.on_connect(ws)
+                    self.connected, backoff = True, 1
+                    print(f"[STREAM] {self.name}: Подключено к {self.url}")
+                    last_ping = time.time()
+                    while True:
+                        ping = self.ping_message()
+                        if ping is not None and time.time() - last_ping >= self.ping_interval_seconds:
+                            await ws.send_json(ping)
+                            last_ping = time.time()
+                        try:
+                            msg = await ws.receive(timeout=self.ping_interval_seconds)
+                        except asyncio.TimeoutError:
+                            continue
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.last_message_time = time.time()
+                            try:
+                                self.apply_message(json.loads(msg.data))
+                            except (ValueError, TypeError, KeyError) as e:
+                                print(f"[STREAM] {self.name}: Ошибка обработки сообщения: {e}")
+                        elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.ERROR):
+                            break
+                print(f"[STREAM] {self.name}: Соединение закрыто сервером")
+            except asyncio.CancelledError:
+                self.connected = False
+                raise
+            except Exception as e:
+                print(f"[STREAM] {self.name}: Ошибка соединения {type(e).__name__}: {e}")
+            self.connected = False
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
 
-    bot_data = context.bot_data if isinstance(context, Application) else context.bot_data
-    
-    print("[DEBUG] Обновляем данные с API...")
-    mexc_api_key = bot_data.get('mexc_api_key')
-    mexc_secret_key = bot_data.get('mexc_secret_key')
-    bybit_api_key = bot_data.get('bybit_api_key')
-    bybit_secret_key = bot_data.get('bybit_secret_key')
-    
-    tasks = [
-        get_bybit_data(api_key=bybit_api_key, secret_key=bybit_secret_key), 
-        get_mexc_data(api_key=mexc_api_key, secret_key=mexc_secret_key),
-        get_binance_data(),
-        get_okx_data(),
-        get_kucoin_data(),
-        get_bitget_data(),
-        get_gateio_data(),
-        get_hyperliquid_data()
-       # get_htx_data()
-    ]
-    results_from_tasks = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    all_data = []
-    for i, res in enumerate(results_from_tasks):
-        exchange_name = ['Bybit', 'MEXC', 'Binance', 'OKX', 'KuCoin', 'Bitget', 'Gate.io', 'Hyperliquid'][i]
-        if isinstance(res, list): 
-            all_data.extend(res)
-            print(f"[DEBUG] {exchange_name}: Добавлено {len(res)} инструментов")
+class BybitTickerStream(ExchangeStream):
+    """
+    Публичный поток tickers.* Bybit (linear). Первое сообщение по символу - snapshot,
+    дальше приходят дельты только с изменившимися полями.
+    """
+    name = 'Bybit'
+    SUBSCRIBE_BATCH = 10
+    BOOK_FIELDS = ('symbol', 'fundingRate', 'nextFundingTime', 'turnover24h', 'fundingIntervalHour')
+
+    def __init__(self, url: str = BYBIT_WS_URL, symbols: Optional[List[str]] = None):
+        super().__init__(url)
+        self.symbols = symbols
+        self._records: Dict[str, Optional[FundingRecord]] = {}
+        self._dirty: set = set()
+
+    def ping_message(self) -> Optional[Dict]:
+        return {"op": "ping"}
+
+    async def load_symbols(self) -> List[str]:
+        """Список торгуемых linear-перпетуалов для подписки"""
+        symbols, cursor = [], ''
+        session = get_http_session()
+        while True:
+            params = {'category': 'linear', 'limit': 1000}
+            if cursor:
+                params['cursor'] = cursor
+            async with exchange_request(session, 'Bybit', 'GET', "https://api.bybit.com/v5/market/instruments-info", params=params, timeout=15) as response:
+                data = await response.json()
+            result = data.get('result', {}) if data.get('retCode') == 0 else {}
+            symbols.extend(
+                item['symbol'] for item in result.get('list', [])
+                if item.get('status') == 'Trading' and item.get('contractType') == 'LinearPerpetual'
+            )
+            cursor = result.get('nextPageCursor')
+            if not cursor:
+                return symbols
+
+    async def on_connect(self, ws: aiohttp.ClientWebSocketResponse):
+        symbols = self.symbols or await self.load_symbols()
+        for i in range(0, len(symbols), self.SUBSCRIBE_BATCH):
+            args = [f"tickers.{symbol}" for symbol in symbols[i:i + self.SUBSCRIBE_BATCH]]
+            await ws.send_json({"op": "subscribe", "args": args})
+        print(f"[STREAM] Bybit: Подписка на {len(symbols)} тикеров")
+
+    def apply_message(self, message) -> None:
+        topic = message.get('topic', '')
+        if not topic.startswith('tickers.'):
+            return  # ответы на subscribe/ping
+        data = message.get('data') or {}
+        symbol = data.get('symbol') or topic.split('.', 1)[1]
+        fields = {key: data[key] for key in self.BOOK_FIELDS if data.get(key) not in (None, '')}
+        current = self.book.get(symbol)
+        if message.get('type') == 'snapshot' or current is None:
+            if current == fields:
+                return
+            self.book[symbol] = fields
         else:
-            print(f"[DEBUG] {exchange_name}: Исключение - {res}")
-            
+            if all(current.get(key) == value for key, value in fields.items()):
+                return  # дельта только по полям, которых нет в книге (цена, стакан)
+            current.update(fields)
+        self._dirty.add(symbol)
+        self.updates += 1
+
+    def records(self) -> List[FundingRecord]:
+        # Пересобираем только символы, по которым пришли изменения
+        for symbol in self._dirty:
+            self._records[symbol] = parse_bybit_ticker(self.book[symbol])
+        self._dirty.clear()
+        return [record for record in self._records.values() if record]
+
+class BinanceMarkPriceStream(ExchangeStream):
+    """
+    Поток !markPrice@arr Binance Futures: раз в секунду приходит массив обновлений
+    со ставкой (r) и временем следующей выплаты (T) по всем символам.
+    Объем 24ч подтягивается отдельно по REST раз в BINANCE_VOLUME_REFRESH_SECONDS.
+    """
+    name = 'Binance'
+
+    def __init__(self, url: str = BINANCE_WS_URL, ticker_url: str = "https://fapi.binance.com/fapi/v1/ticker/24hr"):
+        super().__init__(url)
+        self.ticker_url = ticker_url
+        self.volumes: Dict[str, float] = {}
+        self.volumes_updated = 0.0
+        self._records: Dict[str, Optional[FundingRecord]] = {}
+        self._dirty: set = set()
+
+    def apply_message(self, message) -> None:
+        updates = message if isinstance(message, list) else [message]
+        for update in updates:
+            if update.get('e') != 'markPriceUpdate' or not update.get('r'):
+                continue
+            symbol = update['s']
+            entry = (update['r'], update['T'])
+            if self.book.get(symbol) != entry:
+                self.book[symbol] = entry
+                self._dirty.add(symbol)
+                self.updates += 1
+
+    async def refresh_volumes_if_due(self):
+        if time.time() - self.volumes_updated < BINANCE_VOLUME_REFRESH_SECONDS:
+            return
+        try:
+            async with exchange_request(get_http_session(), 'Binance', 'GET', self.ticker_url, weight=40, timeout=15) as response:
+                if response.status != 200:
+                    print(f"[API_ERROR] Binance Ticker: Статус {response.status}")
+                    return
+                ticker_data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"[API_ERROR] Binance Ticker: {type(e).__name__}: {e}")
+            return
+        volumes = {}
+        for ticker in ticker_data:
+            try:
+                volumes[ticker['symbol']] = float(ticker.get("quoteVolume", "0"))
+            except (TypeError, KeyError, ValueError):
+                continue
+        self.volumes, self.volumes_updated = volumes, time.time()
+        self._dirty.update(self.book)  # объемы поменялись у всех записей
+        self.updates += 1
+        print(f"[DEBUG] Binance: Обновлено {len(volumes)} объемов 24ч.")
+
+    def records(self) -> List[FundingRecord]:
+        for symbol in self._dirty:
+            rate, next_funding_time = self.book[symbol]
+            if symbol not in self.volumes:
+                self._records[symbol] = None  # как и в REST: только символы с тикером 24ч
+                continue
+            try:
+                self._records[symbol] = FundingRecord('Binance', symbol, rate, next_funding_time, self.volumes[symbol])
+            except (TypeError, ValueError) as e:
+                print(f"[DEBUG] Binance: Ошибка обработки тикера {symbol}: {e}")
+                self._records[symbol] = None
+        self._dirty.clear()
+        return [record for record in self._records.values() if record]
+
+def start_exchange_streams():
+    """Создает и запускает включенные WebSocket-потоки"""
+    if BYBIT_STREAMING:
+        EXCHANGE_ADAPTERS['Bybit']['stream'] = BybitTickerStream()
+    if BINANCE_STREAMING:
+        EXCHANGE_ADAPTERS['Binance']['stream'] = BinanceMarkPriceStream()
+    for adapter in EXCHANGE_ADAPTERS.values():
+        if adapter['stream'] is not None:
+            adapter['stream'].start()
+
+async def stop_exchange_streams():
+    for adapter in EXCHANGE_ADAPTERS.values():
+        if adapter['stream'] is not None:
+            await adapter['stream'].stop()
+
+ALL_AVAILABLE_EXCHANGES = list(EXCHANGE_ADAPTERS)
+
+# ===== КЭШ СНИМКА ДАННЫХ =====
+class SnapshotCache:
+    """
+    Последний снимок данных всех бирж.
+    Одновременные обновления склеиваются в один запрос (single-flight), а пока обновление
+    идет в фоне, читатели получают предыдущий снимок (stale-while-revalidate).
+    """
+
+    def __init__(self):
+        self.data: List[FundingRecord] = []
+        self.exchanges: List[str] = []
+        self.last_update: Optional[float] = None
+        self.version = 0
+        self._sources: List[Tuple[str, List[FundingRecord]]] = []  # (биржа, ее записи), из которых собран data
+        self._columns: Optional[FundingColumns] = None
+        self._columns_version = -1
+        self._task: Optional[asyncio.Task] = None
+        self._task_exchanges: set = set()
+
+    @property
+    def columns(self) -> FundingColumns:
+        """
+        Колоночный вид текущего снимка (пересобирается только при смене версии). Строится из тех же
+        списков бирж, что и data, а не из exchange_data_cache: одна версия - один набор данных.
+        """
+        if self._columns_version != self.version:
+            self._columns = FundingColumns.concat([exchange_columns(name, records) for name, records in self._sources])
+            self._columns_version = self.version
+        return self._columns
+
+    def age(self) -> float:
+        return time.time() - self.last_update if self.last_update else float('inf')
+
+    def covers(self, exchanges: List[str]) -> bool:
+        return set(exchanges) <= set(self.exchanges)
+
+    def publish(self, exchanges: List[str], refreshed: bool = True) -> List[FundingRecord]:
+        """
+        Собирает снимок из последних удачных данных бирж и кладет его, им сразу пользуются все обработчики.
+        refreshed=False - поменялись только данные потоков: возраст снимка (и срок REST-обновления) прежний.
+        """
+        self._sources = [(name, exchange_data(name)) for name in exchanges]
+        self.data = [item for _, records in self._sources for item in records]
+        self.exchanges = list(exchanges)
+        if refreshed:
+            self.last_update = time.time()
+        self.version += 1
+        return self.data
+
+    def is_refreshing(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _start(self, refresh, exchanges: List[str]) -> asyncio.Task:
+        self._task = asyncio.create_task(refresh())
+        self._task_exchanges = set(exchanges)
+        self._task.add_done_callback(self._log_failure)
+        return self._task
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[SNAPSHOT] ❌ Ошибка обновления снимка: {task.exception()!r}")
+
+    async def refresh(self, refresh, exchanges: List[str]) -> List[FundingRecord]:
+        """Ждет обновления: присоединяется к уже идущему, если оно покрывает нужные биржи"""
+        while self.is_refreshing():
+            task = self._task
+            if set(exchanges) <= self._task_exchanges:
+                return await asyncio.shield(task)
+            try:
+                await asyncio.shield(task)
+            except Exception:
+                pass
+            if self._task is task:
+                break
+        return await asyncio.shield(self._start(refresh, exchanges))
+
+    def refresh_in_background(self, refresh, exchanges: List[str]):
+        if not self.is_refreshing():
+            self._start(refresh, exchanges)
+
+snapshot_cache = SnapshotCache()
+
+FETCH_LATENCY_BUDGET_SECONDS = 8  # сколько ждем медленные биржи в интерактивных запросах
+
+def exchange_data(name: str) -> List[FundingRecord]:
+    """Последние удачные данные биржи (если они не старше SNAPSHOT_MAX_STALE_SECONDS)"""
+    entry = exchange_data_cache.get(name)
+    if not entry or time.time() - entry.get('last_good', 0) >= SNAPSHOT_MAX_STALE_SECONDS:
+        return []
+    return entry['data']
+
+def exchange_columns(name: str, data: Optional[List[FundingRecord]] = None) -> FundingColumns:
+    """
+    Колонки последних удачных данных биржи (или переданного ответа биржи, например из снимка);
+    строятся один раз на каждый ответ биржи.
+    """
+    if data is None:
+        data = exchange_data(name)
+    if not data:
+        return FundingColumns.from_records([])
+    entry = exchange_data_cache.get(name)
+    if entry is not None and entry.get('columns') is not None and entry['columns'].records is data:
+        return entry['columns']
+    columns = FundingColumns.from_records(data)
+    if entry is not None and entry['data'] is data:
+        entry['columns'] = columns  # старые ответы (снимок отстал от кэша) не вытесняют колонки текущего
+    return columns
+
+def assemble_columns(exchanges: List[str]) -> FundingColumns:
+    return FundingColumns.concat([exchange_columns(name) for name in exchanges])
+
+def is_exchange_due(name: str, now: float) -> bool:
+    """Пора ли обновлять биржу (биржи с живым WebSocket-потоком берутся из потока всегда)"""
+    adapter = EXCHANGE_ADAPTERS[name]
+    if adapter['stream'] is not None and adapter['stream'].is_live():
+        return True
+    return now - exchange_data_cache.get(name, {}).get('last_update', 0) >= adapter['refresh_seconds']
+
+async def _fetch_exchange(name: str, bot_data: Dict) -> List[FundingRecord]:
+    started = time.time()
+    try:
+        res = await run_exchange_adapter(name, bot_data)
+    except Exception as e:
+        print(f"[DEBUG] {name}: Исключение - {e!r}")
+        res = []
+    entry = exchange_data_cache.setdefault(name, {'last_update': 0, 'last_good': 0, 'data': []})
+    entry['last_update'] = started
+    if res:
+        entry['last_good'], entry['data'] = started, res
+        print(f"[DEBUG] {name}: Добавлено {len(res)} инструментов")
+    elif entry['data']:
+        print(f"[DEBUG] {name}: Пустой ответ, оставляем последние удачные данные ({len(entry['data'])} инструментов)")
+    return exchange_data(name)
+
+def start_exchange_fetch(name: str, bot_data: Dict) -> asyncio.Task:
+    """Запускает запрос к бирже или возвращает уже идущий (single-flight на уровне биржи)"""
+    task = exchange_fetch_tasks.get(name)
+    if task is None or task.done():
+        exchange_fetch_started.pop(task, None)
+        task = asyncio.create_task(_fetch_exchange(name, bot_data))
+        exchange_fetch_started[task] = time.monotonic()
+        exchange_fetch_tasks[name] = task
+    return task
+
+async def refresh_exchanges(bot_data: Dict, wanted: List[str]) -> List[FundingRecord]:
+    """Обновляет биржи из списка, у которых прошел их refresh_seconds, и публикует новый снимок"""
+    now = time.time()
+    due = [name for name in wanted if is_exchange_due(name, now)]
+    print(f"[DEBUG] Обновляем данные с API: {', '.join(due) if due else 'все биржи свежие'}")
+    if due:
+        # asyncio.wait, а не gather: отмена ожидающего не должна отменять общие запросы
+        await asyncio.wait([start_exchange_fetch(name, bot_data) for name in due])
+    
+    all_data = snapshot_cache.publish(wanted)
     print(f"[DEBUG] Всего получено {len(all_data)} инструментов")
-    api_data_cache["data"], api_data_cache["last_update"] = all_data, now
+    schedule_history_prefetch()
     return all_data
 
+# --- Прогрев истории ставок для анализатора ---
+HISTORY_PREFETCH_MAX_ROWS = 300  # самые большие |ставки| среди прошедших хоть один фильтр
+history_prefetch_task: Optional[asyncio.Task] = None
+
+def history_prefetch_candidates(columns: FundingColumns) -> List[FundingRecord]:
+    """Инструменты, которые пройдут фильтр топа хотя бы одного пользователя (их будут анализировать)"""
+    filters = set()
+    for user_data in list(user_settings.values()):
+        stored_user_id = user_data.get('user_id')
+        if not stored_user_id or not check_access(stored_user_id): continue
+        settings = user_data['settings']
+        filters.add((tuple(settings['exchanges']), float(settings['funding_threshold']), float(settings['volume_threshold_usdt'])))
+    if not filters or not len(columns):
+        return []
+    mask = np.zeros(len(columns), dtype=bool)
+    for exchanges, threshold, volume_floor in filters:
+        mask |= (columns.exchange_mask(list(exchanges)) & (columns.abs_rate >= threshold)
+                 & ((columns.volume == 0) | (columns.volume >= volume_floor)))
+    rows = np.flatnonzero(mask)
+    return columns.take(rows[np.argsort(-columns.abs_rate[rows], kind='stable')[:HISTORY_PREFETCH_MAX_ROWS]])
+
+async def prefetch_history():
+    started = time.monotonic()
+    candidates = history_prefetch_candidates(snapshot_cache.columns)
+    fetched = await enhanced_funding_analyzer.prefetch_history(candidates)
+    if fetched:
+        print(f"[DEBUG] Прогрев истории: {fetched} запросов для {len(candidates)} кандидатов за {time.monotonic() - started:.1f}с")
+
+def schedule_history_prefetch():
+    """Запускает прогрев после публикации снимка (предыдущий прогрев, если еще идет, продолжается)"""
+    global history_prefetch_task
+    if history_prefetch_task is not None and not history_prefetch_task.done():
+        return
+    history_prefetch_task = asyncio.create_task(prefetch_history())
+    history_prefetch_task.add_done_callback(SnapshotCache._log_failure)
+
+# биржа -> (stream.updates, список записей), которые уже лежат в exchange_data_cache и в снимке
+spliced_streams: Dict[str, Tuple[int, List[FundingRecord]]] = {}
+
+def splice_live_streams():
+    """
+    Подменяет в снимке данные бирж с живым WebSocket-потоком на текущие (без сети).
+    Новая версия снимка публикуется, только если книга какого-то потока изменилась.
+    """
+    changed = False
+    for name in snapshot_cache.exchanges:
+        stream = EXCHANGE_ADAPTERS[name]['stream']
+        if stream is None or not stream.is_live():
+            continue
+        spliced = spliced_streams.get(name)
+        if spliced and spliced[0] == stream.updates and spliced[1] is exchange_data_cache.get(name, {}).get('data'):
+            continue  # книга не менялась, и данные с тех пор не перезаписывал REST
+        data = stream.records()
+        spliced_streams[name] = (stream.updates, data)
+        now = time.time()
+        exchange_data_cache[name] = {'last_update': now, 'last_good': now, 'data': data}
+        changed = True
+    if changed:
+        snapshot_cache.publish(snapshot_cache.exchanges, refreshed=False)
+
+async def fetch_all_data(context: ContextTypes.DEFAULT_TYPE | Application, force_update=False, exchanges: Optional[List[str]] = None):
+    """
+    Отдает снимок данных с бирж, которые кому-то нужны (или с переданного списка).
+    - свежий снимок (< CACHE_LIFETIME_SECONDS) отдается сразу;
+    - устаревший (< SNAPSHOT_MAX_STALE_SECONDS) отдается сразу, а обновление идет в фоне;
+    - иначе, или при force_update, ждем обновления. Параллельные обновления склеиваются в одно.
+    """
+    wanted = [name for name in (exchanges if exchanges is not None else get_active_exchanges()) if name in EXCHANGE_ADAPTERS]
+    bot_data = context.bot_data if isinstance(context, Application) else context.bot_data
+    refresh = lambda: refresh_exchanges(bot_data, wanted)
+
+    if not force_update and snapshot_cache.covers(wanted):
+        age = snapshot_cache.age()
+        if age < CACHE_LIFETIME_SECONDS:
+            splice_live_streams()
+            return snapshot_cache.data
+        if age < SNAPSHOT_MAX_STALE_SECONDS:
+            snapshot_cache.refresh_in_background(refresh, wanted)
+            return snapshot_cache.data
+
+    return await snapshot_cache.refresh(refresh, wanted)
+
+
+async def iter_exchange_data(context: ContextTypes.DEFAULT_TYPE | Application, exchanges: Optional[List[str]] = None, budget: float = FETCH_LATENCY_BUDGET_SECONDS):
+    """
+    Асинхронный итератор по биржам: отдает (биржа, данные, из_кэша) по мере готовности.
+    Свежие биржи отдаются сразу, остальные - как только ответят. Биржи, не уложившиеся
+    в budget секунд, отдаются из последних удачных данных, а их запросы продолжают
+    работать в фоне и обновят кэш для следующих вызовов.
+    """
+    wanted = [name for name in (exchanges if exchanges is not None else get_active_exchanges()) if name in EXCHANGE_ADAPTERS]
+    bot_data = context.bot_data if isinstance(context, Application) else context.bot_data
+
+    if snapshot_cache.covers(wanted) and snapshot_cache.age() < CACHE_LIFETIME_SECONDS:
+        splice_live_streams()
+        for name in wanted:
+            yield name, exchange_data(name), False
+        return
+
+    now = time.time()
+    pending: Dict[asyncio.Task, str] = {}
+    for name in wanted:
+        if is_exchange_due(name, now):
+            pending[start_exchange_fetch(name, bot_data)] = name
+        else:
+            yield name, exchange_data(name), False
+
+    # Бюджет считаем от начала запроса: если он уже идет давно (запущен сканером или
+    # предыдущим вызовом), ждать его снова целиком не нужно
+    while pending:
+        now = time.monotonic()
+        for task in [task for task in pending if not task.done() and now - exchange_fetch_started[task] >= budget]:
+            name = pending.pop(task)
+            print(f"[DEBUG] {name}: Не уложилась в {budget} сек, берем последние удачные данные")
+            yield name, exchange_data(name), True
+        if not pending:
+            break
+        timeout = max(0.0, min(exchange_fetch_started[task] + budget for task in pending) - time.monotonic())
+        done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield pending.pop(task), task.result(), False
+
+# ===== ДВИЖОК МЕЖБИРЖЕВЫХ СПРЕДОВ =====
+# Для монеты, торгуемой на двух и более биржах, лучшая пара - шорт там, где ставка выше, и лонг там,
+# где ниже: разница ставок и есть доход за выплату. Пары считаются векторно по колонкам снимка,
+# а в кучу top-K попадают только монеты, у которых пара изменилась; вытесненные записи кучи
+# отбрасываются лениво при чтении.
+# Ноги сравниваются по ставке в час (FundingRecord.hourly_rate): нога с выплатой раз в час и нога
+# раз в 8 часов иначе выглядели бы равными. Пары ранжируются по оценке = часовой спред
+# x вес ликвидности слабой ноги x вес времени до выплаты обеих ног (чем дальше выплата, тем больше
+# ставка успеет измениться). Часовой спред x вес ликвидности не зависит от текущего времени и
+# лежит в куче как верхняя граница оценки; точная оценка считается при чтении top().
+SPREAD_TOP_K = 10
+SPREAD_ENGINES_MAX = 32  # движков в LRU; сверх этого (и без чатов с такими настройками) они выбрасываются
+SPREAD_FULL_VOLUME_USDT = 10_000_000  # объем слабой ноги, с которого ликвидность не штрафуется
+SPREAD_UNKNOWN_VOLUME_WEIGHT = 0.5    # биржа не отдает объем (HTX) - штрафуем наполовину, но не отбрасываем
+SPREAD_TIME_HALF_HOURS = 8            # выплата обеих ног через столько часов - оценка вдвое ниже
+
+class SpreadPair:
+    """Пара ног по монете: шорт на short.exchange, лонг на long.exchange"""
+    __slots__ = ('symbol', 'short', 'long', 'spread', 'hourly_spread', 'min_volume', 'bound')
+
+    def __init__(self, short: FundingRecord, long: FundingRecord):
+        self.symbol = short.symbol
+        self.short = short
+        self.long = long
+        self.spread = short.rate - long.rate  # за одну выплату каждой ноги
+        self.hourly_spread = short.hourly_rate - long.hourly_rate
+        self.min_volume = min(short.volume_24h_usdt, long.volume_24h_usdt)  # ликвидность ограничена слабой ногой
+        self.bound = self.hourly_spread * self.volume_weight  # оценка без учета времени - верхняя граница score()
+
+    @property
+    def volume_weight(self) -> float:
+        if self.min_volume <= 0:
+            return SPREAD_UNKNOWN_VOLUME_WEIGHT
+        return min(1.0, self.min_volume / SPREAD_FULL_VOLUME_USDT)
+
+    def score(self, now_ms: int) -> float:
+        """Часовой спред с поправкой на ликвидность и на время, за которое придут выплаты обеих ног"""
+        hours = max(0, max(self.short.next_funding_time, self.long.next_funding_time) - now_ms) / 3_600_000
+        return self.bound / (1 + hours / SPREAD_TIME_HALF_HOURS)
+
+    @property
+    def expires_at(self) -> int:
+        """После ближайшей выплаты биржа выставит новую ставку - пара требует пересчета"""
+        return min(self.short.next_funding_time, self.long.next_funding_time)
+
+class SpreadEngine:
+    """Лучшая пара по каждой монете и top-K по оценке для набора бирж и порога объема слабой ноги"""
+    SIGNATURE_WIDTH = 8
+
+    def __init__(self, exchanges: List[str], min_volume: float = 0.0):
+        self.exchanges = list(exchanges)
+        self.min_volume = min_volume
+        self.pairs: Dict[str, SpreadPair] = {}
+        self._heap: List[Tuple[float, int, str]] = []  # (-верхняя граница оценки, номер записи, символ)
+        self._entry: Dict[str, int] = {}                # символ -> номер актуальной записи в куче
+        self._seq = 0
+        self._columns: Optional[FundingColumns] = None
+        self._signature = np.empty((0, self.SIGNATURE_WIDTH))  # по коду символа: биржи, часовые ставки, время и объем ног
+        self._symbol_by_code: Dict[int, str] = {}
+
+    def update(self, columns: FundingColumns) -> int:
+        """Пересчитывает пары по новому снимку; возвращает число монет, у которых пара изменилась"""
+        if columns is self._columns:
+            return 0
+        self._columns = columns
+        now_ms = int(time.time() * 1000)
+        mask = columns.exchange_mask(self.exchanges) & (columns.next_funding_time > now_ms)
+        if self.min_volume > 0:
+            # Как и в топе: нулевой объем - биржа его не отдает, такие ноги не отсекаем
+            mask &= (columns.volume == 0) | (columns.volume >= self.min_volume)
+        codes, short_rows, long_rows, legs = columns.rate_extremes_per_symbol(np.flatnonzero(mask), columns.hourly_rate)
+        paired = (legs >= 2) & (columns.exchange_id[short_rows] != columns.exchange_id[long_rows])
+        codes, short_rows, long_rows = codes[paired], short_rows[paired], long_rows[paired]
+
+        signature = np.full((len(symbol_codes), self.SIGNATURE_WIDTH), np.nan)
+        signature[codes] = np.column_stack((
+            columns.exchange_id[short_rows], columns.exchange_id[long_rows],
+            columns.hourly_rate[short_rows], columns.hourly_rate[long_rows],
+            columns.next_funding_time[short_rows], columns.next_funding_time[long_rows],
+            columns.volume[short_rows], columns.volume[long_rows],
+        ))
+        previous = np.full_like(signature, np.nan)
+        previous[:len(self._signature)] = self._signature
+        unchanged = ((signature == previous) | (np.isnan(signature) & np.isnan(previous))).all(axis=1)
+        self._signature = signature
+
+        position = dict(zip(codes.tolist(), range(len(codes))))
+        changed = np.flatnonzero(~unchanged)
+        for code in changed.tolist():
+            i = position.get(code)
+            if i is None:
+                symbol = self._symbol_by_code.pop(code)
+                del self.pairs[symbol], self._entry[symbol]
+                continue
+            pair = SpreadPair(columns.records[short_rows[i]], columns.records[long_rows[i]])
+            self._symbol_by_code[code] = pair.symbol
+            self._seq += 1
+            self.pairs[pair.symbol], self._entry[pair.symbol] = pair, self._seq
+            heapq.heappush(self._heap, (-pair.bound, self._seq, pair.symbol))
+
+        if len(self._heap) > 2 * len(self.pairs) + SPREAD_TOP_K:
+            # Слишком много вытесненных записей - пересобираем кучу из актуальных
+            self._heap = [(-pair.bound, self._entry[symbol], symbol) for symbol, pair in self.pairs.items()]
+            heapq.heapify(self._heap)
+        return len(changed)
+
+    def top(self, k: int = SPREAD_TOP_K) -> List[SpreadPair]:
+        """
+        k лучших актуальных пар по убыванию оценки. Куча упорядочена по верхней границе, поэтому
+        пары достаются, пока граница следующей не опустится ниже k-й уже найденной оценки.
+        """
+        now_ms = int(time.time() * 1000)
+        scored: List[Tuple[float, int, SpreadPair]] = []  # куча k лучших: (оценка, номер записи, пара)
+        seen = []
+        while self._heap and (len(scored) < k or -self._heap[0][0] > scored[0][0]):
+            entry = heapq.heappop(self._heap)
+            _, seq, symbol = entry
+            if self._entry.get(symbol) != seq:
+                continue  # пара по монете пересчитана или исчезла
+            seen.append(entry)
+            pair = self.pairs[symbol]
+            if pair.expires_at > now_ms:
+                heapq.heappush(scored, (pair.score(now_ms), seq, pair))
+                if len(scored) > k:
+                    heapq.heappop(scored)
+        for entry in seen:
+            heapq.heappush(self._heap, entry)
+        return [pair for _, _, pair in sorted(scored, key=lambda item: -item[0])]
+
+spread_engines: 'OrderedDict[Tuple[frozenset, float], SpreadEngine]' = OrderedDict()
+
+def spread_engine_key(settings: Dict) -> Tuple[frozenset, float]:
+    return frozenset(settings['exchanges']), float(settings['volume_threshold_usdt'])
+
+def get_spread_engine(settings: Dict) -> SpreadEngine:
+    """Движок для набора бирж и порога объема пользователя (одинаковые настройки делят один движок)"""
+    key = spread_engine_key(settings)
+    if key not in spread_engines:
+        spread_engines[key] = SpreadEngine(settings['exchanges'], key[1])
+    spread_engines.move_to_end(key)
+    while len(spread_engines) > SPREAD_ENGINES_MAX:
+        spread_engines.popitem(last=False)
+    return spread_engines[key]
+
+def prune_spread_engines():
+    """Выбрасывает движки, настроек которых больше нет ни у одного чата с доступом (фильтры поменяли)"""
+    used = {spread_engine_key(user_data['settings']) for user_data in list(user_settings.values())
+            if user_data.get('user_id') and check_access(user_data['user_id'])}
+    for key in [key for key in spread_engines if key not in used]:
+        del spread_engines[key]
+
+# ===== РАНЖИРОВАННЫЙ ТОП =====
+# Каждый блок биржи сортируется по |ставке| один раз на ответ биржи (FundingColumns.ranked),
+# поэтому новый снимок пересортировывает только изменившиеся биржи. Топ-N для набора бирж -
+# ленивое k-way слияние их блоков: O(N log M) вместо фильтрации и сортировки всего снимка.
+# Курсор (позиция в слиянии + уже показанные монеты) позволяет листать дальше без пересчета.
+TOP_PAGE_SIZE = 5
+
+def _ranked_stream(order: int, block: FundingColumns, start: int):
+    rows, keys = block.ranked()
+    for pos in range(start, len(rows)):
+        yield keys[pos], order, pos, block.records[rows[pos]]
+
+def _stream_start(keys: List[float], order: int, after: Optional[Tuple[float, int, int]]) -> int:
+    """Первая позиция блока строго после курсора в порядке (-|ставка|, номер биржи, позиция)"""
+    if after is None:
+        return 0
+    neg_abs, after_order, after_pos = after
+    if order < after_order:
+        return bisect.bisect_right(keys, neg_abs)
+    if order > after_order:
+        return bisect.bisect_left(keys, neg_abs)
+    # Та же биржа: если блок успел обновиться, позиция внутри равных ставок может сместиться
+    return min(max(bisect.bisect_left(keys, neg_abs), after_pos + 1), bisect.bisect_right(keys, neg_abs))
+
+def ranked_page(settings: Dict, cursor: Optional[Dict] = None, exchanges: Optional[List[str]] = None,
+                size: int = TOP_PAGE_SIZE) -> Tuple[List[FundingRecord], Optional[Dict]]:
+    """
+    Следующие size монет топа (лучшая биржа для каждой монеты, по убыванию |ставки|)
+    и курсор для следующей страницы (None, если монет больше нет).
+    Курсор от других настроек или другого набора бирж игнорируется - топ начинается сначала.
+    """
+    exchanges = [name for name in settings['exchanges'] if name in EXCHANGE_ADAPTERS and (exchanges is None or name in exchanges)]
+    threshold, volume_floor = float(settings['funding_threshold']), float(settings['volume_threshold_usdt'])
+    key = (tuple(exchanges), threshold, volume_floor)
+    if cursor is None or cursor['key'] != key:
+        cursor = {'key': key, 'after': None, 'shown': frozenset()}
+    after, shown = cursor['after'], set(cursor['shown'])
+
+    streams = []
+    for order, name in enumerate(exchanges):
+        block = exchange_columns(name)
+        if len(block):
+            streams.append(_ranked_stream(order, block, _stream_start(block.ranked()[1], order, after)))
+
+    page = []
+    for neg_abs, order, pos, item in heapq.merge(*streams):
+        if -neg_abs < threshold:
+            break  # дальше ставки только меньше
+        if item.symbol in shown or (item.volume_24h_usdt and item.volume_24h_usdt < volume_floor):
+            continue  # у монеты уже показана лучшая биржа / не проходит по объему (если объем известен)
+        if len(page) == size:
+            return page, {'key': key, 'after': after, 'shown': frozenset(shown)}
+        page.append(item)
+        shown.add(item.symbol)
+        after = (neg_abs, order, pos)
+    return page, None
+
+def symbol_records(symbol: str, settings: Dict, exchanges: Optional[List[str]] = None) -> List[FundingRecord]:
+    """Записи монеты на выбранных биржах, прошедшие фильтры пользователя (для экрана деталей)"""
+    threshold, volume_floor = float(settings['funding_threshold']), float(settings['volume_threshold_usdt'])
+    return [item for name in (exchanges or settings['exchanges']) if name in EXCHANGE_ADAPTERS
+            for item in exchange_columns(name).records_for_symbol(symbol)
+            if abs(item.rate) >= threshold and not (item.volume_24h_usdt and item.volume_24h_usdt < volume_floor)]
 
 async def fetch_funding_history_async(symbol, start_time, end_time):
-    """Асинхронно получает историю ставок финансирования с MEXC."""
+    """Асинхронно получает историю ставок финансирования с MEXC (выплаты в [start_time, end_time])."""
     url = f"https://contract.mexc.com/api/v1/contract/funding_rate/history"
-    params = {'symbol': symbol, 'page_size': 100, 'start_time': start_time, 'end_time': end_time}
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=10) as response:
-                response.raise_for_status()
-                data = await response.json()
-                if data.get("success"): return data.get('data', [])
-                else: return []
-    except Exception: return []
-
-async def fetch_klines_async(symbol, start_time, end_time):
-    """Асинхронно получает 1-минутные свечи с MEXC."""
-    url = f"https://contract.mexc.com/api/v1/contract/kline/{symbol}"
-    all_klines = []
-    current_time = start_time
+    records, page = [], 1
     try:
-        async with aiohttp.ClientSession() as session:
-            while current_time < end_time:
-                params = {'symbol': symbol, 'interval': 'Min1', 'start': int(current_time / 1000), 'end': int(end_time / 1000)}
-                async with session.get(url, params=params, timeout=20) as response:
+        async with shared_http_session() as session:
+            while True:
+                params = {'symbol': symbol, 'page_num': page, 'page_size': 100}
+                async with exchange_request(session, 'MEXC', 'GET', url, params=params, timeout=10) as response:
                     response.raise_for_status()
                     data = await response.json()
-                    if data.get("success") and data.get('data', {}).get('time'):
-                        klines = data['data']
-                        for i in range(len(klines['time'])):
-                            all_klines.append([klines['time'][i] * 1000, klines['open'][i], klines['high'][i], klines['low'][i], klines['close'][i], klines['vol'][i]])
-                        last_time = klines['time'][-1] * 1000
-                        if last_time >= current_time: current_time = last_time + 60000
-                        else: break
-                    else: break
+                if not data.get("success"): break
+                result = data['data'].get('resultList', [])
+                records.extend(r for r in result if start_time <= r['settleTime'] <= end_time)
+                # страницы идут от новых выплат к старым
+                if not result or result[-1]['settleTime'] < start_time or page >= data['data'].get('totalPage', 1): break
+                page += 1
     except Exception: return []
-    return all_klines
+    return sorted(records, key=lambda r: r['settleTime'])
+
+# Диапазон делится на окна по размеру страницы MEXC и окна качаются параллельно:
+# многодневная выгрузка занимает время одного-двух запросов, а не цепочки из N.
+KLINE_PAGE_MINUTES = 1000
+KLINE_FETCH_CONCURRENCY = 6
+KLINE_WINDOW_RETRIES = 2
+
+async def _fetch_kline_window(session: aiohttp.ClientSession, url: str, symbol: str, start_ms: int, end_ms: int) -> List[List]:
+    """
+    Свечи одного окна [start_ms, end_ms]. Если биржа отдала окно не до конца, докачивает
+    хвост; сетевые ошибки и ответы без success повторяются, после попыток - исключение.
+    """
+    klines, current = [], start_ms
+    attempt = 0
+    while current <= end_ms:
+        params = {'symbol': symbol, 'interval': 'Min1', 'start': current // 1000, 'end': end_ms // 1000}
+        try:
+            async with exchange_request(session, 'MEXC', 'GET', url, params=params, timeout=20) as response:
+                response.raise_for_status()
+                data = await response.json()
+            if not data.get("success"):
+                raise RuntimeError(f"MEXC: {data.get('message')}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError):
+            if attempt >= KLINE_WINDOW_RETRIES:
+                raise
+            attempt += 1
+            await asyncio.sleep(attempt)
+            continue
+        page = data.get('data', {})
+        if not page.get('time'):
+            break  # в окне нет торгов (или монета еще не листилась)
+        klines.extend([t * 1000, o, h, l, c, v] for t, o, h, l, c, v in
+                      zip(page['time'], page['open'], page['high'], page['low'], page['close'], page['vol']))
+        if page['time'][-1] * 1000 < current:
+            break
+        current = page['time'][-1] * 1000 + 60000
+    return klines
+
+async def fetch_klines_async(symbol, start_time, end_time, strict: bool = False):
+    """Асинхронно получает 1-минутные свечи с MEXC. strict - падать, если какое-то окно не скачалось."""
+    url = f"https://contract.mexc.com/api/v1/contract/kline/{symbol}"
+    window_ms = KLINE_PAGE_MINUTES * 60000
+    first = start_time - start_time % 60000
+    windows = [(ws, min(ws + window_ms - 60000, end_time)) for ws in range(first, end_time, window_ms)]
+    semaphore = asyncio.Semaphore(KLINE_FETCH_CONCURRENCY)
+
+    async def fetch_window(window):
+        async with semaphore:
+            return await _fetch_kline_window(session, url, symbol, *window)
+
+    async with shared_http_session() as session:
+        results = await asyncio.gather(*(fetch_window(window) for window in windows), return_exceptions=True)
+    by_time = {}
+    for window, result in zip(windows, results):
+        if isinstance(result, BaseException):
+            print(f"[API_ERROR] MEXC: свечи {symbol} {window[0]}..{window[1]} не получены: {result!r}")
+            if strict:
+                raise result
+            continue
+        for kline in result:
+            if start_time <= kline[0] <= end_time:
+                by_time[kline[0]] = kline  # окна не пересекаются, но край может прийти дважды
+    return [by_time[t] for t in sorted(by_time)]
+
+# --- Кэш свечей по покрытым интервалам ---
+# Свечи живут в market_store, а его coverage.json помнит, какие отрезки времени уже скачаны
+# для (биржа, монета, интервал). Запрос докачивает только непокрытые куски; покрытием
+# отмечаются только закрытые свечи, поэтому текущая минута перезапрашивается, а закрытые - никогда.
+KLINE_INTERVAL_KIND = {'Min1': 'klines_1m'}
+kline_locks: Dict[Tuple[str, str, str], asyncio.Lock] = {}
+
+async def load_klines(symbol: str, start_ms: int, end_ms: int, exchange: str = 'MEXC', interval: str = 'Min1') -> np.ndarray:
+    """Свечи [start_ms, end_ms] из хранилища с докачкой недостающих отрезков"""
+    kind = KLINE_INTERVAL_KIND[interval]
+    # один ключ качает один вызов: параллельный запрос того же диапазона дождется и возьмет из хранилища
+    async with kline_locks.setdefault((exchange, symbol, interval), asyncio.Lock()):
+        gaps = await asyncio.to_thread(market_store.missing, kind, exchange, symbol, start_ms, end_ms)
+        if gaps:
+            closed_until = int(time.time() * 1000) // 60000 * 60000 - 1  # до открытия текущей свечи
+            results = await asyncio.gather(*(fetch_klines_async(symbol, start, end, strict=True) for start, end in gaps),
+                                           return_exceptions=True)
+            for (start, end), klines in zip(gaps, results):
+                if isinstance(klines, BaseException):
+                    continue  # отрезок не покрыт - следующий запрос попробует снова
+                await asyncio.to_thread(market_store.append, kind, exchange, symbol, klines)
+                await asyncio.to_thread(market_store.mark_covered, kind, exchange, symbol, start, min(end, closed_until))
+            print(f"[DEBUG] Свечи {exchange} {symbol}: докачано отрезков {len(gaps)}")
+        return await asyncio.to_thread(market_store.read_range, kind, exchange, symbol, start_ms, end_ms)
 
 # =================================================================
 # ========== ПОЛЬЗОВАТЕЛЬСКИЙ ИНТЕРФЕЙС С УМНЫМ АНАЛИЗОМ ==========
@@ -1207,7 +2771,7 @@ async def fetch_klines_async(symbol, start_time, end_time):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"--- ПОЛУЧЕНА КОМАНДА /start от пользователя {update.effective_user.id} ---")
     ensure_user_settings(update.effective_chat.id, update.effective_user.id)
-    main_menu_keyboard = [["🔥 Топ-ставки сейчас"], ["🔧 Настроить фильтры", "ℹ️ Мои настройки"], ["🔧 Диагностика API"]]
+    main_menu_keyboard = [["🔥 Топ-ставки сейчас", "↔️ Спреды между биржами"], ["🔧 Настроить фильтры", "ℹ️ Мои настройки"], ["🔧 Диагностика API"]]
     reply_markup = ReplyKeyboardMarkup(main_menu_keyboard, resize_keyboard=True)
     await update.message.reply_text("Добро пожаловать в RateHunter 2.0 с умным анализатором!", reply_markup=reply_markup)
 
@@ -1216,19 +2780,19 @@ async def api_diagnostics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Диагностика состояния API"""
     msg = await update.message.reply_text("🔧 Проверяю состояние API...")
     
-    all_data = await fetch_all_data(context, force_update=True)
+    all_data = await fetch_all_data(context, exchanges=ALL_AVAILABLE_EXCHANGES)
     
     exchange_counts = {}
     for item in all_data:
-        exchange = item.get('exchange', 'Unknown')
+        exchange = item.exchange
         exchange_counts[exchange] = exchange_counts.get(exchange, 0) + 1
     
     rates_analysis = {"high_rates": 0, "medium_rates": 0, "low_rates": 0}
     volume_analysis = {"high_volume": 0, "medium_volume": 0, "low_volume": 0}
     
     for item in all_data:
-        rate_pct = abs(item['rate']) * 100
-        volume_m = item.get('volume_24h_usdt', Decimal('0')) / 1_000_000
+        rate_pct = abs(item.rate) * 100
+        volume_m = item.volume_24h_usdt / 1_000_000
         
         if rate_pct >= 0.5:
             rates_analysis["high_rates"] += 1
@@ -1264,12 +2828,12 @@ async def api_diagnostics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     report += f"• < 10M USDT: {volume_analysis['low_volume']} пар\n"
     
     if all_data:
-        top_rates = sorted(all_data, key=lambda x: abs(x['rate']), reverse=True)[:5]
+        top_rates = sorted(all_data, key=lambda x: abs(x.rate), reverse=True)[:5]
         report += f"\n🔥 **Топ-5 ставок:**\n"
         for item in top_rates:
-            rate_pct = abs(item['rate']) * 100
-            vol_m = item.get('volume_24h_usdt', Decimal('0')) / 1_000_000
-            report += f"• {item['symbol'].replace('USDT', '')}: {rate_pct:.3f}% (объем: {vol_m:.1f}M) [{item['exchange']}]\n"
+            rate_pct = abs(item.rate) * 100
+            vol_m = item.volume_24h_usdt / 1_000_000
+            report += f"• {item.symbol.replace('USDT', '')}: {rate_pct:.3f}% (объем: {vol_m:.1f}M) [{item.exchange}]\n"
     
     report += f"\n⏰ Время обновления: {datetime.now(MSK_TIMEZONE).strftime('%H:%M:%S MSK')}"
     report += f"\n🕐 Кэш действителен: {CACHE_LIFETIME_SECONDS} сек"
@@ -1280,21 +2844,31 @@ async def api_diagnostics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     report += f"{'✅' if mexc_key else '❌'} MEXC: {'Настроены' if mexc_key else 'Отсутствуют'}\n"
     report += f"{'✅' if bybit_key else '❌'} Bybit: {'Настроены' if bybit_key else 'Отсутствуют'}\n"
+
+    cache_stats = enhanced_funding_analyzer.historical_cache.stats()
+    report += f"\n🗄 **Кэш истории ставок:** {cache_stats['entries']} записей\n"
+    report += f"• Попадания: {cache_stats['hits']} (+{cache_stats['negative_hits']} пустых)\n"
+    report += f"• Промахи: {cache_stats['misses']}\n"
+    report += f"• Вытеснения: {cache_stats['evictions']}\n"
     
     await msg.edit_text(report, parse_mode='Markdown')
 
 # ===== НОВАЯ ФУНКЦИЯ: УМНЫЙ АНАЛИЗ ВОЗМОЖНОСТЕЙ =====
-async def analyze_funding_opportunity(item: Dict) -> Dict:
+async def analyze_funding_opportunity(item: FundingRecord) -> Dict:
     """
     ФИНАЛЬНАЯ ВЕРСИЯ: Улучшенные, интуитивно понятные эмодзи и описания сигналов.
+    Запись из снимка не меняется: результат - отдельный словарь со ссылкой на нее в 'record'.
     """
     analysis = await enhanced_funding_analyzer.analyze_trading_opportunity(
-        symbol=item['symbol'],
-        exchange=item['exchange'], 
-        current_rate=item['rate']
+        symbol=item.symbol,
+        exchange=item.exchange, 
+        current_rate=Decimal(repr(item.rate)),  # анализатор считает в Decimal
+        next_funding_time=item.next_funding_time  # история монеты не меняется до выплаты
     )
-    
-    item['enhanced_analysis'] = analysis
+    return describe_funding_analysis(item, analysis)
+
+def describe_funding_analysis(item: FundingRecord, analysis: Dict) -> Dict:
+    """Оформляет результат анализатора для интерфейса (эмодзи, текст сигнала)"""
     signal = analysis['signal']
     confidence = analysis['confidence']
     
@@ -1317,29 +2891,63 @@ async def analyze_funding_opportunity(item: Dict) -> Dict:
     
     signal_info = signal_map.get(signal, {'emoji': '❓', 'message': 'Анализ...', 'details': 'Обработка данных'})
     
-    item['smart_recommendation'] = {
-        'emoji': signal_info['emoji'],
-        'message': signal_info['message'],
-        'details': signal_info['details'],
-        'confidence': confidence,
-        'recommendation_type': signal
+    return {
+        'record': item,
+        'enhanced_analysis': analysis,
+        'smart_recommendation': {
+            'emoji': signal_info['emoji'],
+            'message': signal_info['message'],
+            'details': signal_info['details'],
+            'confidence': confidence,
+            'recommendation_type': signal
+        },
+        'enhanced_recommendation': {
+            'signal_type': signal,
+            'trend_direction': analysis.get('trend_direction', 'unknown'),
+            'trend_strength': analysis.get('trend_strength', 0.0),
+            'recent_change': analysis.get('recent_change', 0.0),
+            'momentum': analysis.get('momentum', 'steady'),
+            'full_recommendation': analysis.get('recommendation', ''),
+            'data_points': analysis.get('data_points', 0)
+        },
     }
-    
-    item['enhanced_recommendation'] = {
-        'signal_type': signal,
-        'trend_direction': analysis.get('trend_direction', 'unknown'),
-        'trend_strength': analysis.get('trend_strength', 0.0),
-        'recent_change': analysis.get('recent_change', 0.0),
-        'momentum': analysis.get('momentum', 'steady'),
-        'full_recommendation': analysis.get('recommendation', ''),
-        'data_points': analysis.get('data_points', 0)
+PROGRESSIVE_EDIT_INTERVAL_SECONDS = 1.5  # не чаще редактируем сообщение, пока приходят биржи
+
+def select_top_opportunities(columns: FundingColumns, settings: Dict) -> Dict:
+    """Фильтрует данные по настройкам пользователя и оставляет лучшую биржу для каждой монеты"""
+    exchange_mask = columns.exchange_mask(settings['exchanges'])
+    rate_mask = exchange_mask & (columns.abs_rate >= float(settings['funding_threshold']))
+    # Если объем есть - проверяем фильтр, если нет - пропускаем
+    volume_mask = (columns.volume == 0) | (columns.volume >= float(settings['volume_threshold_usdt']))
+    filtered_rows = np.flatnonzero(rate_mask & volume_mask)
+    return {
+        'exchange_count': int(exchange_mask.sum()), 'rate_count': int(rate_mask.sum()), 'filtered_count': len(filtered_rows),
+        'filtered_rows': filtered_rows, 'opportunities': columns.take(columns.best_per_symbol(filtered_rows)),
     }
-    
-    return item
+
+def format_countdown(next_funding_time: int, now_utc: datetime) -> str:
+    time_left = datetime.fromtimestamp(next_funding_time / 1000, tz=timezone.utc) - now_utc
+    if time_left.total_seconds() <= 0:
+        return ""
+    h, m = divmod(int(time_left.total_seconds()) // 60, 60)
+    return f" ({h}ч {m}м)" if h > 0 else f" ({m}м)"
+
+def render_top_preview(opportunities: List[FundingRecord], waiting: List[str]) -> str:
+    """Предварительный топ-5 без ИИ-анализа, пока не ответили все биржи"""
+    message_text = f"🔥 **ТОП-5 фандинг возможностей** _(предварительно)_\n\n"
+    now_utc = datetime.now(timezone.utc)
+    for item in opportunities[:5]:
+        direction_emoji = "🟢" if item.rate < 0 else "🔴"
+        time_str = datetime.fromtimestamp(item.next_funding_time / 1000, tz=timezone.utc).astimezone(MSK_TIMEZONE).strftime('%H:%M МСК')
+        message_text += f"{direction_emoji} **{item.symbol.replace('USDT', '')}** {item.rate * 100:+.2f}% | 🕒 {time_str}{format_countdown(item.next_funding_time, now_utc)} | {item.exchange}\n"
+    message_text += f"\n⏳ Ждем: {', '.join(waiting)}"
+    return message_text
+
 @require_access()
 async def show_top_rates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    ОБНОВЛЕННАЯ ВЕРСИЯ: Показывает топ возможностей с торговыми сигналами
+    ОБНОВЛЕННАЯ ВЕРСИЯ: Показывает топ возможностей с торговыми сигналами.
+    Пока отвечают биржи, сообщение обновляется предварительным топом по уже пришедшим данным.
     """
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
@@ -1349,84 +2957,173 @@ async def show_top_rates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.callback_query.message if update.callback_query else await update.message.reply_text("🔄 Ищу...")
     await msg.edit_text("🔄 Ищу лучшие возможности с ИИ-анализом...")
 
-    all_data = await fetch_all_data(context)
-    if not all_data:
+    received = []
+    waiting = [name for name in settings['exchanges'] if name in EXCHANGE_ADAPTERS]
+    if not waiting:
+        await msg.edit_text("⚠️ Не выбрано ни одной биржи. Отметьте хотя бы одну: 🔧 Настроить фильтры → 🦄 Биржи.")
+        return
+    from_cache = []
+    last_edit = time.monotonic()
+    async for exchange_name, _, is_stale in iter_exchange_data(context, exchanges=waiting.copy()):
+        received.append(exchange_name)
+        waiting.remove(exchange_name)
+        if is_stale:
+            from_cache.append(exchange_name)
+        if waiting and time.monotonic() - last_edit >= PROGRESSIVE_EDIT_INTERVAL_SECONDS:
+            preview, _ = ranked_page(settings, exchanges=received)
+            if preview:
+                try:
+                    await msg.edit_text(render_top_preview(preview, waiting), parse_mode='Markdown')
+                    last_edit = time.monotonic()
+                except Exception as e:
+                    print(f"[DEBUG] Не удалось обновить предварительный топ: {e}")
+
+    if not any(len(exchange_columns(name)) for name in received):
         await msg.edit_text("😞 Не удалось получить данные с бирж. Попробуйте 🔧 Диагностика API для проверки.")
         return
 
-    exchange_filtered = [item for item in all_data if item['exchange'] in settings['exchanges']]
-    rate_filtered = [item for item in exchange_filtered if abs(item['rate']) >= settings['funding_threshold']]
-    filtered_data = []
-    for item in rate_filtered:
-        volume = item.get('volume_24h_usdt', Decimal('0'))
-        # Если объем есть - проверяем фильтр, если нет - пропускаем
-        if volume == Decimal('0') or volume >= settings['volume_threshold_usdt']:
-           filtered_data.append(item)
+    top_5, next_cursor = ranked_page(settings, exchanges=received)
     
-    if not filtered_data:
+    if not top_5:
+        # Полная фильтрация нужна только для статистики пустого результата
+        columns = assemble_columns(received)
+        selection = select_top_opportunities(columns, settings)
         stats_msg = f"😞 Не найдено пар, соответствующих всем фильтрам.\n\n"
         stats_msg += f"📊 **Статистика:**\n"
-        stats_msg += f"• Всего инструментов: {len(all_data)}\n"
-        stats_msg += f"• На выбранных биржах: {len(exchange_filtered)}\n"
-        stats_msg += f"• Со ставкой ≥ {settings['funding_threshold']*100:.1f}%: {len(rate_filtered)}\n"
-        stats_msg += f"• С объемом ≥ {settings['volume_threshold_usdt']/1_000:.0f}K: {len(filtered_data)}\n"
+        stats_msg += f"• Всего инструментов: {len(columns)}\n"
+        stats_msg += f"• На выбранных биржах: {selection['exchange_count']}\n"
+        stats_msg += f"• Со ставкой ≥ {settings['funding_threshold']*100:.1f}%: {selection['rate_count']}\n"
+        stats_msg += f"• С объемом ≥ {settings['volume_threshold_usdt']/1_000:.0f}K: {selection['filtered_count']}\n"
         await msg.edit_text(stats_msg, parse_mode='Markdown')
         return
 
-    symbol_groups = {}
-    for item in filtered_data:
-        symbol = item['symbol']
-        if symbol not in symbol_groups:
-            symbol_groups[symbol] = []
-        symbol_groups[symbol].append(item)
-    
-    unique_opportunities = [max(items, key=lambda x: abs(x['rate'])) for items in symbol_groups.values()]
-    unique_opportunities.sort(key=lambda x: abs(x['rate']), reverse=True)
-    top_5 = unique_opportunities[:5]
-    
+    context.user_data['top_cursors'] = [None]
+    await send_top_page(msg, context, settings, 0, top_5, next_cursor, from_cache)
+
+async def send_top_page(msg, context: ContextTypes.DEFAULT_TYPE, settings: Dict, page_index: int,
+                        page: List[FundingRecord], next_cursor: Optional[Dict], from_cache: List[str] = ()):
+    """ИИ-анализ и вывод страницы топа; курсор следующей страницы запоминается в user_data"""
     analyzed_opportunities = []
-    for item in top_5:
+    for item in page:
         analyzed_item = await analyze_funding_opportunity(item)
         analyzed_opportunities.append(analyzed_item)
     
+    cursors = context.user_data.setdefault('top_cursors', [None])
+    del cursors[page_index + 1:]
+    if next_cursor is not None:
+        cursors.append(next_cursor)
     context.user_data['current_opportunities'] = analyzed_opportunities
-    context.user_data['all_symbol_data'] = symbol_groups
+    context.user_data['all_symbol_data'] = {item.symbol: symbol_records(item.symbol, settings) for item in page}
 
-    message_text = f"🔥 **ТОП-5 фандинг возможностей с ИИ-сигналами**\n\n"
+    if page_index == 0:
+        message_text = f"🔥 **ТОП-5 фандинг возможностей с ИИ-сигналами**\n\n"
+    else:
+        first = page_index * TOP_PAGE_SIZE + 1
+        message_text = f"🔥 **Фандинг возможности {first}–{first + len(page) - 1} с ИИ-сигналами**\n\n"
     buttons = []
     now_utc = datetime.now(timezone.utc)
     
-    for item in analyzed_opportunities:
-        symbol_only = item['symbol'].replace("USDT", "")
-        smart_rec = item.get('smart_recommendation', {})
-        funding_dt_utc = datetime.fromtimestamp(item['next_funding_time'] / 1000, tz=timezone.utc)
-        time_left = funding_dt_utc - now_utc
-        countdown_str = ""
-        if time_left.total_seconds() > 0:
-            h, m = divmod(int(time_left.total_seconds()) // 60, 60)
-            countdown_str = f" ({h}ч {m}м)" if h > 0 else f" ({m}м)"
+    for analyzed_item in analyzed_opportunities:
+        item = analyzed_item['record']
+        symbol_only = item.symbol.replace("USDT", "")
+        smart_rec = analyzed_item.get('smart_recommendation', {})
+        funding_dt_utc = datetime.fromtimestamp(item.next_funding_time / 1000, tz=timezone.utc)
+        countdown_str = format_countdown(item.next_funding_time, now_utc)
 
-        direction_emoji = "🟢" if item['rate'] < 0 else "🔴"
-        rate_str = f"{item['rate'] * 100:+.2f}%"
+        direction_emoji = "🟢" if item.rate < 0 else "🔴"
+        rate_str = f"{item.rate * 100:+.2f}%"
         time_str = funding_dt_utc.astimezone(MSK_TIMEZONE).strftime('%H:%M МСК')
         ai_emoji = smart_rec.get('emoji', '❓')
         ai_message = smart_rec.get('message', 'Анализ...')
         confidence = smart_rec.get('confidence', 0.0)
         confidence_str = f" ({confidence:.0%})" if confidence > 0 else ""
         
-        message_text += f"{direction_emoji} **{symbol_only}** {rate_str} | 🕒 {time_str}{countdown_str} | {item['exchange']}\n"
+        message_text += f"{direction_emoji} **{symbol_only}** {rate_str} | 🕒 {time_str}{countdown_str} | {item.exchange}\n"
         message_text += f"  {ai_emoji} *ИИ:* _{ai_message}{confidence_str}_\n\n"
-        buttons.append(InlineKeyboardButton(f"{ai_emoji} {symbol_only}", callback_data=f"drill_{item['symbol']}"))
+        buttons.append(InlineKeyboardButton(f"{ai_emoji} {symbol_only}", callback_data=f"drill_{item.symbol}"))
 
+    if from_cache:
+        message_text += f"⚠️ _Не ответили вовремя, показаны последние данные: {', '.join(from_cache)}_\n"
     message_text += "\n💡 *Нажмите на монету для детального просмотра*"
     detail_buttons = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    page_buttons = []
+    if page_index > 0:
+        page_buttons.append(InlineKeyboardButton("⬅️ Предыдущие", callback_data=f"top_page_{page_index - 1}"))
+    if next_cursor is not None:
+        page_buttons.append(InlineKeyboardButton("➡️ Следующие", callback_data=f"top_page_{page_index + 1}"))
     action_buttons = [
         [InlineKeyboardButton("🧠 Подробный ИИ-анализ", callback_data="ai_analysis")],
+        [InlineKeyboardButton("↔️ Спреды между биржами", callback_data="spreads")],
         [InlineKeyboardButton("🔄 Обновить", callback_data="back_to_top")]
     ]
-    keyboard = detail_buttons + action_buttons
+    keyboard = detail_buttons + ([page_buttons] if page_buttons else []) + action_buttons
     await msg.edit_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown', disable_web_page_preview=True)
 
+@require_access()
+async def show_top_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание топа по курсору: без запроса к биржам и без пересортировки снимка"""
+    query = update.callback_query
+    await query.answer()
+    chat_id = update.effective_chat.id
+    ensure_user_settings(chat_id, update.effective_user.id)
+    settings = user_settings[chat_id]['settings']
+
+    page_index = int(query.data.split('_')[-1])
+    cursors = context.user_data.get('top_cursors', [])
+    page, next_cursor = ranked_page(settings, cursors[page_index]) if page_index < len(cursors) else ([], None)
+    if not page:
+        # Курсор потерян (перезапуск бота) или монеты закончились после обновления данных
+        await show_top_rates(update, context)
+        return
+    await send_top_page(query.message, context, settings, page_index, page, next_cursor)
+
+# ===== МЕЖБИРЖЕВЫЕ СПРЕДЫ =====
+@require_access()
+async def show_spreads(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Лучшие пары шорт/лонг между выбранными биржами по разнице ставок"""
+    chat_id = update.effective_chat.id
+    ensure_user_settings(chat_id, update.effective_user.id)
+    settings = user_settings[chat_id]['settings']
+
+    if update.callback_query:
+        await update.callback_query.answer()
+        msg = update.callback_query.message
+    else:
+        msg = await update.message.reply_text("🔄 Считаю спреды...")
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Обновить", callback_data="spreads")],
+        [InlineKeyboardButton("⬅️ Назад к топу", callback_data="back_to_top")],
+    ])
+
+    if len(settings['exchanges']) < 2:
+        await msg.edit_text("↔️ Для спредов выберите в фильтрах хотя бы две биржи.", reply_markup=keyboard)
+        return
+
+    await fetch_all_data(context)
+    engine = get_spread_engine(settings)
+    engine.update(snapshot_cache.columns)
+    pairs = engine.top()
+    if not pairs:
+        await msg.edit_text("😞 Нет монет, которые торгуются сразу на нескольких выбранных биржах.", reply_markup=keyboard)
+        return
+
+    now_utc = datetime.now(timezone.utc)
+    def leg_time(item: FundingRecord) -> str:
+        funding_dt = datetime.fromtimestamp(item.next_funding_time / 1000, tz=timezone.utc)
+        return funding_dt.astimezone(MSK_TIMEZONE).strftime('%H:%M') + format_countdown(item.next_funding_time, now_utc)
+    def leg_interval(item: FundingRecord) -> str:
+        hours = item.funding_interval_hours
+        return f"/{hours:g}ч" if hours else f"/{FUNDING_DEFAULT_INTERVAL_HOURS}ч?"
+
+    message_text = f"↔️ **ТОП-{len(pairs)} межбиржевых спредов**\n\n"
+    for pair in pairs:
+        volume_str = format_volume(pair.min_volume) if pair.min_volume else "н/д"
+        message_text += f"**{pair.symbol.replace('USDT', '')}** спред `{pair.hourly_spread * 100:.4f}%`/ч | объем слабой ноги: {volume_str}\n"
+        message_text += f"  🔴 шорт {pair.short.exchange} `{pair.short.rate * 100:+.3f}%` {leg_interval(pair.short)} 🕒 {leg_time(pair.short)}\n"
+        message_text += f"  🟢 лонг {pair.long.exchange} `{pair.long.rate * 100:+.3f}%` {leg_interval(pair.long)} 🕒 {leg_time(pair.long)}\n\n"
+    message_text += "💡 _Спред приведен к часу по интервалам выплат бирж; порядок учитывает объем слабой ноги и время до выплат_"
+    await msg.edit_text(message_text, reply_markup=keyboard, parse_mode='Markdown')
+
 # ===== НОВАЯ ФУНКЦИЯ: ИИ-АНАЛИЗ =====
 async def show_ai_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -1458,8 +3155,8 @@ async def show_ai_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     def format_group(title, items):
         text = f"{title}\n"
         for item in items:
-            rec = item['smart_recommendation']
-            text += f"{rec['emoji']} **{item['symbol'].replace('USDT','')}** `{item['rate']*100:+.2f}%` - {rec['message']} ({rec['confidence']:.0%})\n"
+            rec, record = item['smart_recommendation'], item['record']
+            text += f"{rec['emoji']} **{record.symbol.replace('USDT','')}** `{record.rate*100:+.2f}%` - {rec['message']} ({rec['confidence']:.0%})\n"
         return text + "\n"
 
     if groups['strong']: message_text += format_group("🚀 **ПРИОРИТЕТНЫЕ СИГНАЛЫ:**", groups['strong'])
@@ -1468,7 +3165,7 @@ async def show_ai_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     message_text += "💡 *Нажмите на монету для детального плана*"
     
-    coin_buttons = [InlineKeyboardButton(f"{item['smart_recommendation']['emoji']} {item['symbol'].replace('USDT','')}", callback_data=f"ai_detail_{item['symbol']}") for item in opportunities]
+    coin_buttons = [InlineKeyboardButton(f"{item['smart_recommendation']['emoji']} {item['record'].symbol.replace('USDT','')}", callback_data=f"ai_detail_{item['record'].symbol}") for item in opportunities]
     button_rows = [coin_buttons[i:i + 2] for i in range(0, len(coin_buttons), 2)]
     button_rows.append([InlineKeyboardButton("⬅️ Назад к топу", callback_data="back_to_top")])
     
@@ -1488,7 +3185,7 @@ async def show_ai_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     opportunities = context.user_data.get('current_opportunities', [])
-    target_item = next((item for item in opportunities if item['symbol'] == symbol_to_analyze), None)
+    target_item = next((item['record'] for item in opportunities if item['record'].symbol == symbol_to_analyze), None)
     
     if not target_item:
         await query.edit_message_text("❌ Монета не найдена.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="ai_analysis")]]))
@@ -1501,8 +3198,8 @@ async def show_ai_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     analysis = analyzed_item['enhanced_analysis']
     
     message_text = f"🧠 **Торговый анализ: {symbol_only}**\n\n"
-    direction_emoji = "🟢" if target_item['rate'] < 0 else "🔴"
-    message_text += f"{direction_emoji} **Ставка:** {target_item['rate'] * 100:+.3f}%\n"
+    direction_emoji = "🟢" if target_item.rate < 0 else "🔴"
+    message_text += f"{direction_emoji} **Ставка:** {target_item.rate * 100:+.3f}%\n"
     message_text += f"{smart_rec['emoji']} **{smart_rec['message'].upper()}**\n"
     message_text += f"_{analysis.get('recommendation', smart_rec['details'])}_\n\n"
     
@@ -1552,13 +3249,12 @@ async def drill_down_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     if symbol_to_show in all_symbol_data:
         symbol_data = all_symbol_data[symbol_to_show]
     else:
-        all_data = api_data_cache.get("data", [])
-        if not all_data:
+        if not snapshot_cache.data:
             await query.edit_message_text("🔄 Обновляю данные...")
-            all_data = await fetch_all_data(context, force_update=True)
-        symbol_data = [item for item in all_data if item['symbol'] == symbol_to_show]
+            await fetch_all_data(context)
+        symbol_data = snapshot_cache.columns.records_for_symbol(symbol_to_show)
     
-    symbol_data = sorted(symbol_data, key=lambda x: abs(x['rate']), reverse=True)
+    symbol_data = sorted(symbol_data, key=lambda x: abs(x.rate), reverse=True)
     symbol_only = symbol_to_show.replace("USDT", "")
     if not symbol_data:
         await query.edit_message_text(f"❌ Данные по {symbol_only} не найдены.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_top")]]))
@@ -1571,21 +3267,20 @@ async def drill_down_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         analyzed_item = await analyze_funding_opportunity(item)
         smart_rec = analyzed_item['smart_recommendation']
         
-        funding_dt_utc = datetime.fromtimestamp(item['next_funding_time'] / 1000, tz=timezone.utc)
+        funding_dt_utc = datetime.fromtimestamp(item.next_funding_time / 1000, tz=timezone.utc)
         time_left = funding_dt_utc - now_utc
         countdown_str = ""
         if time_left.total_seconds() > 0:
             h, m = divmod(int(time_left.total_seconds()) // 60, 60)
             countdown_str = f" (осталось {h}ч {m}м)"
         
-        direction = "🟢 ЛОНГ" if item['rate'] < 0 else "🔴 ШОРТ"
-        rate_str = f"{item['rate'] * 100:+.2f}%"
+        direction = "🟢 ЛОНГ" if item.rate < 0 else "🔴 ШОРТ"
+        rate_str = f"{item.rate * 100:+.2f}%"
         time_str = funding_dt_utc.astimezone(MSK_TIMEZONE).strftime('%H:%M МСК')
-        vol = item.get('volume_24h_usdt', Decimal('0'))
-        vol_str = format_volume(vol)
+        vol_str = format_volume(item.volume_24h_usdt)
         confidence_str = f" ({smart_rec['confidence']:.0%})" if smart_rec['confidence'] > 0 else ""
         
-        message_text += f"{direction} `{rate_str}` в `{time_str}{countdown_str}` [{item['exchange']}]({item['trade_url']})\n"
+        message_text += f"{direction} `{rate_str}` в `{time_str}{countdown_str}` [{item.exchange}]({item.trade_url})\n"
         message_text += f"  *Объем 24ч:* `{vol_str} USDT`\n"
         message_text += f"  {smart_rec['emoji']} *Сигнал:* _{smart_rec['message']}{confidence_str}_\n\n"
 
@@ -2046,14 +3741,152 @@ async def alert_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer()
 
 # ===== ИСПРАВЛЕННЫЙ ФОНОВЫЙ СКАНЕР =====
+# ===== ИНДЕКС ПРАВИЛ УВЕДОМЛЕНИЙ =====
+class AlertIndex:
+    """
+    Обратный индекс правил обычных уведомлений: биржа -> окна до выплаты (по возрастанию) ->
+    пороги ставки (по возрастанию) с чатами. Подписчики инструмента находятся бинарным поиском,
+    поэтому проход по снимку не зависит от числа чатов. Индекс перестраивается, только когда
+    меняются правила (настройки, включение уведомлений или доступ).
+    """
+
+    def __init__(self):
+        self.rules: Tuple = ()
+        self.by_exchange: Dict[str, Tuple[List[int], List[Tuple[List[float], List[int]]]]] = {}
+        self.min_threshold = float('inf')
+        self.max_window_ms = 0
+
+    @staticmethod
+    def collect_rules() -> Tuple:
+        """(chat_id, биржи, порог, окно в мс) всех чатов с включенными уведомлениями и доступом"""
+        rules = []
+        for chat_id, user_data in list(user_settings.items()):
+            settings = user_data['settings']
+            if not settings.get('alerts_on', False): continue
+            stored_user_id = user_data.get('user_id')
+            if not stored_user_id or not check_access(stored_user_id): continue
+            target_exchanges = settings.get('alert_exchanges', []) or settings.get('exchanges', [])
+            rules.append((chat_id, tuple(target_exchanges), float(settings['alert_rate_threshold']),
+                          settings['alert_time_window_minutes'] * 60 * 1000))
+        return tuple(rules)
+
+    def refresh(self):
+        rules = self.collect_rules()
+        if rules == self.rules:
+            return
+        grouped: Dict[str, Dict[int, List[Tuple[float, int]]]] = {}
+        for chat_id, exchanges, threshold, window_ms in rules:
+            for name in dict.fromkeys(exchanges):
+                grouped.setdefault(name, {}).setdefault(window_ms, []).append((threshold, chat_id))
+        self.by_exchange = {}
+        for name, windows in grouped.items():
+            buckets = []
+            for window_ms in sorted(windows):
+                entries = sorted(windows[window_ms], key=lambda entry: entry[0])
+                buckets.append(([threshold for threshold, _ in entries], [chat_id for _, chat_id in entries]))
+            self.by_exchange[name] = (sorted(windows), buckets)
+        self.rules = rules
+        self.min_threshold = min((rule[2] for rule in rules), default=float('inf'))
+        self.max_window_ms = max((rule[3] for rule in rules), default=0)
+        print(f"[BG_SCANNER] Индекс уведомлений перестроен: {len(rules)} чатов, {len(self.by_exchange)} бирж")
+
+    def subscribers(self, exchange: str, abs_rate: float, time_left_ms: int) -> List[int]:
+        """Чаты, у которых |ставка| >= порога и 0 < времени до выплаты <= окна"""
+        if time_left_ms <= 0 or exchange not in self.by_exchange:
+            return []
+        windows, buckets = self.by_exchange[exchange]
+        matched = []
+        for thresholds, chat_ids in buckets[bisect.bisect_left(windows, time_left_ms):]:
+            matched.extend(chat_ids[:bisect.bisect_right(thresholds, abs_rate)])
+        return matched
+
+alert_index = AlertIndex()
+
+# ===== ОБЩИЙ ИИ-АНАЛИЗ ЦИКЛА СКАНЕРА =====
+AI_ANALYSIS_CONCURRENCY = 8  # одновременных анализов (промах кэша истории = HTTP-запрос к бирже)
+
+class CycleAnalysis:
+    """
+    Таблица результатов анализа для одного снимка: (биржа, монета) -> анализ.
+    Каждая пара анализируется один раз на версию снимка, а фильтры ИИ-сигналов всех чатов
+    читают готовый результат - стоимость анализа не растет с числом подписанных чатов.
+    Истории загружаются параллельно, а классифицируются одним пакетом (analyze_history_batch).
+    """
+
+    def __init__(self):
+        self.version = -1
+        self.results: Dict[Tuple[str, str], Dict] = {}
+
+    async def ensure(self, records: List[FundingRecord], version: int):
+        if version != self.version:
+            self.version, self.results = version, {}
+        missing: Dict[Tuple[str, str], FundingRecord] = {}
+        for item in records:
+            if (item.exchange, item.symbol) not in self.results:
+                missing.setdefault((item.exchange, item.symbol), item)
+        if not missing:
+            return
+        semaphore = asyncio.Semaphore(AI_ANALYSIS_CONCURRENCY)
+        # у бирж без истории анализ сразу дает "мало данных" - задачи загрузки для них не создаем
+        histories: Dict[Tuple[str, str], List[Decimal]] = {key: [] for key in missing if key[0].upper() not in HISTORY_EXCHANGES}
+
+        async def load(key: Tuple[str, str], item: FundingRecord):
+            async with semaphore:
+                try:
+                    histories[key] = await enhanced_funding_analyzer._get_funding_history_real(
+                        item.symbol, item.exchange, next_funding_time=item.next_funding_time)
+                except Exception as e:
+                    print(f"[AI_SIGNALS] ❌ Ошибка загрузки истории {item.exchange} {item.symbol}: {e!r}")
+
+        started = time.monotonic()
+        await asyncio.gather(*(load(key, item) for key, item in missing.items() if key not in histories))
+        loaded = [(key, item) for key, item in missing.items() if key in histories]
+        analyses = enhanced_funding_analyzer.analyze_history_batch(
+            [histories[key] for key, _ in loaded], [Decimal(repr(item.rate)) for _, item in loaded])
+        for (key, item), analysis in zip(loaded, analyses):
+            self.results[key] = describe_funding_analysis(item, analysis)
+        print(f"[AI_SIGNALS] Проанализировано {len(loaded)} инструментов за {time.monotonic() - started:.1f}с")
+
+    def get(self, item: FundingRecord) -> Optional[Dict]:
+        return self.results.get((item.exchange, item.symbol))
+
+cycle_analysis = CycleAnalysis()
+
 async def background_scanner(app: Application):
     print("🚀 Фоновый сканер уведомлений запущен.")
     while True:
         await asyncio.sleep(60)
         try:
+            # Сканер - основной поставщик снимка: после его обновления обработчики пользователей берут данные из кэша
             all_data = await fetch_all_data(app, force_update=True)
             if not all_data: continue
+            columns = snapshot_cache.columns
+            prune_spread_engines()
+            for engine in spread_engines.values():
+                engine.update(columns)
             now_utc, current_ts_ms = datetime.now(timezone.utc), int(datetime.now(timezone.utc).timestamp() * 1000)
+
+            # Один проход по снимку: кандидаты отсекаются векторно по самому мягкому правилу,
+            # подписчики каждого кандидата - бинарным поиском по индексу
+            alert_index.refresh()
+            alerts_by_chat: Dict[int, List[FundingRecord]] = {}
+            if alert_index.rules:
+                candidates = np.flatnonzero((columns.abs_rate >= alert_index.min_threshold)
+                                            & columns.funding_window_mask(current_ts_ms, alert_index.max_window_ms))
+                for row, abs_rate in zip(candidates.tolist(), columns.abs_rate[candidates].tolist()):
+                    item = columns.records[row]
+                    for chat_id in alert_index.subscribers(item.exchange, abs_rate, item.next_funding_time - current_ts_ms):
+                        alerts_by_chat.setdefault(chat_id, []).append(item)
+
+            # ИИ-анализ - один раз на инструмент для объединения бирж всех подписанных чатов
+            ai_exchanges = set()
+            for user_data in list(user_settings.values()):
+                settings = user_data['settings']
+                stored_user_id = user_data.get('user_id')
+                if settings.get('ai_signals_on', False) and stored_user_id and check_access(stored_user_id):
+                    ai_exchanges.update(settings.get('alert_exchanges', []) or settings.get('exchanges', []))
+            if ai_exchanges:
+                await cycle_analysis.ensure(columns.take(np.flatnonzero(columns.exchange_mask(list(ai_exchanges)))), snapshot_cache.version)
             
             for chat_id, user_data in list(user_settings.items()):
                 stored_user_id = user_data.get('user_id')
@@ -2065,18 +3898,15 @@ async def background_scanner(app: Application):
                 # --- Блок ОБЫЧНЫХ УВЕДОМЛЕНИЙ (без изменений) ---
                 if settings.get('alerts_on', False):
                     settings['sent_notifications'] = {nid for nid in settings.get('sent_notifications', set()) if int(nid.split('_')[-1]) > current_ts_ms - (3 * 60 * 60 * 1000)}
-                    for item in all_data:
-                        if item['exchange'] not in target_exchanges: continue
-                        if abs(item['rate']) < settings['alert_rate_threshold']: continue
-                        time_left_seconds = (item['next_funding_time'] / 1000) - now_utc.timestamp()
-                        if not (0 < time_left_seconds <= settings['alert_time_window_minutes'] * 60): continue
-                        notification_id = f"{item['exchange']}_{item['symbol']}_{item['next_funding_time']}"
+                    for item in alerts_by_chat.get(chat_id, []):
+                        time_left_seconds = (item.next_funding_time / 1000) - now_utc.timestamp()
+                        notification_id = f"{item.exchange}_{item.symbol}_{item.next_funding_time}"
                         if notification_id in settings['sent_notifications']: continue
                         h, m = divmod(int(time_left_seconds // 60), 60)
                         countdown_str = f"{h}ч {m}м" if h > 0 else f"{m}м"
                         message = (f"⚠️ **Найден фандинг по вашему фильтру!**\n\n"
-                                   f"{'🟢' if item['rate'] < 0 else '🔴'} **{item['symbol'].replace('USDT', '')}** `{item['rate'] * 100:+.2f}%`\n"
-                                   f"⏰ Выплата через *{countdown_str}* на *{item['exchange']}*")
+                                   f"{'🟢' if item.rate < 0 else '🔴'} **{item.symbol.replace('USDT', '')}** `{item.rate * 100:+.2f}%`\n"
+                                   f"⏰ Выплата через *{countdown_str}* на *{item.exchange}*")
                         try:
                             await app.bot.send_message(chat_id, message, parse_mode='Markdown')
                             settings['sent_notifications'].add(notification_id)
@@ -2085,10 +3915,9 @@ async def background_scanner(app: Application):
                 # === НОВЫЙ БЛОК ИИ-СИГНАЛОВ ===
                 if settings.get('ai_signals_on', False):
                     settings['ai_sent_notifications'] = {nid for nid in settings.get('ai_sent_notifications', set()) if int(nid.split('_')[-1]) > current_ts_ms - (3 * 60 * 60 * 1000)} # Очистка старых
-                    for item in all_data:
-                        if item['exchange'] not in target_exchanges: continue
-                        
-                        analyzed_item = await analyze_funding_opportunity(item)
+                    for item in columns.take(np.flatnonzero(columns.exchange_mask(target_exchanges))):
+                        analyzed_item = cycle_analysis.get(item)
+                        if analyzed_item is None: continue
                         smart_rec = analyzed_item.get('smart_recommendation', {})
                         signal_type = smart_rec.get('recommendation_type', '')
                         
@@ -2104,20 +3933,20 @@ async def background_scanner(app: Application):
                         if confidence < settings.get('ai_confidence_threshold', Decimal('0.6')):
                             continue
                             
-                        ai_notification_id = f"AI_{item['exchange']}_{item['symbol']}_{signal_type}_{current_ts_ms}"
-                        if any(nid.startswith(f"AI_{item['exchange']}_{item['symbol']}") for nid in settings.get('ai_sent_notifications', set())):
+                        ai_notification_id = f"AI_{item.exchange}_{item.symbol}_{signal_type}_{current_ts_ms}"
+                        if any(nid.startswith(f"AI_{item.exchange}_{item.symbol}") for nid in settings.get('ai_sent_notifications', set())):
                             continue # Анти-спам: не отправлять повторно по той же монете, пока старый не истечет
                             
                         message = (f"🧠 **ИИ ТОРГОВЫЙ СИГНАЛ!**\n\n"
-                                   f"{smart_rec.get('emoji', '❓')} **{smart_rec.get('message', '')}** по **{item['symbol'].replace('USDT', '')}**\n"
+                                   f"{smart_rec.get('emoji', '❓')} **{smart_rec.get('message', '')}** по **{item.symbol.replace('USDT', '')}**\n"
                                    f"Уверенность: **{confidence:.0%}**\n\n"
                                    f"💡 _{smart_rec.get('details', '')}_\n\n"
-                                   f"📊 Биржа: *{item['exchange']}* | Ставка: `{item['rate'] * 100:+.2f}%`")
+                                   f"📊 Биржа: *{item.exchange}* | Ставка: `{item.rate * 100:+.2f}%`")
                         
                         try:
                             await app.bot.send_message(chat_id, message, parse_mode='Markdown')
                             settings['ai_sent_notifications'].add(ai_notification_id)
-                            print(f"[AI_SIGNALS] ✅ Отправлен ИИ-сигнал для chat_id {chat_id}: {signal_type} {item['symbol']}")
+                            print(f"[AI_SIGNALS] ✅ Отправлен ИИ-сигнал для chat_id {chat_id}: {signal_type} {item.symbol}")
                         except Exception as e:
                             print(f"[AI_SIGNALS] ❌ Ошибка отправки ИИ-сигнала для chat_id {chat_id}: {e}")
         except Exception as e:
@@ -2135,30 +3964,56 @@ async def handle_unauthorized_message(update: Update, context: ContextTypes.DEFA
         "🤖 Используйте кнопки меню или команду /start для начала работы."
     )
 
-    # Отправляем файл с фандингом
-    if funding_data:
-        df_funding = pd.DataFrame(funding_data)
-        json_buffer = io.StringIO()
-        df_funding.to_json(json_buffer, orient="records", indent=4)
-        json_buffer.seek(0)
-        await context.bot.send_document(
-            chat_id=user_id,
-            document=io.BytesIO(json_buffer.read().encode()),
-            filename="funding_history.json"
-        )
+# ===== ВЫГРУЗКА ИСТОРИИ ДЛЯ АНАЛИЗА =====
+# Фандинг и минутные свечи MEXC сохраняются в колоночное хранилище market_store
+# (дневные партиции .npy), пользователю уходит выбранный диапазон в том же формате:
+# np.load(файл) сразу дает массив с колонками timestamp/open/high/low/close/volume или timestamp/rate.
+# С флагом csv - CSV, сжатый gzip. Файлы собираются из партиций в отдельном потоке сразу в bytes:
+# PTB все равно читает документ в память целиком (InputFile), а так чтение не попадает в event loop.
+# Диапазон ограничен EXPORT_MAX_DAYS - неделя минутных свечей меньше мегабайта.
+EXPORT_MAX_DAYS = 7
+market_store = MarketStore(MARKET_STORE_PATH)
+
+def save_export(mexc_symbol: str, funding: List[Dict], start_ms: int, end_ms: int, as_csv: bool = False) -> List[Tuple[str, bytes]]:
+    """Дописывает фандинг в хранилище и собирает файлы диапазона (выполняется в потоке)"""
+    market_store.append('funding', 'MEXC', mexc_symbol, [(r['settleTime'], r['fundingRate']) for r in funding])
+    files = []
+    for kind in ('funding', 'klines_1m'):
+        file = io.BytesIO()
+        if as_csv:
+            rows, filename = market_store.write_csv_gz(file, kind, 'MEXC', mexc_symbol, start_ms, end_ms), f"{mexc_symbol}_{kind}.csv.gz"
+        else:
+            rows, filename = market_store.write_npy(file, kind, 'MEXC', mexc_symbol, start_ms, end_ms), f"{mexc_symbol}_{kind}.npy"
+        if rows:
+            files.append((filename, file.getvalue()))
+    return files
 
-    # Отправляем файл со свечами
-    if kline_data:
-        df_klines = pd.DataFrame(kline_data, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        json_buffer = io.StringIO()
-        df_klines.to_json(json_buffer, orient="records", indent=4)
-        json_buffer.seek(0)
-        await context.bot.send_document(
-            chat_id=user_id,
-            document=io.BytesIO(json_buffer.read().encode()),
-            filename="klines_1m.json"
-        )
-    
+@require_access()
+async def export_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Выгрузка истории фандинга и минутных свечей MEXC за последние дни
+    """
+    args = context.args
+    if not args:
+        await update.message.reply_text(f"Использование: `/export СИМВОЛ [ДНЕЙ] [csv]`\nПример: `/export MYX 3 csv` (не больше {EXPORT_MAX_DAYS} дней)", parse_mode='Markdown')
+        return
+
+    symbol = symbol_index.resolve(args[0])
+    mexc_symbol = symbol_index.native(symbol, 'MEXC') or symbol.replace('USDT', '_USDT')
+    days = min(int(args[1]), EXPORT_MAX_DAYS) if len(args) > 1 and args[1].isdigit() and int(args[1]) > 0 else 1
+    as_csv = any(arg.lower() == 'csv' for arg in args[1:])
+    message = await update.message.reply_text(f"⏳ Собираю историю {mexc_symbol} за {days} дн...")
+
+    end_ms = int(time.time() * 1000)
+    start_ms = end_ms - days * 24 * 60 * 60 * 1000
+    funding, _ = await asyncio.gather(fetch_funding_history_async(mexc_symbol, start_ms, end_ms),
+                                      load_klines(mexc_symbol, start_ms, end_ms))
+    files = await asyncio.to_thread(save_export, mexc_symbol, funding, start_ms, end_ms, as_csv)
+    if not files:
+        await message.edit_text(f"❌ MEXC не вернула данных по {mexc_symbol}.")
+        return
+    for filename, content in files:
+        await context.bot.send_document(chat_id=update.effective_user.id, document=content, filename=filename)
     await message.edit_text("Готово! Файлы отправлены вам в личку.")
 
 # =================================================================
@@ -2174,19 +4029,23 @@ async def get_funding_history_command(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text("Использование: `/history СИМВОЛ [БИРЖА]`\nПример: `/history API3USDT MEXC`", parse_mode='Markdown')
         return
     
-    symbol = args[0].upper()
-    if not symbol.endswith('USDT'): symbol += 'USDT'
+    symbol = symbol_index.resolve(args[0])
     exchange = args[1].upper() if len(args) > 1 else None
     exchanges_to_check = [exchange] if exchange else ['MEXC', 'BYBIT']
     
     message = await update.message.reply_text(f"🔍 Получаю историю для {symbol}...")
     
+    next_funding = {item.exchange.upper(): item.next_funding_time for item in snapshot_cache.columns.records_for_symbol(symbol)}
     report_text = f"📊 **История Funding Rate: {symbol.replace('USDT', '')}**\n\n"
     for ex in exchanges_to_check:
-        history = await enhanced_funding_analyzer._get_funding_history_real(symbol, ex)
-        if history:
-            report_text += f"**{ex}** ({len(history)} периодов):\n"
-            for rate in history[-10:]:
+        # Синхронизация идет в сеть только если с прошлого раза была выплата; сама история - из хранилища
+        await enhanced_funding_analyzer._get_funding_history_real(symbol, ex, next_funding_time=next_funding.get(ex))
+        count, first = await asyncio.to_thread(history_store.summary, ex, symbol)
+        if count:
+            rates = await asyncio.to_thread(history_store.recent, ex, symbol, 10)
+            since = datetime.fromtimestamp(first / 1000, tz=timezone.utc).astimezone(MSK_TIMEZONE).strftime('%d.%m.%Y')
+            report_text += f"**{ex}** ({count} периодов с {since}):\n"
+            for rate in rates:
                 report_text += f"`{float(rate) * 100:+.3f}%` "
             report_text += "\n\n"
     
@@ -2202,26 +4061,25 @@ async def quick_signal_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Использование: `/signal СИМВОЛ [БИРЖА]`\nПример: `/signal API3`", parse_mode='Markdown')
         return
     
-    symbol = args[0].upper()
-    if not symbol.endswith('USDT'): symbol += 'USDT'
+    symbol = symbol_index.resolve(args[0])
     exchange = args[1].upper() if len(args) > 1 else None
     
     message = await update.message.reply_text(f"🧠 Анализирую сигнал для {symbol}...")
     
-    all_data = await fetch_all_data(context, force_update=True)
-    target_items = [item for item in all_data if item['symbol'] == symbol]
-    if exchange: target_items = [item for item in target_items if item['exchange'].upper() == exchange]
+    await fetch_all_data(context)
+    target_items = snapshot_cache.columns.records_for_symbol(symbol)
+    if exchange: target_items = [item for item in target_items if item.exchange.upper() == exchange]
     
     if not target_items:
         await message.edit_text(f"❌ Не найдены данные для {symbol}.")
         return
         
-    best_item = max(target_items, key=lambda x: abs(x['rate']))
+    best_item = max(target_items, key=lambda x: abs(x.rate))
     analyzed_item = await analyze_funding_opportunity(best_item)
     smart_rec = analyzed_item['smart_recommendation']
     
-    report = f"🎯 **Сигнал: {symbol.replace('USDT', '')}** ({best_item['exchange']})\n\n"
-    report += f"**Ставка:** `{best_item['rate'] * 100:+.3f}%`\n"
+    report = f"🎯 **Сигнал: {symbol.replace('USDT', '')}** ({best_item.exchange})\n\n"
+    report += f"**Ставка:** `{best_item.rate * 100:+.3f}%`\n"
     report += f"{smart_rec['emoji']} **{smart_rec['message'].upper()}**\n"
     report += f"_{smart_rec['details']} ({smart_rec['confidence']:.0%})_\n"
     await message.edit_text(report, parse_mode='Markdown')
@@ -2287,6 +4145,7 @@ if __name__ == "__main__":
     regular_handlers = [
         CommandHandler("start", start),
         MessageHandler(filters.Regex("^🔥 Топ-ставки сейчас$"), show_top_rates),
+        MessageHandler(filters.Regex("^↔️ Спреды между биржами$"), show_spreads),
         MessageHandler(filters.Regex("^🔧 Настроить фильтры$"), filters_menu_entry),
         MessageHandler(filters.Regex("^ℹ️ Мои настройки$"), show_my_settings),
         MessageHandler(filters.Regex("^🔧 Диагностика API$"), api_diagnostics),
@@ -2294,6 +4153,8 @@ if __name__ == "__main__":
         CallbackQueryHandler(filters_callback_handler, pattern="^filters_"),
         CallbackQueryHandler(drill_down_callback, pattern="^drill_"),
         CallbackQueryHandler(back_to_top_callback, pattern="^back_to_top$"),
+        CallbackQueryHandler(show_top_page, pattern="^top_page_\\d+$"),
+        CallbackQueryHandler(show_spreads, pattern="^spreads$"),
         CallbackQueryHandler(exchanges_callback_handler, pattern="^exch_"),
         CallbackQueryHandler(show_alerts_menu, pattern="^alert_show_menu$"),
         # ИСПРАВЛЕННЫЕ обработчики уведомлений
@@ -2316,13 +4177,22 @@ if __name__ == "__main__":
     app.add_handlers(conv_handlers)
     app.add_handlers(regular_handlers)
     app.add_handler(CommandHandler("history", get_funding_history_command))
+    app.add_handler(CommandHandler("export", export_history_command))
     app.add_handler(CommandHandler("signal", quick_signal_command))
+    app.add_handler(CommandHandler("spreads", show_spreads))
 
-    # 4. Запуск фонового сканера
+    # 4. Запуск фонового сканера и общего HTTP-клиента
     async def post_init(app):
+        get_http_session()
+        start_exchange_streams()
         asyncio.create_task(background_scanner(app))
 
+    async def post_shutdown(app):
+        await stop_exchange_streams()
+        await close_http_session()
+
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
 
     # 5. Запускаем бота
     print("🤖 RateHunter 2.0 с ИИ-анализатором запущен с ограничением доступа!")
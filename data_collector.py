@@ -1,7 +1,15 @@
 # data_collector.py
+import os
+import json
+import time
+import asyncio
+import argparse
+import aiohttp
 import requests
-import pandas as pd
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from market_store import MarketStore, DEFAULT_ROOT
 
 # --- НАСТРОЙКИ ---
 SYMBOL = "MYX_USDT"  # Монета, которую анализируем. Можешь поменять на любую другую.
@@ -23,8 +31,10 @@ def fetch_funding_history(symbol, start_time, end_time):
         response.raise_for_status()
         data = response.json()
         if data.get("success"):
-            print(f"✅ Успешно получено {len(data.get('data', []))} записей о фандинге.")
-            return data.get('data', [])
+            records = data.get('data', {}).get('resultList', [])
+            records = [r for r in records if start_time <= r['settleTime'] <= end_time]
+            print(f"✅ Успешно получено {len(records)} записей о фандинге.")
+            return records
         else:
             print(f"❌ Ошибка API MEXC (фандинг): {data.get('message')}")
             return []
@@ -32,55 +42,233 @@ def fetch_funding_history(symbol, start_time, end_time):
         print(f"❌ Сетевая ошибка (фандинг): {e}")
         return []
 
-def fetch_klines(symbol, start_time, end_time):
-    """Получает 1-минутные свечи с MEXC."""
-    print(f"Запрашиваю 1-минутные свечи для {symbol} (это может занять некоторое время)...")
-    url = f"https://contract.mexc.com/api/v1/contract/kline/{symbol}"
-    all_klines = []
-    current_time = start_time
-    
-    # API MEXC отдает до 1000 свечей за раз. 
-    # За сутки 1440 минутных свечей, поэтому нужно сделать 2 запроса.
-    while current_time < end_time:
-        params = {
-            'symbol': symbol,
-            'interval': 'Min1',
-            'start': int(current_time / 1000),
-            'end': int(end_time / 1000)
-        }
+KLINE_PAGE_MINUTES = 1000  # MEXC отдает до 1000 свечей за запрос
+KLINE_WORKERS = 4
+
+def kline_windows(start_ms, end_ms):
+    """Делит [start_ms, end_ms] на окна по странице MEXC - их можно качать параллельно"""
+    window_ms = KLINE_PAGE_MINUTES * 60000
+    first = start_ms - start_ms % 60000
+    return [(ws, min(ws + window_ms - 60000, end_ms)) for ws in range(first, end_ms, window_ms)]
+
+def merge_klines(parts, start_ms, end_ms):
+    """Склеивает окна, убирая повторы по timestamp"""
+    by_time = {k[0]: k for part in parts for k in part if start_ms <= k[0] <= end_ms}
+    return [by_time[t] for t in sorted(by_time)]
+
+def fetch_kline_window(url, symbol, start_ms, end_ms, retries=2):
+    """Свечи одного окна; недокачанный хвост дозапрашивается, ошибки повторяются"""
+    klines, current, attempt = [], start_ms, 0
+    while current <= end_ms:
+        params = {'symbol': symbol, 'interval': 'Min1', 'start': current // 1000, 'end': end_ms // 1000}
         try:
             response = requests.get(url, params=params, timeout=20)
             response.raise_for_status()
             data = response.json()
-            if data.get("success"):
-                klines = data.get('data', {})
-                if klines.get('time'):
-                    # Собираем данные в удобный формат
-                    for i in range(len(klines['time'])):
-                        all_klines.append([
-                            klines['time'][i] * 1000, # Приводим к миллисекундам
-                            klines['open'][i],
-                            klines['high'][i],
-                            klines['low'][i],
-                            klines['close'][i],
-                            klines['vol'][i]
-                        ])
-                    # Сдвигаем время для следующего запроса
-                    last_time = klines['time'][-1] * 1000
-                    current_time = last_time + 60000 # +1 минута
-                else:
-                    break # Данных больше нет
-            else:
-                print(f"❌ Ошибка API MEXC (свечи): {data.get('message')}")
+            if not data.get("success"):
+                raise RuntimeError(f"Ошибка API MEXC (свечи): {data.get('message')}")
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            if attempt >= retries:
+                print(f"❌ Окно {start_ms}..{end_ms} не получено: {e}")
                 break
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Сетевая ошибка (свечи): {e}")
+            attempt += 1
+            time.sleep(attempt)
+            continue
+        page = data.get('data', {})
+        if not page.get('time'):
+            break  # Данных больше нет
+        klines.extend([t * 1000, o, h, l, c, v] for t, o, h, l, c, v in
+                      zip(page['time'], page['open'], page['high'], page['low'], page['close'], page['vol']))
+        if page['time'][-1] * 1000 < current:
             break
-            
+        current = page['time'][-1] * 1000 + 60000  # +1 минута
+    return klines
+
+def fetch_klines(symbol, start_time, end_time):
+    """Получает 1-минутные свечи с MEXC."""
+    print(f"Запрашиваю 1-минутные свечи для {symbol}...")
+    url = f"https://contract.mexc.com/api/v1/contract/kline/{symbol}"
+    # Окна по 1000 свечей независимы - качаем их параллельно вместо цепочки запросов
+    windows = kline_windows(start_time, end_time)
+    with ThreadPoolExecutor(max_workers=KLINE_WORKERS) as pool:
+        parts = list(pool.map(lambda w: fetch_kline_window(url, symbol, *w), windows))
+    all_klines = merge_klines(parts, start_time, end_time)
     print(f"✅ Успешно получено {len(all_klines)} минутных свечей.")
     return all_klines
 
-if __name__ == "__main__":
+# ===== ПАКЕТНЫЙ РЕЖИМ: МНОГО МОНЕТ ПАРАЛЛЕЛЬНО =====
+# python data_collector.py --symbols BTC_USDT,ETH_USDT --start 2024-05-01 --end 2024-06-01
+# python data_collector.py --all --min-volume 5000000 --days 30
+# Работа делится на единицы (фандинг монеты за весь период, свечи монеты за один день),
+# готовые единицы отмечаются в checkpoint.json - прерванный сбор продолжается с того же места.
+# Данные пишутся в колоночное хранилище market_store: <out>/MEXC/<монета>/<вид>/<день>.npy
+MEXC_CONTRACT_API = "https://contract.mexc.com/api/v1/contract"
+
+class RateLimiter:
+    """Не больше rate запросов в секунду на все задачи (публичный лимит MEXC - 20 запросов за 2 с)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class BatchCollector:
+    def __init__(self, out_dir: str, concurrency: int, rate: float, retries: int = 3):
+        self.out_dir = out_dir
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.store = MarketStore(out_dir)
+        self.checkpoint_path = os.path.join(out_dir, "checkpoint.json")
+        self.done = set()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.done = set(json.load(f))
+        self.session: aiohttp.ClientSession = None
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sorted(self.done), f)
+        os.replace(tmp_path, self.checkpoint_path)  # атомарно: файл не бывает недописанным
+
+    async def get(self, url: str, params: dict) -> dict:
+        """GET с лимитом запросов и повторами при сетевых ошибках, 429 и 5xx"""
+        for attempt in range(self.retries + 1):
+            await self.limiter.wait()
+            try:
+                async with self.session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=20)) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                    response.raise_for_status()
+                    data = await response.json(content_type=None)
+                    if not data.get("success"):
+                        raise RuntimeError(f"Ошибка API MEXC: {data.get('message')}")
+                    return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def list_symbols(self, min_volume: float) -> list:
+        """Все USDT-перпетуалы MEXC с оборотом за 24ч не ниже min_volume"""
+        data = await self.get(f"{MEXC_CONTRACT_API}/ticker", {})
+        tickers = [t for t in data.get("data", []) if t.get("symbol", "").endswith("_USDT")]
+        return sorted(t["symbol"] for t in tickers if float(t.get("amount24", 0)) >= min_volume)
+
+    async def collect_funding(self, symbol: str, start_ms: int, end_ms: int):
+        records, page = [], 1
+        while True:
+            data = (await self.get(f"{MEXC_CONTRACT_API}/funding_rate/history",
+                                   {"symbol": symbol, "page_num": page, "page_size": 100}))["data"]
+            result = data.get("resultList", [])
+            records.extend(r for r in result if start_ms <= r["settleTime"] <= end_ms)
+            # страницы идут от новых выплат к старым
+            if not result or result[-1]["settleTime"] < start_ms or page >= data.get("totalPage", 1):
+                break
+            page += 1
+        self.store.append('funding', 'MEXC', symbol, [(r["settleTime"], r["fundingRate"]) for r in records])
+        # как и у свечей, скачанный отрезок отмечается в coverage: другой --start/--end докачает только дыры
+        self.store.mark_covered('funding', 'MEXC', symbol, start_ms, min(end_ms, int(time.time() * 1000)))
+        return len(records)
+
+    async def collect_kline_window(self, symbol: str, start_ms: int, end_ms: int) -> list:
+        klines, current = [], start_ms
+        while current <= end_ms:
+            data = (await self.get(f"{MEXC_CONTRACT_API}/kline/{symbol}",
+                                   {"interval": "Min1", "start": current // 1000, "end": end_ms // 1000}))["data"]
+            if not data.get("time"):
+                break
+            klines.extend(zip((t * 1000 for t in data["time"]), data["open"], data["high"], data["low"], data["close"], data["vol"]))
+            if data["time"][-1] * 1000 < current:
+                break  # биржа не сдвинулась вперед - новых свечей нет
+            current = data["time"][-1] * 1000 + 60000
+        return klines
+
+    async def collect_klines_day(self, symbol: str, day_start_ms: int):
+        # окна дня качаются параллельно (темп держит общий RateLimiter); упавшее окно
+        # роняет всю единицу, и она повторится при следующем запуске - дыр в днях не бывает
+        day_end_ms = day_start_ms + 24 * 60 * 60 * 1000 - 1
+        parts = await asyncio.gather(*(self.collect_kline_window(symbol, *window)
+                                       for window in kline_windows(day_start_ms, day_end_ms)))
+        klines = merge_klines(parts, day_start_ms, day_end_ms)
+        self.store.append('klines_1m', 'MEXC', symbol, klines)
+        # день скачан целиком - бот (load_klines) не будет запрашивать его повторно
+        closed_until = int(time.time() * 1000) // 60000 * 60000 - 1
+        self.store.mark_covered('klines_1m', 'MEXC', symbol, day_start_ms, min(day_end_ms, closed_until))
+        return len(klines)
+
+    async def run_unit(self, unit: str, job):
+        if unit in self.done:
+            return
+        async with self.semaphore:
+            try:
+                count = await job()
+            except Exception as e:
+                print(f"❌ {unit}: {e!r} (будет повторено при следующем запуске)")
+                return
+        self.done.add(unit)
+        self.save_checkpoint()
+        print(f"✅ {unit}: {count} записей")
+
+    async def collect(self, symbols: list, start_ms: int, end_ms: int, with_klines: bool = True):
+        days = range(start_ms, end_ms, 24 * 60 * 60 * 1000)
+        units = []
+        for symbol in symbols:
+            gaps = self.store.missing('funding', 'MEXC', symbol, start_ms, end_ms)
+            if gaps:
+                # страницы идут от новых выплат к старым - недостающие куски качаются одним проходом
+                first, last = gaps[0][0], gaps[-1][1]
+                units.append((f"{symbol}:funding:{first}-{last}", lambda s=symbol, a=first, b=last: self.collect_funding(s, a, b)))
+            if with_klines:
+                for day_start in days:
+                    day = datetime.fromtimestamp(day_start / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+                    units.append((f"{symbol}:klines:{day}", lambda s=symbol, d=day_start: self.collect_klines_day(s, d)))
+        pending = [(unit, job) for unit, job in units if unit not in self.done]
+        print(f"--- {len(symbols)} монет, {len(units)} единиц работы, осталось {len(pending)} ---")
+        started = time.monotonic()
+        await asyncio.gather(*(self.run_unit(unit, job) for unit, job in pending))
+        left = sum(1 for unit, _ in units if unit not in self.done)
+        print(f"--- Готово за {time.monotonic() - started:.0f}с, не удалось: {left} ---")
+
+async def run_batch(args):
+    os.makedirs(args.out, exist_ok=True)
+    start = datetime.strptime(args.start, "%Y-%m-%d").replace(tzinfo=timezone.utc) if args.start else None
+    end = datetime.strptime(args.end, "%Y-%m-%d").replace(tzinfo=timezone.utc) if args.end else \
+        datetime.combine(datetime.utcnow().date(), datetime.min.time(), tzinfo=timezone.utc)
+    start = start or end - timedelta(days=args.days)
+    collector = BatchCollector(args.out, args.concurrency, args.rate)
+    async with aiohttp.ClientSession() as session:
+        collector.session = session
+        symbols = args.symbols.split(",") if args.symbols else await collector.list_symbols(args.min_volume)
+        await collector.collect(symbols, int(start.timestamp() * 1000), int(end.timestamp() * 1000) - 1, not args.no_klines)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сбор истории фандинга и минутных свечей MEXC")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--symbols", help="монеты через запятую, например BTC_USDT,ETH_USDT")
+    target.add_argument("--all", action="store_true", help="все USDT-перпетуалы MEXC с оборотом не ниже --min-volume")
+    parser.add_argument("--min-volume", type=float, default=1_000_000, help="минимальный оборот за 24ч, USDT (для --all)")
+    parser.add_argument("--start", help="начало периода, YYYY-MM-DD (UTC)")
+    parser.add_argument("--end", help="конец периода, не включая, YYYY-MM-DD (UTC); по умолчанию сегодня")
+    parser.add_argument("--days", type=int, default=DAYS_AGO, help="длина периода, если не задан --start")
+    parser.add_argument("--out", default=DEFAULT_ROOT,
+                        help="корень хранилища market_store и папка checkpoint.json (по умолчанию общий с ботом и backtester.py: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных единиц работы")
+    parser.add_argument("--rate", type=float, default=8.0, help="запросов в секунду к MEXC")
+    parser.add_argument("--no-klines", action="store_true", help="только история фандинга")
+    return parser.parse_args()
+
+def collect_single():
+    """Исходный режим: одна монета SYMBOL за последние DAYS_AGO дней"""
     # Вычисляем временной диапазон для вчерашнего дня
     today = datetime.utcnow().date()
     end_of_yesterday = datetime.combine(today, datetime.min.time())
@@ -92,18 +280,25 @@ if __name__ == "__main__":
     
     print(f"--- Сбор данных для {SYMBOL} за {start_of_yesterday.strftime('%Y-%m-%d')} ---")
     
+    store = MarketStore(DEFAULT_ROOT)
+
     # 1. Получаем и сохраняем историю фандинга
     funding_data = fetch_funding_history(SYMBOL, start_ts_ms, end_ts_ms)
     if funding_data:
-        df_funding = pd.DataFrame(funding_data)
-        df_funding.to_json("funding_history.json", orient="records", indent=4)
-        print("💾 История фандинга сохранена в `funding_history.json`")
+        store.append('funding', 'MEXC', SYMBOL, [(r['settleTime'], r['fundingRate']) for r in funding_data])
+        print(f"💾 История фандинга сохранена в `{store.root}/MEXC/{SYMBOL}/funding`")
 
     # 2. Получаем и сохраняем историю свечей
     kline_data = fetch_klines(SYMBOL, start_ts_ms, end_ts_ms)
     if kline_data:
-        df_klines = pd.DataFrame(kline_data, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-        df_klines.to_json("klines_1m.json", orient="records", indent=4)
-        print("💾 1-минутные свечи сохранены в `klines_1m.json`")
+        store.append('klines_1m', 'MEXC', SYMBOL, [k for k in kline_data if k[0] <= end_ts_ms])
+        print(f"💾 1-минутные свечи сохранены в `{store.root}/MEXC/{SYMBOL}/klines_1m`")
         
     print("\n--- Готово! ---")
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.symbols or args.all:
+        asyncio.run(run_batch(args))
+    else:
+        collect_single()
@@ -0,0 +1,172 @@
+# market_store.py
+"""
+Колоночное хранилище минутных свечей и истории фандинга.
+
+Данные лежат по партициям <root>/<биржа>/<монета>/<вид>/<YYYY-MM-DD>.npy (день в UTC).
+Каждая партиция - структурированный массив NumPy, отсортированный по timestamp (мс).
+Файлы .npy открываются через mmap: чтение диапазона не парсит текст и не копирует
+данные, колонка (например, rows['close']) - это просто вид на отображенный файл.
+Индекс - имена партиций (дни) плюс бинарный поиск по timestamp внутри дня.
+Рядом лежит coverage.json - отрезки времени [start, end] (мс, включительно), которые уже
+полностью скачаны: по нему видно, какие части запрошенного диапазона надо докачать.
+"""
+import os
+import json
+import gzip
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+KLINE_DTYPE = np.dtype([('timestamp', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'), ('volume', '<f8')])
+FUNDING_DTYPE = np.dtype([('timestamp', '<i8'), ('rate', '<f8')])
+DTYPES = {'klines_1m': KLINE_DTYPE, 'funding': FUNDING_DTYPE}
+CSV_FORMATS = {'klines_1m': '%d,%.10g,%.10g,%.10g,%.10g,%.10g', 'funding': '%d,%.10g'}
+DAY_MS = 24 * 60 * 60 * 1000
+# Общий корень для бота, data_collector.py и backtester.py: market_data рядом со скриптами,
+# а не в текущей папке - иначе запуск из другого каталога читал бы и писал другое хранилище
+DEFAULT_ROOT = os.getenv("MARKET_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "market_data"))
+
+
+def day_name(day_start_ms: int) -> str:
+    return datetime.fromtimestamp(day_start_ms / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def to_rows(kind: str, rows: Iterable) -> np.ndarray:
+    """Кортежи (timestamp, ...) в структурированный массив нужного вида"""
+    if isinstance(rows, np.ndarray) and rows.dtype == DTYPES[kind]:
+        return rows
+    return np.array([tuple(row) for row in rows], dtype=DTYPES[kind])
+
+
+class MarketStore:
+    def __init__(self, root: str = DEFAULT_ROOT):
+        self.root = root
+
+    def _dir(self, kind: str, exchange: str, symbol: str) -> str:
+        return os.path.join(self.root, exchange, symbol, kind)
+
+    def partition_path(self, kind: str, exchange: str, symbol: str, day_start_ms: int) -> str:
+        return os.path.join(self._dir(kind, exchange, symbol), f"{day_name(day_start_ms)}.npy")
+
+    def days(self, kind: str, exchange: str, symbol: str) -> List[int]:
+        """Начала дней (мс), за которые есть партиции, по возрастанию"""
+        path = self._dir(kind, exchange, symbol)
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(datetime.strptime(name[:-4], "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+                      for name in os.listdir(path) if name.endswith(".npy"))
+
+    def read_day(self, kind: str, exchange: str, symbol: str, day_start_ms: int) -> np.ndarray:
+        path = self.partition_path(kind, exchange, symbol, day_start_ms)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=DTYPES[kind])
+        return np.load(path, mmap_mode='r')
+
+    def append(self, kind: str, exchange: str, symbol: str, rows: Iterable) -> int:
+        """
+        Дописывает строки в дневные партиции. Повтор timestamp заменяет старую строку
+        (биржа могла досчитать незакрытую свечу). Возвращает число новых строк.
+        """
+        rows = to_rows(kind, rows)
+        if not len(rows):
+            return 0
+        added = 0
+        day_starts = rows['timestamp'] - rows['timestamp'] % DAY_MS
+        for day_start in np.unique(day_starts).tolist():
+            new = rows[day_starts == day_start]
+            existing = np.array(self.read_day(kind, exchange, symbol, day_start))  # копия: файл будет заменен
+            merged = np.concatenate([new, existing])
+            _, first = np.unique(merged['timestamp'], return_index=True)  # новые строки идут первыми и побеждают
+            merged = merged[first]
+            path = self.partition_path(kind, exchange, symbol, day_start)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, merged)
+            os.replace(tmp_path, path)  # читатели со старым mmap дочитают прежний файл
+            added += len(merged) - len(existing)
+        return added
+
+    def _coverage_path(self, kind: str, exchange: str, symbol: str) -> str:
+        return os.path.join(self._dir(kind, exchange, symbol), "coverage.json")
+
+    def coverage(self, kind: str, exchange: str, symbol: str) -> List[Tuple[int, int]]:
+        path = self._coverage_path(kind, exchange, symbol)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [tuple(interval) for interval in json.load(f)]
+
+    def mark_covered(self, kind: str, exchange: str, symbol: str, start_ms: int, end_ms: int):
+        """Отмечает [start_ms, end_ms] скачанным, сливая соседние и пересекающиеся отрезки"""
+        if end_ms < start_ms:
+            return
+        merged = []
+        for start, end in sorted(self.coverage(kind, exchange, symbol) + [(start_ms, end_ms)]):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        path = self._coverage_path(kind, exchange, symbol)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(merged, f)
+        os.replace(path + ".tmp", path)
+
+    def missing(self, kind: str, exchange: str, symbol: str, start_ms: int, end_ms: int) -> List[Tuple[int, int]]:
+        """Части [start_ms, end_ms], которых нет в coverage"""
+        gaps, current = [], start_ms
+        for start, end in self.coverage(kind, exchange, symbol):
+            if end < current:
+                continue
+            if start > end_ms:
+                break
+            if start > current:
+                gaps.append((current, start - 1))
+            current = end + 1
+            if current > end_ms:
+                return gaps
+        gaps.append((current, end_ms))
+        return gaps
+
+    def iter_range(self, kind: str, exchange: str, symbol: str, start_ms: int, end_ms: Optional[int] = None) -> Iterator[np.ndarray]:
+        """Строки с timestamp в [start_ms, end_ms] по дням - без копирования (виды на mmap)"""
+        end_ms = end_ms if end_ms is not None else 2 ** 62
+        for day_start in self.days(kind, exchange, symbol):
+            if day_start + DAY_MS <= start_ms or day_start > end_ms:
+                continue
+            rows = self.read_day(kind, exchange, symbol, day_start)
+            timestamps = rows['timestamp']
+            lo = np.searchsorted(timestamps, start_ms, side='left')
+            hi = np.searchsorted(timestamps, end_ms, side='right')
+            if hi > lo:
+                yield rows[lo:hi]
+
+    def read_range(self, kind: str, exchange: str, symbol: str, start_ms: int = 0, end_ms: Optional[int] = None) -> np.ndarray:
+        """Диапазон одним массивом (один день - без копирования, несколько - одна склейка)"""
+        parts = list(self.iter_range(kind, exchange, symbol, start_ms, end_ms))
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=DTYPES[kind])
+
+    # --- Выгрузка диапазона в файл: партиции пишутся по очереди прямо из mmap, без склейки ---
+    def write_npy(self, fileobj: BinaryIO, kind: str, exchange: str, symbol: str, start_ms: int, end_ms: Optional[int] = None) -> int:
+        """Диапазон одним .npy: заголовок на общую длину, затем байты партиций. Возвращает число строк"""
+        parts = list(self.iter_range(kind, exchange, symbol, start_ms, end_ms))
+        total = sum(len(part) for part in parts)
+        np.lib.format.write_array_header_1_0(fileobj, {'descr': np.lib.format.dtype_to_descr(DTYPES[kind]),
+                                                      'fortran_order': False, 'shape': (total,)})
+        for part in parts:
+            fileobj.write(memoryview(part).cast('B'))  # срез партиции непрерывен - копии нет
+        return total
+
+    def write_csv_gz(self, fileobj: BinaryIO, kind: str, exchange: str, symbol: str, start_ms: int, end_ms: Optional[int] = None) -> int:
+        """Диапазон в CSV, сжатый gzip на лету. Возвращает число строк"""
+        total = 0
+        with gzip.GzipFile(fileobj=fileobj, mode='wb') as gz:  # fileobj остается открытым
+            gz.write((",".join(DTYPES[kind].names) + "\n").encode())
+            for part in self.iter_range(kind, exchange, symbol, start_ms, end_ms):
+                np.savetxt(gz, part, fmt=CSV_FORMATS[kind])
+                total += len(part)
+        return total
@@ -0,0 +1,153 @@
+"""
+Потоки бирж против локального WebSocket-стенда, который проигрывает записанные кадры:
+Bybit (tests/fixtures/bybit_tickers.jsonl) - snapshot, дельты, ответы на subscribe/ping;
+Binance (tests/fixtures/binance_mark_price.jsonl) - массивы !markPrice@arr с обрывом соединения.
+"""
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+FIXTURE = os.path.join(FIXTURES, "bybit_tickers.jsonl")
+BINANCE_FIXTURE = os.path.join(FIXTURES, "binance_mark_price.jsonl")
+BINANCE_TICKERS = [{"symbol": "BTCUSDT", "quoteVolume": "12000000000.5"}, {"symbol": "ETHUSDT", "quoteVolume": "5000000000"},
+                   {"symbol": "SOLUSDT", "quoteVolume": "900000000"}]  # XRPUSDT без тикера 24ч
+
+
+async def replay_bybit_frames():
+    with open(FIXTURE) as f:
+        frames = [line.strip() for line in f if line.strip()]
+    subscriptions = []
+
+    async def handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscriptions.extend((await ws.receive_json())['args'])
+        for frame in frames:
+            await ws.send_str(frame)
+        async for _ in ws:  # держим соединение, пока клиент не отключится
+            pass
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/ws", handler)
+    server = TestServer(app)
+    await server.start_server()
+    stream = bot.BybitTickerStream(url=str(server.make_url("/ws")), symbols=["BTCUSDT", "ETHUSDT"])
+    try:
+        stream.start()
+        deadline = time.monotonic() + 5
+        while stream.book.get("ETHUSDT", {}).get("nextFundingTime") != "1673308800000":  # последний кадр
+            assert time.monotonic() < deadline, "кадры не дошли до потока"
+            await asyncio.sleep(0.01)
+        return stream, subscriptions, stream.is_live()
+    finally:
+        await stream.stop()
+        await server.close()
+        await bot.close_http_session()
+
+
+async def replay_binance_frames():
+    # пустая строка в фикстуре - обрыв: кадры до нее идут в первое соединение, после - во второе
+    with open(BINANCE_FIXTURE) as f:
+        connections = [[line for line in block.splitlines() if line.strip()] for block in f.read().split("\n\n")]
+    served = []
+
+    async def handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        frames = connections[min(len(served), len(connections) - 1)]
+        served.append(len(frames))
+        for frame in frames:
+            await ws.send_str(frame)
+        if len(served) < len(connections):
+            await ws.close()  # сервер рвет соединение - поток должен переподключиться
+        else:
+            async for _ in ws:
+                pass
+        return ws
+
+    async def tickers(request):
+        return web.json_response(BINANCE_TICKERS)
+
+    app = web.Application()
+    app.router.add_get("/ws", handler)
+    app.router.add_get("/ticker", tickers)
+    server = TestServer(app)
+    await server.start_server()
+    stream = bot.BinanceMarkPriceStream(url=str(server.make_url("/ws")), ticker_url=str(server.make_url("/ticker")))
+    try:
+        stream.start()
+        deadline = time.monotonic() + 5
+        while "SOLUSDT" not in stream.book:  # последний кадр второго соединения
+            assert time.monotonic() < deadline, "кадры после переподключения не дошли до потока"
+            await asyncio.sleep(0.01)
+        live, updates = stream.is_live(), stream.updates
+        await stream.refresh_volumes_if_due()
+        return stream, served, live, updates
+    finally:
+        await stream.stop()
+        await server.close()
+        await bot.close_http_session()
+
+
+def test_bybit_stream_applies_snapshot_and_deltas():
+    stream, subscriptions, live = asyncio.run(replay_bybit_frames())
+
+    assert subscriptions == ["tickers.BTCUSDT", "tickers.ETHUSDT"]
+    assert live
+    # в книге только нужные поля; дельты без них книгу не трогают, пустые значения игнорируются
+    assert stream.book == {
+        "BTCUSDT": {"symbol": "BTCUSDT", "fundingRate": "-0.000215", "nextFundingTime": "1673280000000",
+                    "turnover24h": "1570412555.1"},
+        "ETHUSDT": {"symbol": "ETHUSDT", "fundingRate": "0.000125", "nextFundingTime": "1673308800000",
+                    "turnover24h": "987654321.1234"},
+    }
+
+    records = {record.symbol: record for record in stream.records()}
+    assert set(records) == {"BTCUSDT", "ETHUSDT"}
+    btc, eth = records["BTCUSDT"], records["ETHUSDT"]
+    assert (btc.exchange, btc.rate, btc.next_funding_time, btc.volume_24h_usdt) == ("Bybit", -0.000215, 1673280000000, 1570412555.1)
+    assert (eth.rate, eth.next_funding_time, eth.volume_24h_usdt) == (0.000125, 1673308800000, 987654321.1234)
+    assert stream.records() == list(records.values())  # без новых кадров записи не пересобираются
+
+
+def test_binance_stream_parses_mark_price_and_reconnects():
+    stream, served, live, updates = asyncio.run(replay_binance_frames())
+
+    assert served == [2, 2]  # второе соединение - переподключение после обрыва
+    assert live
+    # поставочные контракты без ставки пропускаются; повтор той же ставки книгу не меняет
+    assert stream.book == {
+        "BTCUSDT": ("-0.00002500", 1700006400000),
+        "ETHUSDT": ("0.00007500", 1700006400000),
+        "XRPUSDT": ("0.00010000", 1700006400000),
+        "SOLUSDT": ("0.00012000", 1700006400000),
+    }
+    assert updates == 6  # BTC, ETH; ETH; BTC, XRP; SOL - кадры с одной ценой не считаются
+
+    records = {record.symbol: record for record in stream.records()}
+    assert set(records) == {"BTCUSDT", "ETHUSDT", "SOLUSDT"}  # как в REST: только символы с тикером 24ч
+    btc = records["BTCUSDT"]
+    assert (btc.exchange, btc.rate, btc.next_funding_time, btc.volume_24h_usdt) == ("Binance", -0.000025, 1700006400000, 12000000000.5)
+    assert records["ETHUSDT"].rate == 0.000075 and records["SOLUSDT"].volume_24h_usdt == 900000000.0
+
+
+def test_exchange_stream_requires_hooks():
+    class Incomplete(bot.ExchangeStream):
+        def apply_message(self, message):
+            pass
+
+    try:
+        Incomplete("ws://localhost")
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("records() должен быть абстрактным")